@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark the extraction on a synthetic CCI Lakes dataset.
+
+The dataset is generated once per scale (or reused) and the extraction paths are redirected
+to it. Each workload runs in a separate process to measure its peak memory. Per-stage timings
+(file discovery, lake index, open/read, write) are measured on the hot loop of the per-lake
+extraction. Results are printed and can be stored as JSON lines and compared to a baseline:
+
+    python -m benchmarks.benchmark --days 30 --lakes 50 --output results.jsonl
+    python -m benchmarks.benchmark --days 30 --lakes 50 --baseline results.jsonl
+"""
+
+import json
+import argparse
+import tempfile
+from pathlib import Path
+from multiprocessing import Process, Queue
+from time import time
+try:
+    import resource
+except ImportError:
+    resource = None
+import numpy as np
+import netCDF4 as nc4
+from scripts import constants as c
+from scripts.lakeindex import load_lake_index
+from scripts.functions import find_ncfiles, create_output, read_day, BlockWriter, extract_lake_subset
+from scripts.engine import extract_lakes_daymajor
+from scripts.scheduler import run_scheduled
+from benchmarks.synthetic import make_dataset
+
+WORKLOADS = ['stages', 'lake', 'pixels', 'zarr', 'daymajor', 'scheduled']
+
+def use_dataset(path):
+    """Redirect the extraction to the synthetic dataset at path."""
+    c.PATH_RAW = str(path.joinpath('raw'))
+    c.PATH_AUXILIARY = str(path.joinpath('auxiliary'))
+    c.PATH_ABBREV = str(path.joinpath('auxiliary').joinpath('abbreviations.json'))
+    c.PATH_EXTRACTED = str(path.joinpath('extracted'))
+    c.PATH_CATALOG = str(path.joinpath('cache'))
+    c.PATH_CONSOLIDATED = str(path.joinpath('consolidated'))
+
+def peak_rss_mb():
+    """Return the peak resident memory of this process and its children in MB (0 if not available, e.g. on Windows)."""
+    if resource is None:
+        return 0.0
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+def extracted_mb(lakeids: list, variables: list, paths_ncfiles: list):
+    """Return the uncompressed size of the extracted bboxes in MB."""
+    lake_index = load_lake_index()
+    cells = 0
+    for lakeid in lakeids:
+        i0, i1, j0, j1 = lake_index.bbox_of(int(lakeid))
+        cells += (i1 - i0) * (j1 - j0)
+    with nc4.Dataset(paths_ncfiles[0], 'r') as nc_in:
+        itemsize = sum(nc_in[v_name].dtype.itemsize for v_name in variables)
+    return cells * itemsize * len(paths_ncfiles) / 1024**2
+
+def run_stages(lakeids: list, variables: list, startdate: str, enddate: str, block_days: int):
+    """Time the stages of the per-lake extraction of all lakes and return dict of seconds."""
+    timings = dict.fromkeys(['discovery', 'index_build', 'index_load', 'open', 'read', 'write'], 0.0)
+    time_start = time()
+    load_lake_index(rebuild=True)
+    timings['index_build'] = time() - time_start
+
+    path_extracted = Path(c.PATH_EXTRACTED)
+    path_extracted.mkdir(parents=True, exist_ok=True)
+    for lakeid in lakeids:
+        time_start = time()
+        paths_ncfiles = find_ncfiles(startdate, enddate)
+        timings['discovery'] += time() - time_start
+
+        time_start = time()
+        window = load_lake_index().window([int(lakeid)])
+        timings['index_load'] += time() - time_start
+
+        with nc4.Dataset(path_extracted.joinpath(f'stages-{lakeid}.nc'), 'w', format='NETCDF4') as nc_out:
+            writer = BlockWriter(nc_out, window.mask, block_days=block_days)
+            for idx, filepath in enumerate(paths_ncfiles):
+                time_start = time()
+                nc_in = nc4.Dataset(filepath, 'r')
+                timings['open'] += time() - time_start
+
+                time_start = time()
+                fields = read_day(nc_in, variables, window.bbox)
+                time_value = nc_in['time'][0]
+                timings['read'] += time() - time_start
+
+                time_start = time()
+                if idx == 0:
+                    create_output(nc_out, nc_in, window, 'stages', int(lakeid), variables,
+                                  chunk_time=block_days)
+                writer.append(fields, time_value, nc_in.time_coverage_end)
+                timings['write'] += time() - time_start
+                nc_in.close()
+
+            time_start = time()
+            writer.flush()
+        timings['write'] += time() - time_start
+    return timings
+
+def run_workload(workload: str, lakeids: list, settings: dict, n_processes: int):
+    """Run a workload and return dict of seconds per stage (total only for end-to-end workloads)."""
+    extract_settings = {k: settings[k] for k in ['variables', 'startdate', 'enddate', 'compress',
+                                                'complevel', 'block_days']}
+    time_start = time()
+    if workload == 'stages':
+        timings = run_stages(lakeids, settings['variables'], settings['startdate'],
+                             settings['enddate'], settings['block_days'])
+    elif workload in ['lake', 'pixels', 'zarr']:
+        for lakeid in lakeids:
+            extract_lake_subset(lakeid=int(lakeid), layout='pixels' if workload == 'pixels' else 'grid',
+                                backend='zarr' if workload == 'zarr' else 'netcdf', **extract_settings)
+        timings = {}
+    elif workload == 'daymajor':
+        extract_lakes_daymajor([int(lakeid) for lakeid in lakeids], **extract_settings)
+        timings = {}
+    elif workload == 'scheduled':
+        run_scheduled([int(lakeid) for lakeid in lakeids], {**settings, 'use_opendap': False},
+                      n_processes)
+        timings = {}
+    else:
+        raise ValueError(f'Unknown workload {workload}, use one of {WORKLOADS}!')
+    timings['total'] = time() - time_start
+    return timings
+
+def measure(queue, path_dataset, workload, lakeids, settings, n_processes):
+    """Run a workload in a child process and put its timings and peak memory into the queue."""
+    use_dataset(path_dataset)
+    with tempfile.TemporaryDirectory(dir=path_dataset) as path_extracted:
+        c.PATH_EXTRACTED = path_extracted
+        timings = run_workload(workload, lakeids, settings, n_processes)
+        output_mb = sum(p.stat().st_size for p in Path(path_extracted).rglob('*') if p.is_file()) / 1024**2
+    queue.put({'timings': timings, 'peak_rss_mb': peak_rss_mb(), 'output_mb': output_mb})
+
+def benchmark(path_dataset, workloads: list, lakeids: list, settings: dict, n_processes: int):
+    """Run the workloads one after the other and return list of result dicts."""
+    use_dataset(path_dataset)
+    paths_ncfiles = find_ncfiles(settings['startdate'], settings['enddate'])
+    n_days = len(paths_ncfiles)
+    input_mb = extracted_mb(lakeids, settings['variables'], paths_ncfiles)
+    results = []
+    for workload in workloads:
+        queue = Queue()
+        process = Process(target=measure, args=(queue, path_dataset, workload, lakeids, settings,
+                                                n_processes))
+        process.start()
+        result = queue.get()
+        process.join()
+        total = result['timings']['total']
+        results.append({'workload': workload, 'lakes': len(lakeids), 'days': n_days,
+                        'complevel': settings['complevel'], 'processes': n_processes,
+                        'days_per_s': n_days * len(lakeids) / total,
+                        'mb_per_s': input_mb / total, **result})
+    return results
+
+def report(results: list, baseline: list = None):
+    """Print the results, with the change of days/s relative to the baseline if given."""
+    baseline = {r['workload']: r for r in baseline or []}
+    print(f'{"workload":<10} {"lake-days/s":>12} {"MB/s":>9} {"peak MB":>9} {"out MB":>8} {"change":>8}  stages (s)')
+    for r in results:
+        change = ''
+        if r['workload'] in baseline:
+            change = f'{100 * (r["days_per_s"] / baseline[r["workload"]]["days_per_s"] - 1):+0.1f}%'
+        stages = ' '.join(f'{k}={v:0.2f}' for k, v in r['timings'].items())
+        print(f'{r["workload"]:<10} {r["days_per_s"]:>12.1f} {r["mb_per_s"]:>9.1f} {r["peak_rss_mb"]:>9.0f} '
+              f'{r["output_mb"]:>8.1f} {change:>8}  {stages}')
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the extraction on a synthetic CCI Lakes dataset.')
+    parser.add_argument('--path', type=Path, default=None,
+                        help='Directory of the synthetic dataset (default: generated per scale in the temp dir)')
+    parser.add_argument('--days', type=int, default=30, help='Number of daily files')
+    parser.add_argument('--lakes', type=int, default=50, help='Number of lakes')
+    parser.add_argument('--ny', type=int, default=900, help='Grid cells along latitude')
+    parser.add_argument('--nx', type=int, default=1800, help='Grid cells along longitude')
+    parser.add_argument('--input-complevel', type=int, default=4, help='Compression level of the daily files')
+    parser.add_argument('--complevel', type=int, default=4, help='Compression level of the outputs (0 to disable)')
+    parser.add_argument('--block-days', type=int, default=c.BLOCK_DAYS, help='Days written at once')
+    parser.add_argument('--processes', type=int, default=4, help='Processes of the scheduled workload')
+    parser.add_argument('--variables', nargs='+', default=c.DEFAULT_VARS, help='Variables to extract')
+    parser.add_argument('--workloads', nargs='+', default=WORKLOADS, choices=WORKLOADS)
+    parser.add_argument('--output', type=Path, default=None, help='Append results as JSON lines')
+    parser.add_argument('--baseline', type=Path, default=None, help='JSON lines of a previous run to compare to')
+    args = parser.parse_args()
+
+    scale = f'd{args.days}-l{args.lakes}-{args.ny}x{args.nx}-c{args.input_complevel}'
+    path_dataset = args.path or Path(tempfile.gettempdir()).joinpath(f'lakecrest-bench-{scale}')
+    startdate = '2010-01-01'
+    if not path_dataset.joinpath('auxiliary').joinpath(c.FN_MASK).exists():
+        print(f'Generating synthetic dataset ({scale}) in {path_dataset}..')
+        make_dataset(path_dataset, n_days=args.days, n_lakes=args.lakes, ny=args.ny, nx=args.nx,
+                     startdate=startdate, complevel=args.input_complevel)
+
+    use_dataset(path_dataset)
+    lakeids = [int(lakeid) for lakeid in load_lake_index().ids]
+    enddate = str(np.datetime64(startdate) + np.timedelta64(args.days - 1, 'D'))
+    settings = {'variables': args.variables, 'startdate': startdate, 'enddate': enddate,
+                'compress': args.complevel > 0, 'complevel': max(args.complevel, 1),
+                'block_days': args.block_days, 'verbose': False}
+
+    results = benchmark(path_dataset, args.workloads, lakeids, settings, args.processes)
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = [json.loads(line) for line in f if line.strip()]
+    report(results, baseline)
+
+    if args.output is not None:
+        with open(args.output, 'a') as f:
+            for result in results:
+                f.write(json.dumps({'scale': scale, **result}) + '\n')
+
+if __name__ == '__main__':
+    main()
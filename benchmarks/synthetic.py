@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+"""This module generates a synthetic CCI Lakes dataset for benchmarking.
+
+The dataset mirrors the layout of the real one: daily files named
+ESACCI-LAKES-L3S-LK_PRODUCTS-MERGED-YYYYMMDD-fv{VERSION}.nc in yearly and monthly folders,
+the static lake mask, the data-availability table and the abbreviations. Only the
+grid size is reduced, the variables, dtypes and attributes follow the real files.
+"""
+
+import shutil
+import numpy as np
+import pandas as pd
+import netCDF4 as nc4
+from scripts import constants as c
+from scripts import ROOT
+
+# Variables of the daily files with dtype, packing and attributes of the real dataset
+VARIABLES = {
+    'lake_surface_water_temperature': ('i2', {
+        'long_name': 'lake surface skin temperature', 'standard_name': 'lake_surface_skin_temperature',
+        'units': 'K', 'scale_factor': 0.01, 'add_offset': 273.15,
+        'valid_min': np.int16(-1000), 'valid_max': np.int16(5000)}),
+    'lswt_uncertainty': ('i2', {
+        'long_name': 'Total uncertainty in lake surface water temperature', 'units': 'K',
+        'scale_factor': 0.001, 'add_offset': 0.0, 'valid_min': np.int16(0), 'valid_max': np.int16(10000)}),
+    'lswt_quality_level': ('i1', {
+        'long_name': 'Quality levels of lake surface water temperature',
+        'flag_values': np.arange(6, dtype=np.int8),
+        'flag_meanings': 'unprocessed bad suspect_or_marginal intermediate good best'}),
+    'lake_ice_cover_class': ('i1', {
+        'long_name': 'lake ice cover categorization',
+        'flag_values': np.arange(1, 4, dtype=np.int8), 'flag_meanings': 'open_water ice cloud'}),
+    'chla_mean': ('f4', {
+        'long_name': 'Mean of chlorophyll-a concentration', 'units': 'mg m-3'}),
+}
+
+def make_lakes(ny: int, nx: int, n_lakes: int, rng):
+    """Draw elliptic lakes of log-uniform size and return the lakeid grid (0 outside lakes)."""
+    lakeids = np.zeros((ny, nx), dtype=np.int32)
+    radius_max = max(2, min(ny, nx) // 8)
+    radii = np.exp(rng.uniform(np.log(1), np.log(radius_max), size=(n_lakes, 2)))
+    rows, cols = np.ogrid[:ny, :nx]
+    # Largest lakes first, so small lakes are not covered by large ones
+    for lakeid, (ri, rj) in enumerate(sorted(radii, key=lambda r: -r[0] * r[1]), start=1):
+        ci = rng.integers(int(ri) + 1, ny - int(ri) - 1)
+        cj = rng.integers(int(rj) + 1, nx - int(rj) - 1)
+        i0, i1 = max(0, int(ci - ri) - 1), min(ny, int(ci + ri) + 2)
+        j0, j1 = max(0, int(cj - rj) - 1), min(nx, int(cj + rj) + 2)
+        inside = ((rows[i0:i1] - ci) / ri) ** 2 + ((cols[:, j0:j1] - cj) / rj) ** 2 <= 1
+        inside &= rng.random(inside.shape) < 0.95
+        lakeids[i0:i1, j0:j1][inside & (lakeids[i0:i1, j0:j1] == 0)] = lakeid
+    return lakeids
+
+def write_mask(path_maskfile, lat, lon, lakeids, rng):
+    """Write the static lake mask with lakeids and distance to shoreline."""
+    with nc4.Dataset(path_maskfile, 'w', format='NETCDF4') as nc_mask:
+        nc_mask.createDimension('lat', len(lat))
+        nc_mask.createDimension('lon', len(lon))
+        nc_mask.createVariable('lat', 'f4', ('lat',))[:] = lat
+        nc_mask.createVariable('lon', 'f4', ('lon',))[:] = lon
+        nc_mask.createVariable('CCI_lakeid', 'i4', ('lat', 'lon'), zlib=True)[:] = lakeids
+        var_dist = nc_mask.createVariable('distance_to_land', 'f4', ('lat', 'lon'), zlib=True,
+                                          fill_value=nc4.default_fillvals['f4'])
+        var_dist.units = 'km'
+        var_dist[:] = np.ma.masked_array(rng.random(lakeids.shape, dtype=np.float32) * 50,
+                                         mask=lakeids == 0)
+
+def write_table(path_table, lat, lon, lakeids):
+    """Write the data-availability table of the synthetic lakes."""
+    ids = np.unique(lakeids[lakeids > 0])
+    rows, cols = np.nonzero(lakeids)
+    centre = pd.DataFrame({'id': lakeids[rows, cols], 'lat': lat[rows], 'lon': lon[cols]}).groupby('id').mean()
+    df = pd.DataFrame({'id': ids, 'short_name': [f'SYNT{lakeid:08d}' for lakeid in ids],
+                       'name': [f'Synthetic {lakeid}' for lakeid in ids],
+                       'lat centre': centre.loc[ids, 'lat'].round(4).values,
+                       'lon centre': centre.loc[ids, 'lon'].round(4).values})
+    for column in ['lwl_data', 'lwe_data', 'lswt_data', 'lic_data', 'lwlr_data']:
+        df[column] = True
+    df.to_csv(path_table, index=False)
+
+def write_day(path_ncfile, date, lat, lon, lakeids, rng, complevel: int = 4):
+    """Write one synthetic daily file."""
+    ny, nx = lakeids.shape
+    lake = lakeids > 0
+    with nc4.Dataset(path_ncfile, 'w', format='NETCDF4') as nc_day:
+        nc_day.setncatts({'title': 'ESA CCI Lakes (synthetic benchmark data)',
+                          'Conventions': 'CF-1.7', 'product_version': c.VERSION,
+                          'time_coverage_start': f'{date:%Y%m%d}T000000Z',
+                          'time_coverage_end': f'{date:%Y%m%d}T235959Z',
+                          'geospatial_lat_min': float(lat.min()), 'geospatial_lat_max': float(lat.max()),
+                          'geospatial_lon_min': float(lon.min()), 'geospatial_lon_max': float(lon.max())})
+        nc_day.createDimension('time', None)
+        nc_day.createDimension('lat', ny)
+        nc_day.createDimension('lon', nx)
+        var_time = nc_day.createVariable('time', 'i4', ('time',))
+        var_time.setncatts({'units': 'seconds since 1970-01-01 00:00:00', 'calendar': 'standard',
+                            'standard_name': 'time'})
+        var_time[0] = int((date - pd.Timestamp('1970-01-01')).total_seconds())
+        for v_name, values in [('lat', lat), ('lon', lon)]:
+            outVar = nc_day.createVariable(v_name, 'f4', (v_name,))
+            outVar.setncatts({'units': f'degrees_{"north" if v_name == "lat" else "east"}',
+                              'standard_name': 'latitude' if v_name == 'lat' else 'longitude'})
+            outVar[:] = values
+
+        # Clouds hide part of the lakes, the remaining lakecells are observed
+        observed = lake & (rng.random((ny, nx)) < 0.6)
+        data = {'lake_surface_water_temperature': rng.normal(285, 6, (ny, nx)),
+                'lswt_uncertainty': rng.uniform(0.2, 2, (ny, nx)),
+                'lswt_quality_level': rng.integers(0, 6, (ny, nx)),
+                'lake_ice_cover_class': np.where(observed, rng.integers(1, 3, (ny, nx)), 3),
+                'chla_mean': rng.lognormal(1, 1, (ny, nx))}
+        masks = {'lake_ice_cover_class': ~lake}
+        chunksizes = (1, min(ny, 1024), min(nx, 1024))
+        for v_name, (dtype, attrs) in VARIABLES.items():
+            outVar = nc_day.createVariable(v_name, dtype, ('time', 'lat', 'lon'), zlib=complevel > 0,
+                                           complevel=max(complevel, 1), chunksizes=chunksizes,
+                                           fill_value=nc4.default_fillvals[dtype])
+            outVar.setncatts(attrs)
+            outVar[0, :, :] = np.ma.masked_array(data[v_name], mask=masks.get(v_name, ~observed))
+
+def make_dataset(path, n_days: int = 30, n_lakes: int = 50, ny: int = 900, nx: int = 1800,
+                 startdate: str = '2010-01-01', complevel: int = 4, seed: int = 0):
+    """Generate a synthetic CCI Lakes dataset.
+
+    Parameters
+    ----------
+    path : Path
+        Root directory of the dataset, the daily files are put into raw/v{VERSION}/ and the
+        maskfile, data-availability table and abbreviations into auxiliary/
+    n_days : int
+        Number of daily files
+    n_lakes : int
+        Number of lakes
+    ny : int
+        Number of grid cells along latitude
+    nx : int
+        Number of grid cells along longitude
+    startdate : str
+        Date of the first daily file in the form (YYYY-MM-DD)
+    complevel : int
+        Compression level of the daily files (0 for uncompressed)
+    seed : int
+        Seed of the random generator
+    Returns
+    -------
+    np.ndarray
+        CCI lake ids of the synthetic lakes
+    """
+    rng = np.random.default_rng(seed)
+    path_auxiliary = path.joinpath('auxiliary')
+    path_dataset = path.joinpath('raw').joinpath(f'v{c.VERSION}')
+    path_auxiliary.mkdir(parents=True, exist_ok=True)
+
+    lat = np.linspace(90 - 90 / ny, -90 + 90 / ny, ny, dtype=np.float32)
+    lon = np.linspace(-180 + 180 / nx, 180 - 180 / nx, nx, dtype=np.float32)
+    lakeids = make_lakes(ny, nx, n_lakes, rng)
+    write_mask(path_auxiliary.joinpath(c.FN_MASK), lat, lon, lakeids, rng)
+    write_table(path_auxiliary.joinpath(c.FN_TABLE), lat, lon, lakeids)
+    shutil.copy(ROOT.joinpath(c.PATH_ABBREV), path_auxiliary.joinpath('abbreviations.json'))
+
+    for date in pd.date_range(startdate, periods=n_days):
+        path_day = path_dataset.joinpath(f'{date:%Y}').joinpath(f'{date:%m}')
+        path_day.mkdir(parents=True, exist_ok=True)
+        write_day(path_day.joinpath(f'ESACCI-LAKES-L3S-LK_PRODUCTS-MERGED-{date:%Y%m%d}-fv{c.VERSION}.nc'),
+                  date, lat, lon, lakeids, rng, complevel)
+
+    return np.unique(lakeids[lakeids > 0])
@@ -1,31 +1,50 @@
 # -*- coding: utf-8 -*-
 
-from multiprocessing import Pool
-from scripts.functions import data_extraction, find_lakeid
+from scripts.lookup import load_lake_table, find_lakeids
+from scripts.cli import run_extraction
+
+# Settings can also be passed as arguments, see: python -m scripts.cli --help
 
 # Define lakes of interest
 # Extract specific lakes by lakeids
 lakeids = [6, 2, 8, 9, 10, 12]
 
 # (OR) Extract all lakes
-#import pandas as pd
-#lakescci_lut = pd.read_csv('data/auxiliary/lakescci_v2.0.2_data-availability.csv')
-#lakeids = list(lakescci_lut.id)
+#lakeids = list(load_lake_table().id)
 
 # (OR) Extract specific lakes by names
 #lakenames = ['Michigan']
-#lakeids = [find_lakeid(lakename) for lakename in lakenames]
+#lakeids = find_lakeids(lakenames)
 
 # Set extraction settings
-settings = {'variables': ['lake_surface_water_temperature',
+settings = {'version': '2.0.1',         # (string) Version of the CCI Lakes dataset
+            'variables': ['lake_surface_water_temperature',
                           'lswt_quality_level',
                           'lake_ice_cover_class'], # (list) Variables to extract
             'use_opendap': False,      # (boolean) Download data using oPeNDAP (slow, up to 2sec per day)
+            'opendap_workers': 4,      # (int) Concurrent oPeNDAP requests per lake
+            'opendap_cache': True,     # (boolean) Reuse oPeNDAP downloads from the local cache (data/cache/opendap)
             'startdate': '1992-09-26', # (string) Startdate of the timeseries in the form (YYYY-MM-DD)
             'enddate': '2020-09-01',   # (string) Enddate of the timeseries in the form (YYYY-MM-DD)
             'compress': True,          # (boolean) Apply z-lib compression
             'complevel': 4,            # (int) Compression level to use
+            'incremental': False,      # (boolean) Resume interrupted runs or append new days to existing outputs
+            'block_days': 32,          # (int) Days buffered and written at once (time chunk size of the output)
+            'layout': 'grid',          # (string) Output layout, full bbox ('grid') or lakecells only ('pixels')
+            'backend': 'netcdf',       # (string) Output format, NETCDF4 file ('netcdf') or Zarr store ('zarr')
+            'statistics': None,        # (string) Also write daily lake-wide statistics as 'csv' or 'nc' (None to disable)
+            'min_quality': None,       # (int) Min. lswt_quality_level used for the temperature statistics (None for all)
+            'write_cube': True,        # (boolean) Write the extracted subsets, False to only write the statistics
+            'skip_empty': False,       # (boolean) Do not read days on which a lake certainly has no valid data
+            'use_consolidated': False, # (boolean) Read from the consolidated archive if it holds the days (local only)
             'verbose': False,          # (boolean) Print additional status updates
+            'metrics': False,          # (boolean) Record time per stage, bytes and peak memory per lake (metrics.jsonl)
+            'day_major': False,        # (boolean) Open each daily file once for all lakes of a process (local only)
+            'shard': None,             # (string) Extract large lakes in parallel 'year' or 'month' shards (None to disable)
+            'shard_min_cells': 10**6,  # (int) Min. bbox grid cells of a lake to extract it in shards
+            'stream': False,           # (boolean) Extract in batches within a memory budget, e.g. all lakes (local only)
+            'memory_mb': 16000,        # (int) Memory budget of all processes of the streaming extraction (MB)
+            'max_open_outputs': 256,   # (int) Max. outputs open at once per process of the streaming extraction
             }
 
 # Multiprocessing settings
@@ -33,12 +52,4 @@ n_processes = 4
 
 # Main (run extraction)
 if __name__ == '__main__':
-    
-    if settings['use_opendap']:
-        print(f'Start extracting {len(lakeids)} lakes using oPeNDAP (slow)..')
-    else:
-        print(f'Start extracting {len(lakeids)} lakes from local dataset..')
-    
-    # Run extraction in multiprocessing pool
-    with Pool(processes=n_processes) as p:
-        outputs = p.map(data_extraction, map(lambda id: (id, settings), lakeids))
+    run_extraction(lakeids, settings, n_processes)
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+"""This module finds the days on which a lake certainly has no valid data.
+
+Two sources are used: the data-availability table, which states per lake whether a product
+(e.g. LSWT or LIC) exists at all, and the availability index, which stores per day, variable
+and lake whether any lakecell is valid. The index is built in one pass over the rows of the
+daily files which contain lakes, saved next to the lake index and extended with new days
+when rebuilt. The extraction writes days which are certainly empty as fill without reading them.
+"""
+
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+import netCDF4 as nc4
+from scripts import constants as c
+from scripts import ROOT
+from scripts.lakeindex import load_lake_index, gather_pixels
+from scripts.catalog import load_catalog
+from scripts.lookup import load_lake_table
+
+# Columns of the data-availability table by prefix of the variable names
+TABLE_COLUMNS = {'lake_surface_water_temperature': 'lswt_data', 'lswt_': 'lswt_data',
+                 'lake_ice_cover': 'lic_data', 'water_surface_height': 'lwl_data',
+                 'lake_surface_water_extent': 'lwe_data', 'Rw': 'lwlr_data', 'chla': 'lwlr_data',
+                 'turbidity': 'lwlr_data'}
+
+_cache = {}
+
+def table_column(v_name: str):
+    """Return the column of the data-availability table of a variable (None if unknown)."""
+    for prefix, column in TABLE_COLUMNS.items():
+        if v_name.startswith(prefix):
+            return column
+    return None
+
+def table_empty(lakeids: list, variables: list):
+    """Check if the data-availability table states that none of the lakes has any of the variables."""
+    columns = [table_column(v_name) for v_name in variables]
+    if None in columns:
+        return False
+    df = load_lake_table()
+    if _cache.get('table', (None,))[0] is not df:
+        _cache['table'] = (df, df.set_index('id'))
+    df = _cache['table'][1]
+    if not all(lakeid in df.index for lakeid in lakeids) or not all(col in df.columns for col in columns):
+        return False
+    return not df.loc[list(lakeids), columns].astype(bool).values.any()
+
+class AvailabilityIndex:
+    """Memory-mapped flags per day, variable and lake whether any lakecell is valid."""
+
+    def __init__(self, path_index):
+        with open(path_index.joinpath('meta.json')) as f:
+            self.meta = json.load(f)
+        self.ids = np.load(path_index.joinpath('ids.npy'), mmap_mode='r')
+        self.dates, self.flags = {}, {}
+        for v_name in self.meta['variables']:
+            self.dates[v_name] = np.load(path_index.joinpath(f'{v_name}.dates.npy'))
+            self.flags[v_name] = np.load(path_index.joinpath(f'{v_name}.npy'), mmap_mode='r')
+
+    def empty_days(self, lakeids: list, variables: list, dates):
+        """Return boolean array, True for the dates on which none of the lakes has a valid lakecell."""
+        dates = np.asarray(dates, dtype='datetime64[D]')
+        pos = np.searchsorted(self.ids, lakeids)
+        if np.any(pos >= len(self.ids)) or np.any(self.ids[np.minimum(pos, len(self.ids) - 1)] != lakeids):
+            return np.zeros(len(dates), dtype=bool)
+        empty = np.ones(len(dates), dtype=bool)
+        for v_name in variables:
+            if v_name not in self.flags:
+                return np.zeros(len(dates), dtype=bool)
+            var_dates = self.dates[v_name]
+            idx = np.minimum(np.searchsorted(var_dates, dates), max(len(var_dates) - 1, 0))
+            known = (var_dates[idx] == dates) if len(var_dates) > 0 else np.zeros(len(dates), dtype=bool)
+            empty &= known & ~np.asarray(self.flags[v_name][idx][:, pos]).any(axis=1)
+        return empty
+
+def file_dates(paths_ncfiles):
+    """Return the dates of daily files by their filenames."""
+    days = [path.name.split('-')[-2] for path in paths_ncfiles]
+    return pd.to_datetime(days, format='%Y%m%d').values.astype('datetime64[D]')
+
+def lake_pixels(lake_index):
+    """Return the flat pixel indices of all lakecells sorted and the position of their lake in the index."""
+    pos = np.repeat(np.arange(len(lake_index.ids)), lake_index.counts)
+    order = np.argsort(lake_index.pixels)
+    return np.asarray(lake_index.pixels)[order], pos[order]
+
+def valid_lakes(var, pixels, pos, n_lakes: int, nx: int, block_rows: int):
+    """Read the rows of a daily variable which contain lakes and return boolean array of lakes with valid cells."""
+    flags = np.zeros(n_lakes, dtype=bool)
+    valid = ~np.ma.getmaskarray(gather_pixels(var, pixels, nx, block_rows))
+    flags[pos[valid]] = True
+    return flags
+
+def build_availability_index(variables: list, startdate: str, enddate: str,
+                             block_rows: int = c.INDEX_BLOCK_ROWS, verbose: bool = False):
+    """Add the days of the daterange missing in the availability index of the variables.
+
+    Parameters
+    ----------
+    variables : list
+        Variables to index
+    startdate : str
+        Startdate in the form (YYYY-MM-DD)
+    enddate : str
+        Enddate in the form (YYYY-MM-DD)
+    block_rows : int
+        Number of rows of a daily file read at once
+    verbose : bool
+        Print status updates to console
+    """
+    lake_index = load_lake_index()
+    path_index = ROOT.joinpath(c.PATH_AUXILIARY).joinpath(c.DIR_AVAILABILITY)
+    index = load_availability_index()
+
+    paths_ncfiles = load_catalog(refresh=False).select(startdate, enddate)
+    dates_ncfiles = file_dates(paths_ncfiles)
+    dates, flags, todo = {}, {}, {}
+    for v_name in dict.fromkeys([*(index.meta['variables'] if index else []), *variables]):
+        dates[v_name] = index.dates[v_name] if index and v_name in index.dates else np.array([], 'datetime64[D]')
+        flags[v_name] = np.asarray(index.flags[v_name]) if index and v_name in index.flags \
+            else np.zeros((0, len(lake_index.ids)), dtype=bool)
+        todo[v_name] = ~np.isin(dates_ncfiles, dates[v_name]) if v_name in variables \
+            else np.zeros(len(dates_ncfiles), dtype=bool)
+
+    days = np.flatnonzero(np.any(list(todo.values()), axis=0))
+    if verbose:
+        print(f'Indexing the availability of {variables} for {len(days)} days..')
+    if len(days) == 0:
+        return
+
+    pixels, pos = lake_pixels(lake_index)
+    new_flags = {v_name: [] for v_name in dates}
+    for day in days:
+        with nc4.Dataset(paths_ncfiles[day], 'r') as nc_in:
+            for v_name in dates:
+                if todo[v_name][day]:
+                    new_flags[v_name].append(valid_lakes(nc_in[v_name], pixels, pos, len(lake_index.ids),
+                                                         lake_index.shape[1], block_rows))
+
+    # Write to a temporary directory and move it in place once complete
+    path_tmp = path_index.with_name(f'{path_index.name}.tmp-{os.getpid()}')
+    shutil.rmtree(path_tmp, ignore_errors=True)
+    path_tmp.mkdir(parents=True)
+    np.save(path_tmp.joinpath('ids.npy'), np.asarray(lake_index.ids))
+    for v_name in dates:
+        if len(new_flags[v_name]) > 0:
+            var_dates = np.concatenate([dates[v_name], dates_ncfiles[days][todo[v_name][days]]])
+            var_flags = np.concatenate([flags[v_name], np.stack(new_flags[v_name])])
+            order = np.argsort(var_dates, kind='stable')
+            dates[v_name], flags[v_name] = var_dates[order], var_flags[order]
+        np.save(path_tmp.joinpath(f'{v_name}.dates.npy'), dates[v_name])
+        np.save(path_tmp.joinpath(f'{v_name}.npy'), flags[v_name])
+    with open(path_tmp.joinpath('meta.json'), 'w') as f:
+        json.dump({'lakeindex': lake_index.meta, 'variables': list(dates)}, f)
+
+    _cache.pop(path_index, None)
+    shutil.rmtree(path_index, ignore_errors=True)
+    try:
+        os.replace(path_tmp, path_index)
+    except OSError:
+        # Another process moved its index in place first
+        shutil.rmtree(path_tmp, ignore_errors=True)
+
+def load_availability_index():
+    """Return the availability index (None if not built or built for another lake index)."""
+    path_index = ROOT.joinpath(c.PATH_AUXILIARY).joinpath(c.DIR_AVAILABILITY)
+    if not path_index.joinpath('meta.json').exists():
+        return None
+    index = _cache.get(path_index)
+    if index is None:
+        index = AvailabilityIndex(path_index)
+        _cache[path_index] = index
+    if index.meta['lakeindex'] != load_lake_index().meta:
+        return None
+    return index
+
+def empty_days(lakeids: list, variables: list, dates):
+    """Return boolean array, True for the dates on which the lakes certainly have no valid data of the variables.
+
+    Parameters
+    ----------
+    lakeids : list
+        CCI lake ids (e.g. of merged lakes)
+    variables : list
+        Variables which are read
+    dates : array-like
+        Days to check
+    Returns
+    -------
+    np.ndarray
+        True for days which do not have to be read
+    """
+    lakeids = [int(lakeid) for lakeid in lakeids]
+    if table_empty(lakeids, variables):
+        return np.ones(len(dates), dtype=bool)
+    index = load_availability_index()
+    if index is None:
+        return np.zeros(len(dates), dtype=bool)
+    return index.empty_days(lakeids, variables, dates)
+
+def time_values(dates, ref_date, ref_value, time_attrs: dict):
+    """Return the time values of dates with the time of day and dtype of a reference day."""
+    units, calendar = time_attrs['units'], time_attrs.get('calendar', 'standard')
+    ref = nc4.num2date(ref_value, units, calendar, only_use_cftime_datetimes=False,
+                       only_use_python_datetimes=True)
+    offsets = pd.DatetimeIndex(dates) - pd.Timestamp(ref_date).normalize()
+    values = nc4.date2num([ref + offset.to_pytimedelta() for offset in offsets], units, calendar)
+    return np.asarray(values).astype(np.asarray(ref_value).dtype)
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+"""This module builds and loads the catalog of the local daily files.
+
+The catalog maps the date of every daily file to its path. It is saved to the cache
+folder together with the modification time of every directory of the dataset, so only
+directories which changed since (e.g. a new month) are listed again when it is loaded.
+The dates are kept sorted, selecting a daterange is a binary search.
+"""
+
+import os
+import json
+import numpy as np
+import pandas as pd
+from scripts import constants as c
+from scripts import ROOT
+
+_cache = {}
+
+class Catalog:
+    """Sorted dates and paths of the local daily files."""
+
+    def __init__(self, path_dataset, dirs: dict):
+        self.path_dataset = path_dataset
+        self.dirs = dirs
+        names = [(reldir, fn) for reldir, entry in dirs.items() for fn in entry['files']]
+        days = [fn.split('-')[-2] for _, fn in names]
+        dates = pd.to_datetime(days, format='%Y%m%d').values.astype('datetime64[D]')
+        order = np.argsort(dates, kind='stable')
+        self.dates = dates[order]
+        self.paths = np.array([path_dataset.joinpath(reldir, fn) for reldir, fn in names],
+                              dtype=object)[order]
+
+    def __len__(self):
+        return len(self.dates)
+
+    def select(self, startdate: str, enddate: str):
+        """Return the paths of the daily files within the daterange sorted by date."""
+        start = np.searchsorted(self.dates, pd.Timestamp(startdate).to_datetime64().astype('datetime64[D]'))
+        stop = np.searchsorted(self.dates, pd.Timestamp(enddate).to_datetime64().astype('datetime64[D]'),
+                               side='right')
+        return self.paths[start:stop]
+
+    def missing(self, startdate: str, enddate: str):
+        """Return the days of the daterange without a daily file."""
+        expected = pd.date_range(startdate, enddate).values.astype('datetime64[D]')
+        return pd.DatetimeIndex(expected[~np.isin(expected, self.dates)])
+
+def scan_dir(path_dataset, reldir: str, dirs: dict, previous: dict):
+    """List a directory of the dataset (recursively), reusing the entries of unchanged directories."""
+    path_dir = path_dataset.joinpath(reldir)
+    mtime_ns = os.stat(path_dir).st_mtime_ns
+    entry = previous.get(reldir)
+    if entry is None or entry['mtime_ns'] != mtime_ns:
+        files, subdirs = [], []
+        with os.scandir(path_dir) as it:
+            for dir_entry in it:
+                if dir_entry.is_dir():
+                    subdirs.append(dir_entry.name)
+                elif dir_entry.name.endswith(f'-fv{c.VERSION}.nc'):
+                    files.append(dir_entry.name)
+        entry = {'mtime_ns': mtime_ns, 'files': sorted(files), 'subdirs': sorted(subdirs)}
+    dirs[reldir] = entry
+    for subdir in entry['subdirs']:
+        scan_dir(path_dataset, os.path.join(reldir, subdir), dirs, previous)
+
+def load_catalog(refresh: bool = True):
+    """Return the catalog of the local dataset, updated for directories which changed.
+
+    Parameters
+    ----------
+    refresh : bool
+        Check the directories for changes, otherwise the catalog already loaded by the
+        process (e.g. inherited from the main process) is returned as is
+    Returns
+    -------
+    Catalog
+        Dates and paths of the local daily files
+    """
+    path_dataset = ROOT.joinpath(c.PATH_RAW).joinpath(f'v{c.VERSION}')
+    if not refresh and path_dataset in _cache:
+        return _cache[path_dataset]
+
+    path_catalog = ROOT.joinpath(c.PATH_CATALOG).joinpath(c.FN_CATALOG)
+    previous = {}
+    if path_catalog.exists():
+        try:
+            with open(path_catalog) as f:
+                saved = json.load(f)
+            if saved['dataset'] == str(path_dataset):
+                previous = saved['dirs']
+        except (ValueError, KeyError):
+            previous = {}
+
+    dirs = {}
+    if path_dataset.is_dir():
+        scan_dir(path_dataset, '', dirs, previous)
+
+    if dirs != previous:
+        # Write to a temporary file and move it in place once complete
+        path_catalog.parent.mkdir(parents=True, exist_ok=True)
+        path_tmp = path_catalog.with_name(f'{path_catalog.name}.tmp-{os.getpid()}')
+        with open(path_tmp, 'w') as f:
+            json.dump({'dataset': str(path_dataset), 'dirs': dirs}, f)
+        os.replace(path_tmp, path_catalog)
+
+    catalog = _cache.get(path_dataset)
+    if catalog is None or catalog.dirs != dirs:
+        catalog = Catalog(path_dataset, dirs)
+        _cache[path_dataset] = catalog
+    return catalog
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+
+"""This module is the command-line entry point of the extraction.
+
+The lakes, variables, daterange, processes, backend and dataset version are arguments instead
+of settings in main.py, e.g.:
+
+    python -m scripts.cli --lakeids 2 6 --startdate 2010-01-01 --enddate 2010-12-31 --processes 4
+    python -m scripts.cli --lakenames Michigan --backend zarr --version 2.0.1
+    python -m scripts.cli --all --mode stream --memory-mb 16000 --processes 16
+
+Only the argument parser is imported at startup, the extraction modules (numpy, pandas,
+netCDF4) are imported once the arguments are valid. The process pool of a run is started
+once, after the lake table, lake index and catalog are loaded, so the workers are forked
+with them and all lakes, shards and batches of the run share the same workers. The workers
+set the dataset version in their initializer, so it also holds for spawned workers.
+"""
+
+import argparse
+from scripts import constants as c
+
+MODES = ['lake', 'day-major', 'stream']
+
+def worker_pool(settings: dict, n_processes: int):
+    """Start the process pool of a run.
+
+    The workers set the dataset version of the settings (spawned workers do not inherit it),
+    the workers of the streaming extraction also lower their chunk cache.
+    """
+    from multiprocessing import Pool
+    version = settings.get('version', c.VERSION)
+    if settings.get('stream', False) and not settings['use_opendap']:
+        from scripts.streaming import init_worker
+        return Pool(processes=n_processes, initializer=init_worker, initargs=(c.STREAM_CHUNK_CACHE, version),
+                    maxtasksperchild=c.STREAM_TASKS_PER_CHILD)
+    return Pool(processes=n_processes, initializer=c.set_version, initargs=(version,))
+
+def run_extraction(lakeids: list, settings: dict, n_processes: int):
+    """Extract the lakes with the settings of main.py on a process pool started once for the run.
+
+    Parameters
+    ----------
+    lakeids : list
+        CCI lake ids to extract
+    settings : dict
+        Extraction settings as in main.py
+    n_processes : int
+        Number of processes
+    Returns
+    -------
+    list
+        Results of the extraction mode (filenames or tuples with filenames, see run_scheduled,
+        run_streaming and run_sharded), None for failed lakes
+    """
+    from time import time
+    from scripts.lookup import find_lakenames
+    from scripts.engine import data_extraction_daymajor
+    from scripts.lakeindex import load_lake_index
+    from scripts.catalog import load_catalog
+    from scripts.availability import build_availability_index
+    from scripts.lakestats import STATISTICS_VARS
+    from scripts.scheduler import lake_costs, balance_groups, run_scheduled
+    from scripts.sharding import large_lakes, run_sharded
+    from scripts.streaming import run_streaming
+    from scripts.metrics import new_run_id, summarize_run
+
+    # The versioned file names are set before any of them is loaded
+    c.set_version(settings.get('version', c.VERSION))
+
+    # Tag the metrics records of this run, the summary is appended once all lakes are done
+    time_start = time()
+    if settings['metrics']:
+        settings['run_id'] = new_run_id()
+
+    if settings['use_opendap']:
+        print(f'Start extracting {len(lakeids)} lakes using oPeNDAP (slow)..')
+    else:
+        print(f'Start extracting {len(lakeids)} lakes from local dataset..')
+
+    # Resolve all lakenames at once (fails for unknown lakes before any extraction starts),
+    # the workers inherit the loaded lake table
+    find_lakenames(lakeids)
+
+    # Build the lake index once (if missing or outdated), the workers memory-map it
+    load_lake_index()
+
+    # Update the catalog of the local files once, the workers inherit it
+    if not settings['use_opendap']:
+        catalog = load_catalog()
+        missing = catalog.missing(settings['startdate'], settings['enddate'])
+        if len(missing) > 0:
+            print(f'{len(missing)} days without local file between {settings["startdate"]} and '
+                  f'{settings["enddate"]} (first: {missing[0]:%Y-%m-%d}, last: {missing[-1]:%Y-%m-%d}).')
+
+        # Index the days with valid data per lake once (only new days are added), the workers memory-map it
+        if settings['skip_empty']:
+            variables = settings['variables']
+            if settings['statistics']:
+                variables = list(dict.fromkeys([*variables, *STATISTICS_VARS]))
+            build_availability_index(variables, settings['startdate'], settings['enddate'],
+                                     verbose=settings['verbose'])
+
+    outputs = []
+    with worker_pool(settings, n_processes) as pool:
+
+        # Extract large lakes one after the other, each split into time shards on all processes
+        if settings['shard']:
+            sharded = large_lakes(lakeids, settings['shard_min_cells'])
+            lakeids = [lakeid for lakeid in lakeids if lakeid not in sharded]
+            outputs += run_sharded(sharded, settings, n_processes, pool=pool)
+
+        if settings['stream'] and not settings['use_opendap']:
+            # Pack lakes into batches within the memory budget, each extracted day-major
+            outputs += run_streaming(lakeids, settings, n_processes, settings['memory_mb'],
+                                     settings['max_open_outputs'], pool=pool)
+        elif settings['day_major'] and not settings['use_opendap']:
+            # Split lakes into groups of similar cost, each process walks the daily files once
+            costs = lake_costs(lakeids, settings['startdate'], settings['enddate'])
+            groups = balance_groups(lakeids, costs, n_processes)
+            outputs += pool.map(data_extraction_daymajor, map(lambda ids: (ids, settings), groups))
+        else:
+            # Dispatch largest lakes first and stream progress as lakes finish
+            outputs += run_scheduled(lakeids, settings, n_processes, pool=pool)
+
+    if settings['metrics']:
+        summary = summarize_run(settings['run_id'], time_start, processes=n_processes)
+        print(f'Recorded metrics of {summary["lakes"]} lakes ({summary["failed"]} failed) in '
+              f'{summary["elapsed"]:0.1f}s, seconds per stage: {summary["stages"]}')
+
+    return outputs
+
+def parse_args(argv: list = None):
+    parser = argparse.ArgumentParser(description='Extract lakes from the ESA CCI Lakes dataset.')
+    lakes = parser.add_mutually_exclusive_group(required=True)
+    lakes.add_argument('--lakeids', nargs='+', type=int, help='CCI lake ids')
+    lakes.add_argument('--lakenames', nargs='+', help='Lakenames (case-insensitive)')
+    lakes.add_argument('--lakeids-file', help='File with whitespace-separated CCI lake ids')
+    lakes.add_argument('--all', action='store_true', help='All lakes of the lake table')
+    parser.add_argument('--variables', nargs='+', default=c.DEFAULT_VARS, help='Variables to extract')
+    parser.add_argument('--startdate', default=c.DEFAULT_START, help='Startdate (YYYY-MM-DD)')
+    parser.add_argument('--enddate', default=c.DEFAULT_END, help='Enddate (YYYY-MM-DD)')
+    parser.add_argument('--processes', type=int, default=4, help='Number of processes')
+    parser.add_argument('--backend', choices=c.BACKENDS, default='netcdf', help='Output format')
+    parser.add_argument('--version', default=c.VERSION, help='Version of the CCI Lakes dataset')
+    parser.add_argument('--layout', choices=c.LAYOUTS, default='grid', help='Full bbox or lakecells only')
+    parser.add_argument('--mode', choices=MODES, default='lake',
+                        help='Per-lake, day-major or memory-bounded streaming extraction (local only)')
+    parser.add_argument('--opendap', action='store_true', help='Download data using oPeNDAP')
+    parser.add_argument('--opendap-workers', type=int, default=c.OPENDAP_WORKERS,
+                        help='Concurrent oPeNDAP requests per lake')
+    parser.add_argument('--no-opendap-cache', action='store_true', help='Do not reuse oPeNDAP downloads')
+    parser.add_argument('--complevel', type=int, default=4, help='Compression level (0 to disable)')
+    parser.add_argument('--block-days', type=int, default=c.BLOCK_DAYS, help='Days buffered and written at once')
+    parser.add_argument('--incremental', action='store_true', help='Resume runs or append new days')
+    parser.add_argument('--statistics', choices=c.STATISTICS_FORMATS, default=None,
+                        help='Also write daily lake-wide statistics')
+    parser.add_argument('--min-quality', type=int, default=None, help='Min. quality level of the statistics')
+    parser.add_argument('--no-cube', action='store_true', help='Only write the statistics')
+    parser.add_argument('--skip-empty', action='store_true', help='Skip days without valid data')
+    parser.add_argument('--use-consolidated', action='store_true', help='Read from the consolidated archive')
+    parser.add_argument('--shard', choices=['year', 'month'], default=None, help='Extract large lakes in shards')
+    parser.add_argument('--shard-min-cells', type=int, default=c.SHARD_MIN_CELLS,
+                        help='Min. bbox grid cells of a lake to extract it in shards')
+    parser.add_argument('--memory-mb', type=int, default=c.STREAM_MEMORY_MB,
+                        help='Memory budget of all processes of the streaming extraction (MB)')
+    parser.add_argument('--max-open-outputs', type=int, default=c.STREAM_MAX_OPEN,
+                        help='Max. outputs open at once per process of the streaming extraction')
+    parser.add_argument('--metrics', action='store_true', help='Record time per stage, bytes and peak memory')
+    parser.add_argument('--verbose', action='store_true', help='Print additional status updates')
+    return parser.parse_args(argv)
+
+def main(argv: list = None):
+    args = parse_args(argv)
+
+    # The versioned file names are set before any of them is loaded, the workers set it again
+    c.set_version(args.version)
+
+    settings = {'version': args.version,
+                'variables': args.variables,
+                'use_opendap': args.opendap,
+                'opendap_workers': args.opendap_workers,
+                'opendap_cache': not args.no_opendap_cache,
+                'startdate': args.startdate,
+                'enddate': args.enddate,
+                'compress': args.complevel > 0,
+                'complevel': max(args.complevel, 1),
+                'incremental': args.incremental,
+                'block_days': args.block_days,
+                'layout': args.layout,
+                'backend': args.backend,
+                'statistics': args.statistics,
+                'min_quality': args.min_quality,
+                'write_cube': not args.no_cube,
+                'skip_empty': args.skip_empty,
+                'use_consolidated': args.use_consolidated,
+                'verbose': args.verbose,
+                'metrics': args.metrics,
+                'day_major': args.mode == 'day-major',
+                'shard': args.shard,
+                'shard_min_cells': args.shard_min_cells,
+                'stream': args.mode == 'stream',
+                'memory_mb': args.memory_mb,
+                'max_open_outputs': args.max_open_outputs,
+                }
+
+    from scripts.lookup import load_lake_table, find_lakeids
+    if args.lakenames:
+        lakeids = find_lakeids(args.lakenames)
+    elif args.lakeids_file:
+        with open(args.lakeids_file) as f:
+            lakeids = [int(lakeid) for lakeid in f.read().split()]
+    elif args.all:
+        lakeids = [int(lakeid) for lakeid in load_lake_table().id]
+    else:
+        lakeids = args.lakeids
+
+    run_extraction(lakeids, settings, args.processes)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+
+"""This module consolidates the local daily files into a time-contiguous store of the lakecells.
+
+The daily files are chunked per day, so every extraction decompresses the day-planes of all
+days again. The consolidated archive is a Zarr store (see zarrstore) with one (time, pixel)
+array per variable which holds the raw values of all lakecells of the static lake mask. The
+pixels are ordered like the lake index (grouped by lake), so a lake is a contiguous pixel range
+and its time series is read from a few chunks. The store is built once in parallel (every task
+writes whole time chunks of a variable) and extended with the days after its last day when
+consolidated again:
+
+    python -m scripts.consolidate --startdate 1992-09-26 --enddate 2020-12-31 --processes 4
+
+The extraction reads from the archive (setting use_consolidated) if it holds all days of the
+daterange and the variables, otherwise from the daily files.
+"""
+
+import argparse
+from multiprocessing import Pool
+import numpy as np
+import netCDF4 as nc4
+from scripts import constants as c
+from scripts import ROOT
+from scripts.lakeindex import load_lake_index, gather_pixels
+from scripts.catalog import load_catalog
+from scripts.availability import file_dates
+from scripts.zarrstore import ZarrStore, read_json, replace_output
+
+EPOCH = np.datetime64('1970-01-01', 'D')
+COORDS = ['time', 'date']
+
+_cache = {}
+
+class ConsolidatedArchive:
+    """Read access to the consolidated archive of the lakecells."""
+
+    def __init__(self, path_store):
+        self.store = ZarrStore(path_store, 'r')
+        self.store.set_auto_maskandscale(False)
+        self.days = int(self.store.days)
+        self.dates = EPOCH + self.store['date'][:self.days].astype('timedelta64[D]')
+        self.variables = [v_name for v_name in self.store.variables if v_name not in COORDS]
+        self.chunk_days = self.store['time'].chunks[0]
+
+    def span(self, variables: list, dates):
+        """Return the time range (t0, t1) of the dates if the archive holds all of them and the variables, else None."""
+        if len(dates) == 0 or not set(variables) <= set(self.variables):
+            return None
+        t0 = int(np.searchsorted(self.dates, dates[0]))
+        t1 = t0 + len(dates)
+        if t1 > self.days or not np.array_equal(self.dates[t0:t1], dates):
+            return None
+        return t0, t1
+
+    def days_of(self, lakeids: list, bbox: tuple, variables: list, t0: int, t1: int):
+        """Yield the packed fields cropped to the bbox and the time value of each day from t0 to t1.
+
+        Only the lakecells of the lakeids are read, the other cells of the bbox are fill.
+        """
+        lake_index = load_lake_index()
+        pos = np.searchsorted(lake_index.ids, lakeids)
+        ranges = [(int(lake_index.offsets[k]), int(lake_index.offsets[k] + lake_index.counts[k])) for k in pos]
+        pixels = np.concatenate([lake_index.pixels[start:stop] for start, stop in ranges])
+        rows, cols = np.divmod(pixels, lake_index.shape[1])
+        i0, i1, j0, j1 = bbox
+        inside = (rows < i1) & (cols < j1)
+        rows, cols = rows[inside] - i0, cols[inside] - j0
+
+        times = self.store['time'][t0:t1]
+        for b0, b1 in chunk_bounds(t0, t1, self.chunk_days):
+            blocks = {}
+            for v_name in variables:
+                var = self.store[v_name]
+                values = np.concatenate([var[b0:b1, start:stop] for start, stop in ranges], axis=1)
+                blocks[v_name] = np.full((b1 - b0, i1 - i0, j1 - j0), var.fill_value, dtype=var.dtype)
+                blocks[v_name][:, rows, cols] = values[:, inside]
+            for k in range(b1 - b0):
+                yield {v_name: blocks[v_name][k] for v_name in variables}, times[b0 - t0 + k]
+
+def chunk_bounds(start: int, stop: int, chunk: int):
+    """Split the range from start to stop at multiples of chunk and return list of (start, stop)."""
+    bounds = [start, *range((start // chunk + 1) * chunk, stop, chunk), stop]
+    return [(lo, hi) for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo]
+
+def archive_path():
+    return ROOT.joinpath(c.PATH_CONSOLIDATED).joinpath(c.DIR_CONSOLIDATED)
+
+def load_consolidated():
+    """Return the consolidated archive (None if not built or built for another lake index)."""
+    path_store = archive_path()
+    if not path_store.joinpath('.zgroup').exists():
+        return None
+    archive = _cache.get(path_store)
+    if archive is None or archive.days != read_json(path_store.joinpath('.zattrs'))['days']:
+        archive = ConsolidatedArchive(path_store)
+        _cache[path_store] = archive
+    if archive.store.lakeindex != load_lake_index().meta:
+        return None
+    return archive
+
+def sorted_pixels():
+    """Return the flat pixel indices of all lakecells sorted and the order which sorts the lake index pixels."""
+    lake_index = load_lake_index()
+    if _cache.get('pixels', (None,))[0] is not lake_index:
+        order = np.argsort(lake_index.pixels)
+        _cache['pixels'] = (lake_index, np.asarray(lake_index.pixels)[order], order)
+    return _cache['pixels'][1:]
+
+def consolidate_block(task):
+    """Read a variable of consecutive daily files and write its block of days into the archive.
+
+    Takes tuple in the form (path of the store, variable, time index, paths of the daily files,
+    write the time axis) and returns the number of days written.
+    """
+    path_store, v_name, t0, paths_ncfiles, with_time = task
+    pixels, order = sorted_pixels()
+    nx = load_lake_index().shape[1]
+    with ZarrStore(path_store, 'r+') as store:
+        var = store[v_name]
+        var.set_auto_maskandscale(False)
+        block = np.empty((len(paths_ncfiles), len(pixels)), dtype=var.dtype)
+        times = []
+        for k, path in enumerate(paths_ncfiles):
+            with nc4.Dataset(path, 'r') as nc_in:
+                var_in = nc_in[v_name]
+                var_in.set_auto_maskandscale(False)
+                block[k, order] = gather_pixels(var_in, pixels, nx)
+                if with_time:
+                    nc_in['time'].set_auto_maskandscale(False)
+                    times.append(nc_in['time'][0])
+        var[t0:t0 + len(paths_ncfiles), :] = block
+        if with_time:
+            store['time'].set_auto_maskandscale(False)
+            store['time'][t0:t0 + len(paths_ncfiles)] = np.asarray(times)
+            days = (file_dates(paths_ncfiles) - EPOCH).astype(np.int32)
+            store['date'][t0:t0 + len(paths_ncfiles)] = days
+    return len(paths_ncfiles)
+
+def create_archive(path_store, nc_in, variables: list, n_pixels: int, chunk_days: int, complevel: int):
+    """Create the empty archive with the variable attributes of a daily file."""
+    lake_index = load_lake_index()
+    with ZarrStore(path_store, 'w') as store:
+        store.createDimension('time', None)
+        store.createDimension('pixel', n_pixels)
+        for v_name in ['time', *variables]:
+            var_in = nc_in[v_name]
+            attrs = {k: var_in.getncattr(k) for k in var_in.ncattrs()}
+            dims, chunks = (('time',), (chunk_days,)) if v_name == 'time' \
+                else (('time', 'pixel'), (chunk_days, min(max(n_pixels, 1), c.CHUNK_PIXELS)))
+            var = store.createVariable(v_name, var_in.dtype, dims, zlib=complevel > 0,
+                                       complevel=max(complevel, 1), chunksizes=chunks,
+                                       fill_value=attrs.pop('_FillValue', None))
+            var.setncatts(attrs)
+        var = store.createVariable('date', np.int32, ('time',), chunksizes=(chunk_days,), fill_value=-1)
+        var.units = f'days since {EPOCH}'
+        store.setncatts({'lakeindex': lake_index.meta, 'days': 0})
+
+def consolidate(variables: list = None, startdate: str = c.DEFAULT_START, enddate: str = c.DEFAULT_END,
+                chunk_days: int = c.CONSOLIDATE_DAYS, complevel: int = 4, n_processes: int = 1,
+                verbose: bool = False):
+    """Consolidate the local daily files of the daterange into the archive of the lakecells.
+
+    The days after the last day of an existing archive (of the same lake index, holding the
+    variables) are appended, otherwise the archive is rebuilt.
+
+    Parameters
+    ----------
+    variables : list
+        Variables to consolidate (all variables of the daily files if None)
+    startdate : str
+        Startdate in the form (YYYY-MM-DD)
+    enddate : str
+        Enddate in the form (YYYY-MM-DD)
+    chunk_days : int
+        Days per chunk of the archive (memory of a task is chunk_days times lakecells per variable)
+    complevel : int
+        Compression level of the archive (0 to disable)
+    n_processes : int
+        Number of processes
+    verbose : bool
+        Print status updates to console
+    Returns
+    -------
+    int
+        Number of days in the archive
+    """
+    lake_index = load_lake_index()
+    paths_ncfiles = load_catalog().select(startdate, enddate)
+    if len(paths_ncfiles) == 0:
+        raise ValueError('No .nc files found for specified timerange!')
+    dates = file_dates(paths_ncfiles)
+
+    with nc4.Dataset(paths_ncfiles[0], 'r') as nc_in:
+        if variables is None:
+            variables = [v_name for v_name in nc_in.variables
+                         if nc_in[v_name].dimensions == ('time', 'lat', 'lon')]
+
+        archive = load_consolidated()
+        path_store = archive_path()
+        if archive is not None and set(variables) <= set(archive.variables) and archive.days > 0 \
+                and archive.dates[0] <= dates[0]:
+            # Continue the archive with the days after its last day
+            variables, chunk_days = archive.variables, archive.chunk_days
+            t_start, path_build = archive.days, path_store
+            new = dates > archive.dates[-1]
+            paths_ncfiles, dates = paths_ncfiles[new], dates[new]
+        else:
+            t_start, path_build = 0, path_store.with_name(path_store.name + '.part')
+            path_build.parent.mkdir(parents=True, exist_ok=True)
+            create_archive(path_build, nc_in, variables, len(lake_index.pixels), chunk_days, complevel)
+
+    # Split the days at the time chunks of the archive, so every task writes whole chunks
+    tasks = [(path_build, v_name, t0, paths_ncfiles[t0 - t_start:t1 - t_start], k == 0)
+             for t0, t1 in chunk_bounds(t_start, t_start + len(dates), chunk_days)
+             for k, v_name in enumerate(variables)]
+
+    if verbose:
+        print(f'Consolidating {len(variables)} variables of {len(dates)} days in {len(tasks)} tasks..')
+
+    if len(tasks) > 0:
+        if n_processes > 1:
+            with Pool(processes=n_processes, initializer=c.set_version, initargs=(c.VERSION,)) as p:
+                for k, _ in enumerate(p.imap_unordered(consolidate_block, tasks), start=1):
+                    if verbose:
+                        print(f'{k}/{len(tasks)} tasks done.')
+        else:
+            for task in tasks:
+                consolidate_block(task)
+
+    # The days are only visible once all of them are written
+    n_days = t_start + len(dates)
+    with ZarrStore(path_build, 'r+') as store:
+        store.days = n_days
+    if path_build != path_store:
+        replace_output(path_build, path_store)
+    _cache.pop(path_store, None)
+    return n_days
+
+def main():
+    parser = argparse.ArgumentParser(description='Consolidate the local daily files into an archive of the lakecells.')
+    parser.add_argument('--variables', nargs='+', default=None, help='Variables (default: all)')
+    parser.add_argument('--startdate', default=c.DEFAULT_START, help='Startdate (YYYY-MM-DD)')
+    parser.add_argument('--enddate', default=c.DEFAULT_END, help='Enddate (YYYY-MM-DD)')
+    parser.add_argument('--chunk-days', type=int, default=c.CONSOLIDATE_DAYS, help='Days per chunk')
+    parser.add_argument('--complevel', type=int, default=4, help='Compression level (0 to disable)')
+    parser.add_argument('--processes', type=int, default=4, help='Number of processes')
+    parser.add_argument('--version', default=c.VERSION, help='Version of the CCI Lakes dataset')
+    args = parser.parse_args()
+
+    # The versioned file names are set before any of them is loaded, the workers set it again
+    c.set_version(args.version)
+    n_days = consolidate(args.variables, args.startdate, args.enddate, args.chunk_days, args.complevel,
+                         args.processes, verbose=True)
+    print(f'The consolidated archive holds {n_days} days.')
+
+if __name__ == '__main__':
+    main()
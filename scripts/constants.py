@@ -9,19 +9,70 @@ DEFAULT_VARS = ['lake_surface_water_temperature',
 LSWT_FLAGS = {0: 'unprocessed', 1: 'bad', 2: 'suspect/marginal',
               3: 'intermediate', 4: 'good', 5: 'best'}
 
+LIC_FLAGS = {1: 'open water', 2: 'ice', 3: 'cloud'} # Used if the daily files have no flag attributes
+
+LAYOUTS = ['grid', 'pixels']
+BACKENDS = ['netcdf', 'zarr']
+STATISTICS_FORMATS = ['csv', 'nc']
+
 DEFAULT_START = '1992-09-26'
 DEFAULT_END = '2020-12-31'
 
 VERSION = '2.0.1'
 
+MAX_BAND_CELLS = 25_000_000 # Max. grid cells read at once by the day-major extraction
+BLOCK_DAYS = 32             # Days buffered and written at once (time chunk size of the outputs)
+CHUNK_LATLON = 64           # Lat/lon chunk size of the outputs
+CHUNK_PIXELS = 4096         # Pixel chunk size of the outputs in the pixel layout
+CHECKPOINT_DAYS = 30        # Days after which a partial output is flushed to disk
+INDEX_BLOCK_ROWS = 1000     # Rows of the lakemask read at once when building the lake index
+CONSOLIDATE_DAYS = 64       # Time chunk size of the consolidated archive
+
+COST_DAY_CELLS = 10_000     # Overhead of opening a daily file in grid cells (cost estimate of the scheduler)
+GRID_RESOLUTION = 1 / 120   # Resolution of the CCI Lakes grid in degrees
+SHARD_MIN_CELLS = 1_000_000 # Min. bbox grid cells of a lake to extract it in time shards
+STREAM_MEMORY_MB = 16_000   # Memory budget of all processes of the streaming extraction (MB)
+STREAM_BASE_MB = 300        # Memory of a worker before extracting (interpreter, modules, lake index)
+STREAM_MAX_OPEN = 256       # Max. outputs open at once per process of the streaming extraction
+STREAM_CHUNK_CACHE = 4 * 1024**2 # Chunk cache per variable of the outputs opened by the streaming workers (bytes)
+STREAM_TASKS_PER_CHILD = 10 # Batches after which a streaming worker is replaced (returns its memory)
+
+OPENDAP_WORKERS = 4         # Concurrent OPeNDAP requests per extraction
+OPENDAP_RETRIES = 5         # Retries of a failed OPeNDAP request
+OPENDAP_BACKOFF = 1.0       # Initial backoff (seconds) between retries, doubled each retry
+OPENDAP_TIMEOUT = 120       # Timeout (seconds) of an OPeNDAP request
+OPENDAP_REDIRECTS = 5       # Redirects followed per OPeNDAP request
+CACHE_MAX_BYTES = 10 * 1024**3 # Size cap of the OPeNDAP cache (bytes)
+
 PATH_RAW = 'data/raw'
 PATH_EXTRACTED = 'data/extracted'
 PATH_INTERP = 'data/interpolated'
 PATH_AUXILIARY = 'data/auxiliary'
 PATH_OUTPUT = 'data/output'
 PATH_DINEOF = 'data/output/DINEOF'
+PATH_CACHE = 'data/cache/opendap'
+PATH_CATALOG = 'data/cache'
+PATH_CONSOLIDATED = 'data/consolidated'
 PATH_ABBREV = PATH_AUXILIARY+'/abbreviations.json'
 
-FN_MASK = f'ESA_CCI_static_lake_mask_v{VERSION}.nc'
-FN_TABLE = f'lakescci_v{VERSION}_data-availability.csv'
-URL_TABLE = f'https://climate.esa.int/documents/1637/lakescci_v{VERSION}_data-availability.csv'
\ No newline at end of file
+FN_LOG = 'log.txt'
+FN_METRICS = 'metrics.jsonl'
+URL_OPENDAP = 'https://data.cci.ceda.ac.uk/thredds/dodsC/esacci/lakes/data/lake_products/L3S'
+
+def set_version(version: str):
+    """Set the version of the CCI Lakes dataset and the names of its versioned files.
+
+    Call before anything is loaded (the caches are keyed by path). Process pools have to call it
+    in their initializer, workers which are spawned instead of forked start with the default version.
+    """
+    global VERSION, FN_MASK, DIR_INDEX, DIR_AVAILABILITY, DIR_CONSOLIDATED, FN_CATALOG, FN_TABLE, URL_TABLE
+    VERSION = version
+    FN_MASK = f'ESA_CCI_static_lake_mask_v{VERSION}.nc'
+    DIR_INDEX = f'lakeindex_v{VERSION}'
+    DIR_AVAILABILITY = f'availability_v{VERSION}'
+    DIR_CONSOLIDATED = f'lakecells_v{VERSION}.zarr'
+    FN_CATALOG = f'catalog_v{VERSION}.json'
+    FN_TABLE = f'lakescci_v{VERSION}_data-availability.csv'
+    URL_TABLE = f'https://climate.esa.int/documents/1637/lakescci_v{VERSION}_data-availability.csv'
+
+set_version(VERSION)
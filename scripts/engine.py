@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+
+"""This module implements the day-major extraction of multiple lakes.
+
+Instead of extracting one lake after the other (each opening every daily file),
+the daily files are walked once. Each requested variable is read once per latitude
+band of lakes and all lake windows of the band are sliced out of the in-memory field.
+"""
+
+from contextlib import ExitStack
+from time import time
+import numpy as np
+import netCDF4 as nc4
+from scripts import constants as c
+from scripts import ROOT
+from scripts.lakeindex import load_lake_index
+from scripts.lakestats import LakeStatistics, STATISTICS_VARS
+from scripts.availability import empty_days, file_dates, time_values
+from scripts.zarrstore import open_output, remove_output, replace_output
+from scripts.metrics import Metrics, NULL_METRICS, output_bytes
+from scripts.functions import (valid_variables, find_lakenames, find_ncfiles, output_filename,
+                               statistics_filename, partial_output, create_output, BlockWriter, log)
+
+def group_bands(windows: dict, max_band_cells: int = c.MAX_BAND_CELLS):
+    """Group lake windows into bands whose union bbox does not exceed max_band_cells.
+
+    Parameters
+    ----------
+    windows : dict
+        Lake windows by lakeid
+    max_band_cells : int
+        Maximum number of grid cells of a band read at once
+    Returns
+    -------
+    list
+        List of tuples (bbox, lakeids) with the union bbox (i0, i1, j0, j1) of each band
+    """
+    bands = []
+    for lakeid in sorted(windows, key=lambda k: windows[k].bbox):
+        i0, i1, j0, j1 = windows[lakeid].bbox
+        if bands:
+            (b_i0, b_i1, b_j0, b_j1), b_lakeids = bands[-1]
+            union = (min(b_i0, i0), max(b_i1, i1), min(b_j0, j0), max(b_j1, j1))
+            if (union[1] - union[0]) * (union[3] - union[2]) <= max_band_cells:
+                bands[-1] = (union, b_lakeids + [lakeid])
+                continue
+        bands.append(((i0, i1, j0, j1), [lakeid]))
+    return bands
+
+def extract_lakes_daymajor(lakeids: list, variables: list = c.DEFAULT_VARS,
+                           startdate: str = c.DEFAULT_START, enddate: str = c.DEFAULT_END,
+                           compress: bool = True, complevel: int = 4, verbose: bool = False,
+                           temp: bool = False, max_band_cells: int = c.MAX_BAND_CELLS,
+                           block_days: int = c.BLOCK_DAYS, layout: str = 'grid',
+                           statistics: str = None, min_quality: int = None, write_cube: bool = True,
+                           skip_empty: bool = False, backend: str = 'netcdf', incremental: bool = False,
+                           metrics: Metrics = None):
+    """Extract several lakes from the local dataset opening each daily file only once.
+
+    The output per lake is identical to the output of extract_lake_subset.
+
+    Parameters
+    ----------
+    lakeids : list
+        CCI lake ids of the lakes to extract
+    variables : list
+        Variables to extract
+    startdate : str
+        Startdate of the timeseries to extract in the form (YYYY-MM-DD)
+    enddate : str
+        Enddate of the timeseries to extract in the form (YYYY-MM-DD)
+    compress : bool
+        Apply z-lib compression
+    complevel : int
+        Compression level to use
+    verbose : bool
+        Print status updates to console
+    temp : bool
+        Put inside temporary folder
+    max_band_cells : int
+        Maximum number of grid cells read at once for a band of neighbouring lakes
+    block_days : int
+        Number of days buffered and written at once per lake
+    layout : str
+        Store the full bbox as (time, lat, lon) ('grid') or only the lakecells as (time, pixel) ('pixels')
+    statistics : str
+        Also write a table of daily lake-wide statistics per lake as 'csv' or 'nc' (None to disable)
+    min_quality : int
+        Minimum lswt_quality_level of the lakecells used for the temperature statistics
+    write_cube : bool
+        Write the extracted subsets, set to False to only write the statistics tables
+    skip_empty : bool
+        Do not read the bands (or daily files) on days on which their lakes certainly have no
+        valid data (see availability), the lakes get fill for these days
+    backend : str
+        Write the subsets as NETCDF4 files ('netcdf') or as Zarr stores ('zarr')
+    incremental : bool
+        Resume the interrupted partial outputs and extend existing outputs with earlier enddates
+    metrics : Metrics
+        Record the time per stage and counters of the group of lakes (see metrics), nothing is recorded if None
+    Returns
+    -------
+    list
+        Filenames of the extracted subsets (of the statistics tables if write_cube is False)
+    """
+    if not valid_variables(variables):
+        raise ValueError('The passed variable-list is invalid!')
+
+    if layout not in c.LAYOUTS:
+        raise ValueError(f'Unknown output layout {layout}!')
+
+    if backend not in c.BACKENDS:
+        raise ValueError(f'Unknown output backend {backend}!')
+
+    if statistics is not None and statistics not in c.STATISTICS_FORMATS:
+        raise ValueError(f'Unknown statistics format {statistics}!')
+
+    if not write_cube and statistics is None:
+        raise ValueError('Nothing to write, either write_cube or statistics has to be set!')
+
+    if statistics is not None and incremental:
+        raise ValueError('Statistics are computed over the whole timerange and cannot be '
+                         'combined with incremental extraction!')
+
+    read_vars = list(dict.fromkeys([*variables, *STATISTICS_VARS])) if statistics else variables
+
+    lakeids = list(dict.fromkeys(int(lakeid) for lakeid in lakeids))
+    lakenames = dict(zip(lakeids, find_lakenames(lakeids)))
+
+    if verbose:
+        print(f'Extracting {variables} for {len(lakeids)} lakes from '
+              f'{startdate} to {enddate} from local dataset (day-major)..')
+
+    time_start = time()
+    metrics = NULL_METRICS if metrics is None else metrics
+
+    with metrics.stage('discovery'):
+        paths_ncfiles = find_ncfiles(startdate, enddate)
+    if len(paths_ncfiles) == 0:
+        raise ValueError('No .nc files found for specified timerange!')
+
+    fns_output = {lakeid: output_filename(lakeid, lakenames[lakeid], variables, startdate, enddate,
+                                          layout, backend)
+                  for lakeid in lakeids}
+    path_extracted = ROOT.joinpath(c.PATH_EXTRACTED)
+    if temp:
+        path_extracted = path_extracted.joinpath('temp')
+    path_extracted.mkdir(parents=True, exist_ok=True)
+
+    with metrics.stage('mask'):
+        lake_index = load_lake_index()
+        windows = {lakeid: lake_index.window([lakeid]) for lakeid in lakeids}
+
+    # Every lake is written into a partial output which is moved in place once complete. In
+    # incremental mode a lake continues its interrupted partial output or latest existing output
+    # at the first daily file after its last written day (lakes without new days are done).
+    dates = file_dates(paths_ncfiles)
+    parts, starts = {}, {}
+    for lakeid in lakeids:
+        parts[lakeid] = partial_output(path_extracted.joinpath(fns_output[lakeid]), windows[lakeid], lakeid,
+                                       lakenames[lakeid], variables, startdate, enddate, layout, backend,
+                                       incremental and write_cube)
+        starts[lakeid] = int(np.searchsorted(dates, np.datetime64(parts[lakeid][3])))
+    pending = [lakeid for lakeid in lakeids if starts[lakeid] < len(dates)]
+    bands = group_bands({lakeid: windows[lakeid] for lakeid in pending}, max_band_cells)
+
+    if verbose:
+        if incremental:
+            print(f'Resuming {sum(parts[lakeid][2] > 0 for lakeid in pending)} lakes, '
+                  f'{len(lakeids) - len(pending)} lakes are up to date.')
+        print(f'Grouped {len(pending)} lakes into {len(bands)} bands.')
+
+    # Days on which a band is not read: the days before the first day of a lake and, with
+    # skip_empty, its empty days. The first and last day of every lake are always read (they
+    # provide the output structure, the reference of the time values and time_coverage_end)
+    skip = {lakeid: np.arange(len(dates)) < starts[lakeid] for lakeid in pending}
+    if skip_empty:
+        for lakeid in pending:
+            k = starts[lakeid]
+            if len(dates) - k > 2:
+                skip[lakeid][k + 1:-1] = empty_days([lakeid], read_vars, dates[k + 1:-1])
+    skip_bands = [np.all([skip[lakeid] for lakeid in band_lakeids], axis=0) for _, band_lakeids in bands]
+    skip_days = np.all(skip_bands, axis=0) if bands else np.ones(len(dates), dtype=bool)
+    k_first = min([starts[lakeid] for lakeid in pending], default=len(dates))
+
+    if verbose and skip_empty:
+        print(f'Skipping {np.count_nonzero(skip_days)} of {len(dates)} days and '
+              f'{np.count_nonzero(skip_bands)} of {len(dates) * len(bands)} band reads without valid data.')
+
+    with ExitStack() as stack:
+        nc_outs, writers, stats = {}, {lakeid: [] for lakeid in pending}, {}
+        if write_cube:
+            for lakeid in pending:
+                path_part, _, idx_start, _ = parts[lakeid]
+                nc_outs[lakeid] = stack.enter_context(open_output(path_part, 'w' if idx_start == 0 else 'r+'))
+                writers[lakeid].append(BlockWriter(nc_outs[lakeid], windows[lakeid].mask, idx_start,
+                                                   block_days=block_days, layout=layout,
+                                                   variables=variables, metrics=metrics))
+
+        for idx, filepath in enumerate(paths_ncfiles):
+            if skip_days[idx]:
+                for lakeid in pending:
+                    if idx >= starts[lakeid]:
+                        for writer in writers[lakeid]:
+                            writer.append_empty(times[idx])
+                continue
+            with metrics.stage('open'):
+                nc_in = nc4.Dataset(filepath, 'r')
+            metrics.count('files')
+            with nc_in:
+                if idx == k_first:
+                    for lakeid in pending:
+                        if write_cube and parts[lakeid][2] == 0:
+                            create_output(nc_outs[lakeid], nc_in, windows[lakeid], lakenames[lakeid],
+                                          lakeid, variables, compress=compress, complevel=complevel,
+                                          chunk_time=block_days, layout=layout)
+                        if statistics is not None:
+                            stats[lakeid] = LakeStatistics(windows[lakeid].mask, nc_in, min_quality, metrics)
+                            writers[lakeid].append(stats[lakeid])
+                    if skip_days.any() or np.any(skip_bands):
+                        times = time_values(dates, dates[idx], nc_in['time'][0],
+                                            {k: nc_in['time'].getncattr(k) for k in nc_in['time'].ncattrs()})
+                time_value = nc_in['time'][0]
+                time_coverage_end = nc_in.time_coverage_end
+
+                for ((b_i0, b_i1, b_j0, b_j1), band_lakeids), skip_band in zip(bands, skip_bands):
+                    if skip_band[idx]:
+                        for lakeid in band_lakeids:
+                            if idx >= starts[lakeid]:
+                                for writer in writers[lakeid]:
+                                    writer.append_empty(times[idx])
+                        continue
+                    # Read each variable once for the whole band
+                    with metrics.stage('read'):
+                        band = {v_name: nc_in[v_name][0, b_i0:b_i1, b_j0:b_j1] for v_name in read_vars}
+                    metrics.count_bytes('bytes_read', band)
+                    for lakeid in band_lakeids:
+                        if idx < starts[lakeid]:
+                            continue
+                        i0, i1, j0, j1 = windows[lakeid].bbox
+                        fields = {v_name: field[i0 - b_i0:i1 - b_i0, j0 - b_j0:j1 - b_j0]
+                                  for v_name, field in band.items()}
+                        for writer in writers[lakeid]:
+                            writer.append(fields, time_value, time_coverage_end)
+
+        for lakeid in pending:
+            for writer in writers[lakeid]:
+                writer.flush()
+    metrics.count('days', len(dates))
+    metrics.count('days_skipped', np.count_nonzero(skip_days))
+
+    # Commit the complete outputs and remove the outputs they were continued from
+    if write_cube:
+        for lakeid in lakeids:
+            path_part, path_previous, _, _ = parts[lakeid]
+            path_output = path_extracted.joinpath(fns_output[lakeid])
+            replace_output(path_part, path_output)
+            if path_previous is not None and path_previous != path_output:
+                remove_output(path_previous)
+
+    fns_statistics = {}
+    if statistics is not None:
+        for lakeid in lakeids:
+            fns_statistics[lakeid] = statistics_filename(lakeid, lakenames[lakeid], startdate, enddate,
+                                                         min_quality, statistics)
+            with metrics.stage('write'):
+                stats[lakeid].write(path_extracted.joinpath(fns_statistics[lakeid]), lakeid, lakenames[lakeid])
+    if write_cube and metrics.enabled:
+        metrics.count('output_bytes', sum(output_bytes(path_extracted.joinpath(fns_output[lakeid]))
+                                          for lakeid in lakeids))
+
+    time_elapsed = time() - time_start
+
+    if verbose:
+        print(f'Finished day-major extraction of {len(lakeids)} lakes after {time_elapsed:0.2f} seconds.')
+
+    return [fns_output[lakeid] if write_cube else fns_statistics[lakeid] for lakeid in lakeids]
+
+def data_extraction_daymajor(ids_and_settings):
+    """Take tuple in the form (ids, settings), call day-major extraction function and return the filenames (None if failed)."""
+    ids = ids_and_settings[0]
+    settings = ids_and_settings[1]
+
+    log("Processing ids: {}".format(ids))
+    fns_ext = None
+    metrics = Metrics(settings.get('run_id')) if settings.get('metrics', False) else NULL_METRICS
+
+    try:
+        fns_ext = extract_lakes_daymajor(lakeids=ids,
+                                         variables=settings['variables'],
+                                         startdate=settings['startdate'],
+                                         enddate=settings['enddate'],
+                                         compress=settings['compress'],
+                                         complevel=settings['complevel'],
+                                         verbose=settings['verbose'],
+                                         block_days=settings.get('block_days', c.BLOCK_DAYS),
+                                         max_band_cells=settings.get('max_band_cells', c.MAX_BAND_CELLS),
+                                         layout=settings.get('layout', 'grid'),
+                                         statistics=settings.get('statistics'),
+                                         min_quality=settings.get('min_quality'),
+                                         write_cube=settings.get('write_cube', True),
+                                         skip_empty=settings.get('skip_empty', False),
+                                         backend=settings.get('backend', 'netcdf'),
+                                         incremental=settings.get('incremental', False),
+                                         metrics=metrics)
+
+    except:
+        log("Failed to process ids: {}".format(ids), indent=1)
+
+    metrics.emit('group', lakeids=[int(lakeid) for lakeid in ids],
+                 status='ok' if fns_ext is not None else 'failed')
+
+    return fns_ext
@@ -1,54 +1,53 @@
 # -*- coding: utf-8 -*-
 
-import os
-import sys
+from contextlib import nullcontext
 from time import time
 import pandas as pd
 from datetime import datetime
 import numpy as np
 import netCDF4 as nc4
-import json
 from scripts import constants as c
 from scripts import ROOT
-import re
+from scripts.lakeindex import LakeWindow, load_lake_index
+from scripts.catalog import load_catalog
+from scripts.lookup import (load_abbreviations, lake_maps, clean_lakename, find_lakeids,
+                            find_lakenames)
+from scripts.lakestats import LakeStatistics, STATISTICS_VARS
+from scripts.opendap import DapFetcher, DapCache, opendap_dates, opendap_url, packed_invalid
+from scripts.availability import empty_days, file_dates, time_values
+from scripts.zarrstore import open_output, remove_output, copy_output, replace_output
+from scripts.consolidate import load_consolidated
+from scripts.metrics import Metrics, NULL_METRICS, append_line, output_bytes
 
-module_path = os.path.abspath(os.path.join('../'))
-if module_path not in sys.path:
-    sys.path.append(module_path)
-    
 def valid_variables(variables: list):
     """Check list of variables for validity and return boolean."""
-    path_abbreviations = ROOT.joinpath(c.PATH_ABBREV)
-    f = open(path_abbreviations)
-    abbrev_dict = json.load(f)
-    f.close()
+    abbrev_dict = load_abbreviations()
     check = all(item in abbrev_dict.keys() for item in variables)
     return check
 
 def get_shortname(variables: list):
     """Get shortnames for variables and return a shortened string for filename."""
-    path_abbreviations = ROOT.joinpath(c.PATH_ABBREV)
-    f = open(path_abbreviations)
-    abbrev_dict = json.load(f)
-    f.close()
+    abbrev_dict = load_abbreviations()
     shortnames = [abbrev_dict[var] for var in variables]
     shortnames_str = '_'.join(shortnames)
     return shortnames_str
 
-def find_lakeid(lakename: str):
-    """Return id corresponding to specified lakename from local-table, revert to web-table or manual input if not available."""
-    path_table = ROOT.joinpath(c.PATH_AUXILIARY).joinpath(c.FN_TABLE)
-    if path_table.exists():
-        df = pd.read_csv(path_table)
-    else:
-        print('Local lake table not found, trying to use CCI Lakes webtable.')
-        try:
-            df = pd.read_csv(c.URL_TABLE)
-        except:
-            lakeid = input('Not able to reach CCI Lakes webtable, '  \
-                           f'please enter the lake ID for Lake {lakename} manually: ')
-            return lakeid
-    ids = df.loc[lambda df: df['name'].str.lower() == lakename.lower()]['id']
+def find_lakeid(lakename: str, interactive: bool = True):
+    """Return id corresponding to specified lakename from local-table, revert to web-table or manual input if not available.
+
+    Manual input is only asked for if interactive, otherwise a ValueError is raised (e.g. inside pool workers).
+    """
+    try:
+        _, ids_by_name = lake_maps()
+    except ValueError:
+        if not interactive:
+            raise
+        lakeid = input('Not able to reach CCI Lakes webtable, '  \
+                       f'please enter the lake ID for Lake {lakename} manually: ')
+        return lakeid
+    ids = ids_by_name.get(lakename.lower(), [])
+    if len(ids) != 1 and not interactive:
+        return find_lakeids([lakename])[0]
     if len(ids) == 0:
         lakeid = int(input(f'No results found for Lake {lakename}, please enter lake ID manually: '))
     elif len(ids) > 1:
@@ -56,26 +55,28 @@ def find_lakeid(lakename: str):
               'Please provide the key of the desired lake ID: '))
         while not(idx in range(1, len(ids)+1)):
             idx = int(input(f'Invalid input "{idx}", please give valid key: '))
-        lakeid = ids.iloc[idx-1]
+        lakeid = ids[idx-1]
     else:
-        lakeid = ids.iloc[0]
+        lakeid = ids[0]
     return lakeid
 
+def find_lakename(lakeid: int, interactive: bool = True):
+    """Return lakename corresponding to specified lakeid from local-table, revert to web-table or manual input if not available.
 
-def find_lakename(lakeid: int):
-    """Return lakename corresponding to specified lakeid from local-table, revert to web-table or manual input if not available."""
-    path_table = ROOT.joinpath(c.PATH_AUXILIARY).joinpath(c.FN_TABLE)
-    if path_table.is_file():
-        df = pd.read_csv(path_table)
-    else:
-        try:
-            df = pd.read_csv(c.URL_TABLE)
-        except:
-            lakename = input('Not able to reach CCI Lakes webtable, '
-                             f'please enter the name for ID{lakeid} manually: ')
-            return re.sub(r'[^a-zA-Z\s]', '', lakename)
-
-    names = df.loc[lambda df: df['id'] == lakeid]['name']
+    Manual input is only asked for if interactive, otherwise a ValueError is raised (e.g. inside pool workers).
+    """
+    try:
+        names_by_id, _ = lake_maps()
+    except ValueError:
+        if not interactive:
+            raise
+        lakename = input('Not able to reach CCI Lakes webtable, '
+                         f'please enter the name for ID{lakeid} manually: ')
+        return clean_lakename(lakename)
+
+    names = names_by_id.get(int(lakeid), [])
+    if len(names) != 1 and not interactive:
+        return find_lakenames([lakeid])[0]
     if len(names) == 0:
         lakename = str(input(f'No results found for ID{lakeid}, please enter lakename manually: '))
     elif len(names) > 1:      
@@ -83,16 +84,358 @@ def find_lakename(lakeid: int):
               'Please provide the key of the desired lakename: '))
         while not(idx in range(1, len(names)+1)):
             idx = int(input(f'Invalid input "{idx}", please give valid key: '))
-        lakename = names.iloc[idx-1]
+        lakename = names[idx-1]
     else:
-        lakename = names.iloc[0]
-    return re.sub(r'[^a-zA-Z\s]', '', lakename)
+        lakename = names[0]
+    return clean_lakename(lakename)
+
+def find_ncfiles(startdate: str, enddate: str):
+    """Return the local daily .nc files within the daterange sorted by date (from the catalog of the process)."""
+    return load_catalog(refresh=False).select(startdate, enddate)
+
+def statistics_filename(lakeid: int, lakename: str, startdate: str, enddate: str,
+                        min_quality: int = None, fmt: str = 'csv'):
+    """Return the filename of the statistics table of a lake."""
+    fn_layout = 'stats' if min_quality is None else f'stats-q{min_quality}'
+    fn_output = output_filename(lakeid, lakename, STATISTICS_VARS, startdate, enddate, fn_layout)
+    return f'{fn_output[:-len(".nc")]}.{fmt}'
+
+def output_filename(lakeid: int, lakename: str, variables: list, startdate: str, enddate: str,
+                    layout: str = 'grid', backend: str = 'netcdf'):
+    """Return the filename of an extracted subset."""
+    fn_varnames = get_shortname(variables)
+    fn_layout = 'extracted' if layout == 'grid' else f'extracted-{layout}'
+    fn_suffix = 'nc' if backend == 'netcdf' else backend
+    return f'ID{lakeid}-{lakename.lower()}-{fn_varnames}-{startdate.replace("-", "")}' \
+        f'_{enddate.replace("-", "")}-v{c.VERSION}.{fn_layout}.{fn_suffix}'
+
+def create_output(nc_out, nc_in, window: LakeWindow, lakename: str, lakeid: int, variables: list,
+                  compress: bool = True, complevel: int = 4, subset: bool = False,
+                  chunk_time: int = c.BLOCK_DAYS, layout: str = 'grid'):
+    """Recreate dims, vars and attributes of the first daily file inside an empty output file.
+
+    The extracted variables are chunked for time-series reads (chunk_time days of CHUNK_LATLON
+    cells, or CHUNK_PIXELS pixels for the pixel layout).
+
+    Parameters
+    ----------
+    nc_out : netCDF4.Dataset
+        Output file opened in write mode
+    nc_in : netCDF4.Dataset
+        First daily file of the timeseries
+    window : LakeWindow
+        Window of the lake to extract
+    lakename : str
+        CCI lake name
+    lakeid : int
+        CCI lake id
+    variables : list
+        Variables to extract
+    compress : bool
+        Apply z-lib compression
+    complevel : int
+        Compression level to use
+    subset : bool
+        The daily file is already cropped to the bbox (OPeNDAP)
+    chunk_time : int
+        Chunk size along time of the extracted variables
+    layout : str
+        Store the full bbox as (time, lat, lon) ('grid') or only the lakecells as (time, pixel) ('pixels')
+    """
+    if layout not in c.LAYOUTS:
+        raise ValueError(f'Unknown output layout {layout}!')
+    i0, i1, j0, j1 = window.bbox
+    pixels = layout == 'pixels'
+
+    # Copy main attributes and add additional ones
+    nc_out.setncatts({k: nc_in.getncattr(k) for k in nc_in.ncattrs()})
+    nc_out.setncatts({'lakename': lakename,
+                      'lakeid': lakeid,
+                      'lakecells': window.lakecells})
+    if pixels:
+        nc_out.setncatts({'layout': layout})
+    # Copy dimensions
+    for dname, the_dim in iter(nc_in.dimensions.items()):
+        dim_size = len(the_dim)
+        if dname == 'lat':
+            dim_size = i1 - i0
+        if dname == 'lon':
+            dim_size = j1 - j0
+        nc_out.createDimension(dname, dim_size if not the_dim.isunlimited() else None)
+    if pixels:
+        nc_out.createDimension('pixel', window.lakecells)
+
+    # Copy variables and fill dims (data is written with BlockWriter)
+    dims = nc_in.dimensions.keys()
+    for v_name, varin in iter(nc_in.variables.items()):
+        if v_name in [*variables, *dims]:
+            dimensions, chunksizes = varin.dimensions, None
+            if dimensions == ('time', 'lat', 'lon') and pixels:
+                dimensions = ('time', 'pixel')
+                chunksizes = (chunk_time, max(1, min(window.lakecells, c.CHUNK_PIXELS)))
+            elif dimensions == ('time', 'lat', 'lon'):
+                chunksizes = (chunk_time, max(1, min(i1 - i0, c.CHUNK_LATLON)),
+                              max(1, min(j1 - j0, c.CHUNK_LATLON)))
+            outVar = nc_out.createVariable(v_name, varin.datatype, dimensions,
+                                           zlib=compress, complevel=complevel, chunksizes=chunksizes)
+            outVar.setncatts({k: varin.getncattr(k) for k in varin.ncattrs()})
+            if v_name == 'lat':
+                outVar[:] = varin[:] if subset else varin[i0:i1]
+            elif v_name == 'lon':
+                outVar[:] = varin[:] if subset else varin[j0:j1]
+
+    attrs_dist = {
+        '_FillValue': np.array(nc4.default_fillvals['f4'], dtype=np.float32),
+        'long_name': 'distance to land',
+        'units': 'km',
+        'description': 'Distance to shoreline extracted from the CCI Lakes maskfile.',
+    }
+
+    # Add position and distance to shoreline of the lakecells as variables
+    if pixels:
+        rows, cols = np.nonzero(window.mask)
+        for v_name, index, description in [('lat_index', rows, 'Index of the pixel along lat.'),
+                                           ('lon_index', cols, 'Index of the pixel along lon.')]:
+            outVar = nc_out.createVariable(v_name, 'i4', ('pixel',), zlib=compress, complevel=complevel)
+            outVar.setncatts({'long_name': v_name.replace('_', ' '), 'description': description})
+            outVar[:] = index
+        for v_name, index in [('lat', rows), ('lon', cols)]:
+            outVar = nc_out.createVariable(f'pixel_{v_name}', nc_out[v_name].datatype, ('pixel',),
+                                           zlib=compress, complevel=complevel)
+            outVar.setncatts({k: nc_out[v_name].getncattr(k) for k in nc_out[v_name].ncattrs()})
+            outVar[:] = nc_out[v_name][:][index]
+        outVar_dist = nc_out.createVariable('distance_to_land', 'f4', ('pixel',),
+                                            zlib=compress, complevel=complevel,
+                                            fill_value=nc4.default_fillvals['f4'])
+        outVar_dist.setncatts(attrs_dist)
+        outVar_dist[:] = window.dist[rows, cols]
+        return
+
+    # Add lakemask and distance to shoreline as variables
+    outVar_mask = nc_out.createVariable('lakemask', 'u1', ('lat', 'lon'),
+                                        zlib=compress, complevel=complevel,
+                                        fill_value=nc4.default_fillvals['u1'])
+    outVar_dist = nc_out.createVariable('distance_to_land', 'f4', ('lat', 'lon'),
+                                        zlib=compress, complevel=complevel,
+                                        fill_value=nc4.default_fillvals['f4'])
+    outVar_mask.setncatts({
+        '_FillValue': np.array(nc4.default_fillvals['u1'], dtype=np.uint8),
+        'long_name': 'lakemask',
+        'description': 'Lakemask extracted from the CCI Lakes maskfile.'})
+    outVar_dist.setncatts(attrs_dist)
+    outVar_mask[:, :] = np.where(~window.mask, 255, 1)
+    outVar_dist[:, :] = window.dist
+
+def pixels_to_grid(nc_pixels, v_name: str):
+    """Rebuild the 2-D grid (..., lat, lon) of a variable stored in the pixel layout as masked array."""
+    data = nc_pixels[v_name][:]
+    shape = (len(nc_pixels.dimensions['lat']), len(nc_pixels.dimensions['lon']))
+    grid = np.ma.masked_all(data.shape[:-1] + shape, dtype=data.dtype)
+    grid[..., nc_pixels['lat_index'][:], nc_pixels['lon_index'][:]] = data
+    return grid
+
+def read_day(nc_in, variables: list, bbox: tuple = None):
+    """Read the variables of a daily file, cropped to the bbox if given."""
+    if bbox is None:
+        return {v_name: nc_in[v_name][0, :, :] for v_name in variables}
+    i0, i1, j0, j1 = bbox
+    return {v_name: nc_in[v_name][0, i0:i1, j0:j1] for v_name in variables}
+
+class BlockWriter:
+    """Buffer the cropped daily fields of an output and write them in blocks of days.
+
+    The lakemask is applied once per block and each variable and the time axis are
+    written with one bulk write. Blocks are aligned to multiples of block_days, which
+    matches the time chunking of the output.
+
+    Parameters
+    ----------
+    nc_out : netCDF4.Dataset
+        Output file
+    mask : np.ndarray
+        Cropped boolean lakemask
+    idx_start : int
+        Time index of the first appended day
+    block_days : int
+        Number of days per block
+    packed : bool
+        The fields are packed (unscaled) values as fetched over OPeNDAP
+    layout : str
+        Layout of the output ('grid' or 'pixels'), only the lakecells are kept for 'pixels'
+    variables : list
+        Variables to write, further appended fields are ignored (all fields are written if None)
+    metrics : Metrics
+        Records the time of buffering and masking ('copy') and writing ('write') and the bytes written
+    """
+
+    def __init__(self, nc_out, mask, idx_start: int = 0, block_days: int = c.BLOCK_DAYS,
+                 packed: bool = False, layout: str = 'grid', variables: list = None,
+                 metrics: Metrics = NULL_METRICS):
+        self.nc_out = nc_out
+        self.metrics = metrics
+        self.variables = variables
+        self.mask = mask
+        self.block_days = max(1, block_days)
+        self.packed = packed
+        self.index = np.nonzero(mask) if layout == 'pixels' else None
+        self.shape = mask.shape if self.index is None else (len(self.index[0]),)
+        self.idx = self.idx_block = self.idx_synced = idx_start
+        self.buffers, self.masks = {}, {}
+        self.times, self.time_coverage_end = [], None
+
+    def append(self, fields: dict, time_value, time_coverage_end: str = None):
+        """Append the fields of the next day, the block is written once full."""
+        n = self.idx - self.idx_block
+        with self.metrics.stage('copy'):
+            for v_name in self.variables or fields:
+                field = fields[v_name]
+                if self.packed:
+                    field = field.reshape(self.mask.shape).astype(self.nc_out[v_name].dtype, casting='unsafe')
+                if self.index is not None:
+                    field = field[self.index]
+                if v_name not in self.buffers:
+                    self.allocate(v_name, field.dtype)
+                self.buffers[v_name][n] = np.ma.getdata(field)
+                self.masks[v_name][n] = np.ma.getmaskarray(field)
+        self.next_day(time_value, time_coverage_end)
+
+    def append_empty(self, time_value, time_coverage_end: str = None):
+        """Append a day without valid lakecells (all fields masked) without reading it.
+
+        Unpacked outputs take the dtypes from the days appended before, so the first day has to be read.
+        """
+        n = self.idx - self.idx_block
+        for v_name in self.variables or list(self.buffers):
+            if v_name not in self.buffers:
+                if not self.packed:
+                    raise ValueError('The first day of an unpacked output has to be appended with append!')
+                self.allocate(v_name, self.nc_out[v_name].dtype)
+            self.buffers[v_name][n] = 0
+            self.masks[v_name][n] = True
+        self.next_day(time_value, time_coverage_end)
+
+    def allocate(self, v_name: str, dtype):
+        """Allocate the block buffer and mask of a variable."""
+        self.buffers[v_name] = np.empty((self.block_days, *self.shape), dtype=dtype)
+        self.masks[v_name] = np.zeros((self.block_days, *self.shape), dtype=bool)
+
+    def next_day(self, time_value, time_coverage_end: str = None):
+        """Record the time of the appended day and write the block once full."""
+        self.times.append(time_value)
+        if time_coverage_end is not None:
+            self.time_coverage_end = time_coverage_end
+        self.idx += 1
+        if self.idx % self.block_days == 0:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered days and flush the file to disk every CHECKPOINT_DAYS days."""
+        n = self.idx - self.idx_block
+        if n == 0:
+            return
+        block = slice(self.idx_block, self.idx)
+        outside = ~self.mask[np.newaxis, :, :] if self.index is None else False
+        for v_name, buffer in self.buffers.items():
+            outVar = self.nc_out[v_name]
+            if self.packed:
+                with self.metrics.stage('copy'):
+                    attrs = {k: outVar.getncattr(k) for k in outVar.ncattrs()}
+                    fill_value = attrs.get('_FillValue', nc4.default_fillvals[buffer.dtype.str[1:]])
+                    invalid = outside | self.masks[v_name][:n] | packed_invalid(buffer[:n], attrs)
+                    data = np.where(invalid, fill_value, buffer[:n]).astype(outVar.dtype)
+                with self.metrics.stage('write'):
+                    outVar.set_auto_maskandscale(False)
+                    outVar[block, ...] = data
+                    outVar.set_auto_maskandscale(True)
+            else:
+                with self.metrics.stage('copy'):
+                    data = np.ma.masked_array(buffer[:n], mask=self.masks[v_name][:n] | outside)
+                with self.metrics.stage('write'):
+                    outVar[block, ...] = data
+            self.metrics.count('bytes_written', data.nbytes)
+        with self.metrics.stage('write'):
+            self.nc_out['time'][block] = np.ma.stack(self.times)
+            if self.time_coverage_end is not None:
+                self.nc_out.time_coverage_end = self.time_coverage_end
+            self.idx_block, self.times = self.idx, []
+            if self.idx - self.idx_synced >= c.CHECKPOINT_DAYS:
+                self.nc_out.sync()
+                self.idx_synced = self.idx
+
+def find_previous_output(path_output, lakeid: int, lakename: str, variables: list,
+                         startdate: str, enddate: str, layout: str = 'grid', backend: str = 'netcdf'):
+    """Return the existing output of the lake with the latest enddate up to enddate or None."""
+    pattern = output_filename(lakeid, lakename, variables, startdate, '*', layout, backend)
+    prefix = pattern.split('*')[0]
+    previous = {}
+    for path in path_output.parent.glob(pattern):
+        path_enddate = path.name[len(prefix):len(prefix) + 8]
+        if path_enddate.isdigit() and path_enddate <= enddate.replace('-', ''):
+            previous[path_enddate] = path
+    return previous[max(previous)] if previous else None
+
+def resume_point(path_part, window: LakeWindow, startdate: str):
+    """Return the time index and date to resume a partial output at, (0, startdate) to start over.
+
+    Days are complete once their time value is written, so the partial output is continued
+    after the last leading valid time value. Unreadable or mismatching files are removed.
+    """
+    if not path_part.exists():
+        return 0, startdate
+    try:
+        with open_output(path_part, 'r') as nc_part:
+            shape = (len(nc_part.dimensions['lat']), len(nc_part.dimensions['lon']))
+            var_time = nc_part['time']
+            valid = ~np.ma.getmaskarray(var_time[:])
+            idx = len(valid) if valid.all() else int(np.argmin(valid))
+            if idx > 0:
+                last_date = nc4.num2date(var_time[idx - 1], var_time.units,
+                                         getattr(var_time, 'calendar', 'standard'))
+    except (OSError, KeyError, RuntimeError):
+        idx, shape = 0, None
+    if idx == 0 or shape != window.mask.shape:
+        remove_output(path_part)
+        return 0, startdate
+    resume_date = pd.Timestamp(last_date.strftime('%Y-%m-%d')) + pd.Timedelta(days=1)
+    return idx, resume_date.strftime('%Y-%m-%d')
+
+def partial_output(path_output, window: LakeWindow, lakeid: int, lakename: str, variables: list,
+                   startdate: str, enddate: str, layout: str = 'grid', backend: str = 'netcdf',
+                   incremental: bool = False):
+    """Prepare the partial output which is moved to path_output once complete.
+
+    In incremental mode an interrupted partial output or the latest existing output is continued,
+    otherwise a leftover partial output is removed.
+
+    Returns
+    -------
+    tuple
+        Path of the partial output, path of the output it continues (None if none), time index
+        and date to resume at
+    """
+    path_part = path_output.with_name(path_output.name + '.part')
+    path_previous = None
+    if not incremental:
+        remove_output(path_part)
+        return path_part, None, 0, startdate
+    if not path_part.exists():
+        path_previous = find_previous_output(path_output, lakeid, lakename, variables,
+                                             startdate, enddate, layout, backend)
+        if path_previous is not None:
+            copy_output(path_previous, path_part)
+    idx_start, resume_date = resume_point(path_part, window, startdate)
+    return path_part, path_previous, idx_start, resume_date
 
 def extract_lake_subset(lakeid: int = None, lakename: str = None, use_opendap: bool = False,
                         variables: list = c.DEFAULT_VARS,
                         startdate: str = c.DEFAULT_START, enddate: str = c.DEFAULT_END,
                         compress: bool = True, complevel: int = 4, verbose: bool = False, 
-                        temp: bool = False, merge_with_lakes: list = []):
+                        temp: bool = False, merge_with_lakes: list = [],
+                        opendap_workers: int = c.OPENDAP_WORKERS, opendap_cache: bool = True,
+                        incremental: bool = False, block_days: int = c.BLOCK_DAYS,
+                        layout: str = 'grid', statistics: str = None, min_quality: int = None,
+                        write_cube: bool = True, skip_empty: bool = False, backend: str = 'netcdf',
+                        region: tuple = None, use_consolidated: bool = False, metrics: Metrics = None):
     """Take lakeid or lakename and extract corresponding lake and specified variables from local dataset.
     
     Parameters
@@ -119,79 +462,97 @@ def extract_lake_subset(lakeid: int = None, lakename: str = None, use_opendap: b
         Put inside temporary folder
     merge_with_lakes : list
         List with additional lakeids to merge with the provided lakeid
+    opendap_workers : int
+        Number of concurrent OPeNDAP requests
+    opendap_cache : bool
+        Keep fetched OPeNDAP subsets in the local cache and reuse them
+    incremental : bool
+        Continue an interrupted extraction or append only the new days to the latest
+        existing output of the lake (which is replaced)
+    block_days : int
+        Number of days buffered and written at once (also the time chunk size of the output)
+    layout : str
+        Store the full bbox as (time, lat, lon) ('grid') or only the lakecells as (time, pixel)
+        ('pixels'), see pixels_to_grid to rebuild the grid
+    statistics : str
+        Also write a table of daily lake-wide statistics as 'csv' or 'nc' (None to disable)
+    min_quality : int
+        Minimum lswt_quality_level of the lakecells used for the temperature statistics
+    write_cube : bool
+        Write the extracted subset, set to False to only write the statistics table
+    skip_empty : bool
+        Do not read the days on which the lake certainly has no valid data (see availability),
+        they are written as fill
+    backend : str
+        Write the subset as NETCDF4 file ('netcdf') or as Zarr store ('zarr', see zarrstore)
+    region : tuple
+        (path, time index) of an existing Zarr store to write the days of the daterange into,
+        starting at the time index. Several processes can write disjoint time ranges of the
+        same store at once (see sharding).
+    use_consolidated : bool
+        Read the lakecells from the consolidated archive if it holds all days of the daterange
+        and the variables (see consolidate), otherwise from the daily files
+    metrics : Metrics
+        Record the time per stage and counters of the extraction (see metrics), nothing is recorded if None
     Returns
     -------
     str
-        Filename of the extracted subset
+        Filename of the extracted subset (of the statistics table if write_cube is False,
+        of the store if region is given)
     """
     if not (bool(lakeid) or bool(lakename)):
         raise ValueError('At least one of the params lakeid and lakename '
                          'should be passed!')
     elif not lakename:
-        lakename = find_lakename(lakeid)
+        lakename = find_lakename(lakeid, interactive=False)
     else:
-        lakeid = find_lakeid(lakename)
+        lakeid = find_lakeid(lakename, interactive=False)
 
     if not valid_variables(variables):
         raise ValueError('The passed variable-list is invalid!')
 
+    if layout not in c.LAYOUTS:
+        raise ValueError(f'Unknown output layout {layout}!')
+
+    if backend not in c.BACKENDS:
+        raise ValueError(f'Unknown output backend {backend}!')
+
+    if region is not None and (backend != 'zarr' or use_opendap or incremental or statistics is not None):
+        raise ValueError('Writing into a region is only supported for the local extraction into a Zarr store '
+                         'without incremental extraction and statistics!')
+
+    if statistics is not None and statistics not in c.STATISTICS_FORMATS:
+        raise ValueError(f'Unknown statistics format {statistics}!')
+
+    if not write_cube and statistics is None:
+        raise ValueError('Nothing to write, either write_cube or statistics has to be set!')
+
+    if statistics is not None and incremental:
+        raise ValueError('Statistics are computed over the whole timerange and cannot be '
+                         'combined with incremental extraction!')
+
+    # Variables to read, the statistics need the temperature, quality level and ice cover
+    read_vars = list(dict.fromkeys([*variables, *STATISTICS_VARS])) if statistics else variables
+
     if verbose:
         print(f'Extracting {variables} for Lake {lakename} (ID{lakeid}) from '
               f'{startdate} to {enddate} from local dataset..')
         
     time_start = time()
+    metrics = NULL_METRICS if metrics is None else metrics
 
-    # Define paths
-    path_dataset = ROOT.joinpath(c.PATH_RAW).joinpath(f'v{c.VERSION}')
-    path_maskfile = ROOT.joinpath(c.PATH_AUXILIARY).joinpath(c.FN_MASK)
-
-    if not (path_maskfile.exists()):
-        raise ValueError('The maskfile does not exist!')
-
-    # Get filepaths and filter daterange
-    paths_ncfiles = list(path_dataset.rglob(f'*-fv{c.VERSION}.nc'))
-    
-    allowed_daterange = pd.date_range(startdate, enddate)
-    paths_ncfiles_filter = [str(paths_ncfiles[i]).split('-')[-2] for i in range(len(paths_ncfiles))]
-    paths_ncfiles_filter = [pd.to_datetime(day_str, yearfirst=True) in allowed_daterange for day_str in
-                            paths_ncfiles_filter]
-    paths_ncfiles = np.array(paths_ncfiles)[paths_ncfiles_filter]
-
-    # Get mask and distance to shoreline from maskfile and compute bounding box
-    nc_mask = nc4.Dataset(path_maskfile, 'r')
-    var_lakeid = nc_mask['CCI_lakeid']
-    var_dist = nc_mask['distance_to_land']
-    
-    bool_mask_full = var_lakeid[:] == lakeid
-    
-    if len(merge_with_lakes) > 0:
-        for lakeid_additional in merge_with_lakes:
-            bool_mask_full = bool_mask_full | (var_lakeid[:] == lakeid_additional)
-
-    i0 = np.min(np.nonzero(bool_mask_full)[0])
-    i1 = np.max(np.nonzero(bool_mask_full)[0])
-    j0 = np.min(np.nonzero(bool_mask_full)[1])
-    j1 = np.max(np.nonzero(bool_mask_full)[1])
+    # Get mask, distance to shoreline and bounding box from the lake index
+    with metrics.stage('mask'):
+        window = load_lake_index().window([lakeid, *merge_with_lakes])
+    i0, i1, j0, j1 = window.bbox
 
-    lat_min, lat_max = nc_mask['lat'][i0], nc_mask['lat'][i1]
-    lon_min, lon_max = nc_mask['lon'][j0], nc_mask['lon'][j1]
-    
     if verbose:
+        lat_min, lat_max, lon_min, lon_max = window.latlon
         print(f'Computed bbox: {lon_min:0.2f}, {lat_min:0.2f} | '
               f'{lon_max:0.2f}, {lat_max:0.2f}')
-    
-    # Crop mask and distance to shoreline
-    bool_mask_crop = bool_mask_full[i0:i1, j0:j1]
-    float_dist_crop = np.where(~bool_mask_crop, nc4.default_fillvals['f4'], var_dist[i0:i1, j0:j1])
-    lakecells = np.count_nonzero(bool_mask_crop)
-    
-    # Close maskfile
-    nc_mask.close()
 
     # Define output path
-    fn_varnames = get_shortname(variables)
-    fn_output = f'ID{lakeid}-{lakename.lower()}-{fn_varnames}-{startdate.replace("-", "")}' \
-        f'_{enddate.replace("-", "")}-v{c.VERSION}.extracted.nc'
+    fn_output = output_filename(lakeid, lakename, variables, startdate, enddate, layout, backend)
 
     if temp:
         path_output = ROOT.joinpath(c.PATH_EXTRACTED).joinpath('temp').joinpath(fn_output)
@@ -200,199 +561,225 @@ def extract_lake_subset(lakeid: int = None, lakename: str = None, use_opendap: b
 
     path_output.parent.mkdir(parents=True, exist_ok=True)
 
+    if statistics is not None:
+        fn_statistics = statistics_filename(lakeid, lakename, startdate, enddate, min_quality, statistics)
+        path_statistics = path_output.with_name(fn_statistics)
+
+    # Write into a partial file which is moved in place once complete. In incremental mode
+    # an interrupted partial file or the latest existing output is continued.
+    if region is not None:
+        path_part, idx_start = region
+        path_previous, resume_date = None, startdate
+    else:
+        path_part, path_previous, idx_start, resume_date = partial_output(
+            path_output, window, lakeid, lakename, variables, startdate, enddate, layout, backend, incremental)
+
+    if verbose and idx_start > 0 and region is None:
+        print(f'Resuming after {idx_start} days from {resume_date}..')
+
+    mode = 'w' if idx_start == 0 and region is None else 'r+'
+    up_to_date = idx_start > 0 and pd.Timestamp(resume_date) > pd.Timestamp(enddate)
+
     # Run extraction from web-files using OpENDaP protocol
-    if use_opendap:
-        # Generate OPeNDAP urls for dataset
-        urls = []
-        date_range = pd.date_range(start=startdate, end=enddate, freq="D")
-
-        if len(date_range) == 0:
-            raise ValueError('Empty timerange provided!')
-
-        lat_range_str = f'[{i0}:1:{i1 - 1}]'
-        lon_range_str = f'[{j0}:1:{j1 - 1}]'
-        year = list(map(str, date_range.year))
-        months = ['{:02d}'.format(month) for month in date_range.month]
-        days = ['{:02d}'.format(day) for day in date_range.day]
-        var_str = ''
-
-        for var in variables:
-            newVar = ',' + var + '[0:1:0]' + lat_range_str + lon_range_str
-            var_str += newVar
-
-        for date in range(0, len(date_range)):
-            path = ('https://data.cci.ceda.ac.uk/thredds/dodsC/esacci/lakes/data/lake_products/L3S/v'
-                    + c.VERSION + '/' + year[date] + '/' + months[date]
-                    + '/ESACCI-LAKES-L3S-LK_PRODUCTS-MERGED-'
-                    + year[date] + months[date] + days[date] + '-fv' + c.VERSION + '.nc?'
-                    + 'lat' + lat_range_str + ',lon' + lon_range_str
-                    + ',time[0:1:0]' + var_str)
-            urls.append(path)
-
-
-        # Use first day to recreate necessary dims and vars in output
-        with nc4.Dataset(urls[0], 'r') as nc_in, \
-             nc4.Dataset(path_output, 'w', format='NETCDF4') as nc_out:
-
-                nc_out.setncatts({k: nc_in.getncattr(k) for k in nc_in.ncattrs()})
-                nc_out.setncatts({'lakename': lakename,
-                                  'lakeid': lakeid,
-                                  'lakecells': lakecells})
-
-                # Create dimensions
-                for dname, the_dim in iter(nc_in.dimensions.items()):
-                    dim_size = len(the_dim)
-                    if dname == 'lat':
-                        dim_size = i1 - i0
-                    if dname == 'lon':
-                        dim_size = j1 - j0
-                    nc_out.createDimension(dname, dim_size if not the_dim.isunlimited() else None)
-
-                # Create variables and fill (including dims)
-                dims = nc_in.dimensions.keys()
-                for v_name, varin in iter(nc_in.variables.items()):
-                    if v_name in [*variables, *dims]:
-                        outVar = nc_out.createVariable(v_name, varin.datatype, varin.dimensions,
-                                                       zlib=compress, complevel=complevel)
-                        outVar.setncatts({k: varin.getncattr(k) for k in varin.ncattrs()})
-                        if v_name in dims:
-                            outVar[:] = varin[:]
-                        else:
-                            varin_masked = np.ma.masked_array(varin[0, :, :], mask=~bool_mask_crop)
-                            outVar[0, :, :] = varin_masked
-
-                # Add lakemask and distance to shoreline as variables
-                outVar_mask = nc_out.createVariable('lakemask', 'u1', ('lat', 'lon'),
-                                                    zlib=compress, complevel=complevel,
-                                                    fill_value=nc4.default_fillvals['u1'])
-                outVar_dist = nc_out.createVariable('distance_to_land', 'f4', ('lat', 'lon'),
-                                                    zlib=compress, complevel=complevel,
-                                                    fill_value=nc4.default_fillvals['f4'])
-                outVar_mask.setncatts({
-                    '_FillValue': np.array(nc4.default_fillvals['u1'], dtype=np.uint8),
-                    'long_name': 'lakemask',
-                    'description': 'Lakemask extracted from the CCI Lakes maskfile.'})
-                outVar_dist.setncatts({
-                    '_FillValue': np.array(nc4.default_fillvals['f4'], dtype=np.float32),
-                    'long_name': 'distance to land',
-                    'units': 'km',
-                    'description': 'Distance to shoreline extracted from the CCI Lakes maskfile.',
-                })
-                outVar_mask[:, :] = np.where(~bool_mask_crop, 255, 1)
-                outVar_dist[:, :] = float_dist_crop
-
-        # Append the rest of the days to output .nc file
-        with nc4.Dataset(path_output, 'r+', format='NETCDF4') as nc_out:
-            for idx, url in enumerate(urls):
-                if idx == 0:
-                    # Skip first url
-                    continue
-                with nc4.Dataset(url, 'r') as nc_in:
-                    # Copy variables
-                    for v_name, varin in iter(nc_in.variables.items()):
-                        if v_name in variables:
-                            outVar = nc_out[v_name]
-                            varin_masked = np.ma.masked_array(varin[0, :, :], mask=~bool_mask_crop)
-                            outVar[idx, :, :] = varin_masked
-                    nc_out['time'][idx] = nc_in['time'][0]
-                    nc_out.time_coverage_end = nc_in.time_coverage_end
+    if use_opendap and not up_to_date:
+        dates = opendap_dates(resume_date, enddate)
+        skip = np.zeros(len(dates), dtype=bool)
+        if skip_empty:
+            skip = empty_days([lakeid, *merge_with_lakes], read_vars, dates)
+
+        with (open_output(path_part, mode) if write_cube else nullcontext()) as nc_out:
+            # Use first day to recreate necessary dims and vars in output
+            if idx_start == 0:
+                with metrics.stage('network'):
+                    nc_in = nc4.Dataset(opendap_url(dates[0], window.bbox, read_vars), 'r')
+                with nc_in:
+                    writers = []
+                    if write_cube:
+                        create_output(nc_out, nc_in, window, lakename, lakeid, variables,
+                                      compress=compress, complevel=complevel, subset=True,
+                                      chunk_time=block_days, layout=layout)
+                        writers.append(BlockWriter(nc_out, window.mask, 0, block_days, layout=layout,
+                                                   variables=variables, metrics=metrics))
+                    if statistics is not None:
+                        stats = LakeStatistics(window.mask, nc_in, min_quality, metrics)
+                        writers.append(stats)
+                    with metrics.stage('network'):
+                        fields = read_day(nc_in, read_vars)
+                    metrics.count_bytes('bytes_read', fields)
+                    metrics.count('days')
+                    for writer in writers:
+                        writer.append(fields, nc_in['time'][0], nc_in.time_coverage_end)
+                        writer.flush()
+                    time_ref = (dates[0], nc_in['time'][0], {k: nc_in['time'].getncattr(k)
+                                                             for k in nc_in['time'].ncattrs()})
+                idx_start, dates, skip = 1, dates[1:], skip[1:]
+            else:
+                time_ref = (pd.Timestamp(resume_date) - pd.Timedelta(days=1), nc_out['time'][idx_start - 1],
+                            {k: nc_out['time'].getncattr(k) for k in nc_out['time'].ncattrs()})
+
+            # Fetch the rest of the days concurrently (or from cache) and append them in time order
+            if len(dates) > 0:
+                fetcher = DapFetcher(workers=opendap_workers, cache=DapCache() if opendap_cache else None)
+                writers = [stats] if statistics is not None else []
+                if write_cube:
+                    writers.append(BlockWriter(nc_out, window.mask, idx_start, block_days, packed=True,
+                                               layout=layout, variables=variables, metrics=metrics))
+                # Days which are certainly empty are not fetched but written as fill
+                times = time_values(dates, *time_ref) if skip.any() else None
+                fetched = metrics.iterate('network', fetcher.fetch(dates[~skip], window.bbox, read_vars))
+                for idx in range(len(dates)):
+                    if skip[idx]:
+                        for writer in writers:
+                            writer.append_empty(times[idx])
+                        continue
+                    arrays = next(fetched)
+                    metrics.count_bytes('bytes_read', arrays)
+                    for writer in writers:
+                        writer.append(arrays, arrays['time'][0])
+                for writer in writers:
+                    writer.flush()
+                if write_cube:
+                    with metrics.stage('network'):
+                        nc_out.time_coverage_end = fetcher.attribute(dates[-1], window.bbox, 'time_coverage_end')
+                metrics.count('days', len(dates))
+                metrics.count('days_skipped', np.count_nonzero(skip))
+                metrics.count('bytes_fetched', fetcher.stats.bytes)
+                metrics.count('retries', fetcher.stats.retries)
+
+                if verbose:
+                    print(f'Fetched {fetcher.stats}, skipped {np.count_nonzero(skip)} empty days.')
+                    if opendap_cache:
+                        print(f'Cache: {fetcher.cache}.')
 
     # Run extraction from local files
-    else:
-        if len(paths_ncfiles) == 0:
+    elif not up_to_date:
+        # Get filepaths and filter daterange
+        with metrics.stage('discovery'):
+            paths_ncfiles = find_ncfiles(resume_date, enddate)
+
+        if len(paths_ncfiles) == 0 and idx_start == 0:
             raise ValueError('No .nc files found for specified timerange!')
 
-        # Use first day to recreate necessary dims and vars in output
-        with nc4.Dataset(paths_ncfiles[0], 'r') as nc_in, \
-             nc4.Dataset(path_output, 'w', format='NETCDF4') as nc_out:
-
-            # Copy main attributes and add additional ones
-            nc_out.setncatts({k: nc_in.getncattr(k) for k in nc_in.ncattrs()})
-            nc_out.setncatts({'lakename': lakename,
-                              'lakeid': lakeid,
-                              'lakecells': lakecells})
-            # copy dimensions
-            for dname, the_dim in iter(nc_in.dimensions.items()):
-                dim_size = len(the_dim)
-                if dname == 'lat':
-                    dim_size = i1 - i0
-                if dname == 'lon':
-                    dim_size = j1 - j0
-                nc_out.createDimension(dname, dim_size if not the_dim.isunlimited() else None)
-
-            # Copy variables
-            dims = nc_in.dimensions.keys()
-            for v_name, varin in iter(nc_in.variables.items()):
-                if v_name in [*variables, *dims]:
-                    outVar = nc_out.createVariable(v_name, varin.datatype, varin.dimensions,
-                                                   zlib=compress, complevel=complevel)
-                    outVar.setncatts({k: varin.getncattr(k) for k in varin.ncattrs()})
-                    if v_name == 'lat':
-                        outVar[:] = varin[i0:i1]
-                    elif v_name == 'lon':
-                        outVar[:] = varin[j0:j1]
-                    elif v_name == 'time':
-                        outVar[0] = varin[0]
-                    else:
-                        varin_clipped = varin[0, i0:i1, j0:j1]
-                        varin_masked = np.ma.masked_array(varin_clipped, mask=~bool_mask_crop)
-                        outVar[0, :, :] = varin_masked
-
-            # Add lakemask and distance to shoreline as variables
-            outVar_mask = nc_out.createVariable('lakemask', 'u1', ('lat', 'lon'),
-                                                zlib=compress, complevel=complevel,
-                                                fill_value=nc4.default_fillvals['u1'])
-            outVar_dist = nc_out.createVariable('distance_to_land', 'f4', ('lat', 'lon'),
-                                                zlib=compress, complevel=complevel,
-                                                fill_value=nc4.default_fillvals['f4'])
-            outVar_mask.setncatts({
-                '_FillValue': np.array(nc4.default_fillvals['u1'], dtype=np.uint8),
-                'long_name': 'lakemask',
-                'description': 'Lakemask extracted from the CCI Lakes maskfile.'})
-            outVar_dist.setncatts({
-                '_FillValue': np.array(nc4.default_fillvals['f4'], dtype=np.float32),
-                'long_name': 'distance to land',
-                'units': 'km',
-                'description': 'Distance to shoreline extracted from the CCI Lakes maskfile.',
-            })
-            outVar_mask[:, :] = np.where(~bool_mask_crop, 255, 1)
-            outVar_dist[:, :] = float_dist_crop
-
-        # Append the rest of the days to output .nc file
-        with nc4.Dataset(path_output, 'r+', format='NETCDF4') as nc_out:
-            for idx, filepath in enumerate(paths_ncfiles):
-                if idx == 0:
-                    continue # Skip first url
-                with nc4.Dataset(filepath, 'r') as nc_in:
-                    # Copy variables
-                    for v_name, varin in iter(nc_in.variables.items()):
-                        if v_name in variables:
-                            outVar = nc_out[v_name]
-                            varin_clipped = varin[0, i0:i1, j0:j1]
-                            varin_masked = np.ma.masked_array(varin_clipped, mask=~bool_mask_crop)
-                            outVar[idx, :, :] = varin_masked
-                    nc_out['time'][idx] = nc_in['time'][0]
-                    nc_out.time_coverage_end = nc_in.time_coverage_end
+        if verbose:
+            missing = load_catalog(refresh=False).missing(resume_date, enddate)
+            print(f'{len(missing)} days without local file within the timerange.')
+
+        # Read the lakecells from the consolidated archive if it holds all days, the first and
+        # last daily file only provide the output structure and time_coverage_end
+        dates = file_dates(paths_ncfiles)
+        archive = load_consolidated() if use_consolidated else None
+        span = archive.span(read_vars, dates) if archive is not None else None
+        if verbose and use_consolidated:
+            print('Reading from the consolidated archive..' if span is not None else
+                  'The consolidated archive does not hold all days and variables, reading the daily files..')
+
+        if span is not None:
+            with (open_output(path_part, mode) if write_cube else nullcontext()) as nc_out:
+                writers = []
+                if idx_start == 0 and region is None:
+                    with nc4.Dataset(paths_ncfiles[0], 'r') as nc_in:
+                        if write_cube:
+                            create_output(nc_out, nc_in, window, lakename, lakeid, variables,
+                                          compress=compress, complevel=complevel, chunk_time=block_days,
+                                          layout=layout)
+                        if statistics is not None:
+                            stats = LakeStatistics(window.mask, nc_in, min_quality, metrics)
+                            writers.append(stats)
+                if write_cube:
+                    writers.append(BlockWriter(nc_out, window.mask, idx_start, block_days, packed=True,
+                                               layout=layout, variables=variables, metrics=metrics))
+                days = archive.days_of([lakeid, *merge_with_lakes], window.bbox, read_vars, *span)
+                for fields, time_value in metrics.iterate('read', days):
+                    metrics.count_bytes('bytes_read', fields)
+                    for writer in writers:
+                        writer.append(fields, time_value)
+                for writer in writers:
+                    writer.flush()
+                if write_cube:
+                    with nc4.Dataset(paths_ncfiles[-1], 'r') as nc_in:
+                        nc_out.time_coverage_end = nc_in.time_coverage_end
+                metrics.count('days', len(dates))
+        else:
+            # Otherwise the first and last day are always read, they provide the output structure,
+            # the reference of the time values and time_coverage_end
+            skip = np.zeros(len(dates), dtype=bool)
+            if skip_empty and len(dates) > 2:
+                skip[1:-1] = empty_days([lakeid, *merge_with_lakes], read_vars, dates[1:-1])
+                if verbose:
+                    print(f'Skipping {np.count_nonzero(skip)} of {len(dates)} days without valid data.')
+
+            # Use first day to recreate necessary dims and vars in output, then
+            # append the rest of the days to output .nc file
+            with (open_output(path_part, mode) if write_cube else nullcontext()) as nc_out:
+                writers = []
+                if write_cube:
+                    writers.append(BlockWriter(nc_out, window.mask, idx_start, block_days, layout=layout,
+                                               variables=variables, metrics=metrics))
+                for idx, filepath in enumerate(paths_ncfiles, start=idx_start):
+                    if skip[idx - idx_start]:
+                        for writer in writers:
+                            writer.append_empty(times[idx - idx_start])
+                        continue
+                    with metrics.stage('open'):
+                        nc_in = nc4.Dataset(filepath, 'r')
+                    with nc_in:
+                        if idx == 0 and region is None:
+                            if write_cube:
+                                create_output(nc_out, nc_in, window, lakename, lakeid, variables,
+                                              compress=compress, complevel=complevel, chunk_time=block_days,
+                                              layout=layout)
+                            if statistics is not None:
+                                stats = LakeStatistics(window.mask, nc_in, min_quality, metrics)
+                                writers.append(stats)
+                        if idx == idx_start and skip.any():
+                            times = time_values(dates, dates[0], nc_in['time'][0],
+                                                {k: nc_in['time'].getncattr(k) for k in nc_in['time'].ncattrs()})
+                        with metrics.stage('read'):
+                            fields = read_day(nc_in, read_vars, window.bbox)
+                        metrics.count_bytes('bytes_read', fields)
+                        for writer in writers:
+                            writer.append(fields, nc_in['time'][0], nc_in.time_coverage_end)
+                for writer in writers:
+                    writer.flush()
+                metrics.count('files', len(dates) - np.count_nonzero(skip))
+                metrics.count('days', len(dates))
+                metrics.count('days_skipped', np.count_nonzero(skip))
+
+    if statistics is not None:
+        with metrics.stage('write'):
+            stats.write(path_statistics, lakeid, lakename)
+
+    # Commit the complete output and remove the output it was continued from
+    if write_cube and region is None:
+        replace_output(path_part, path_output)
+        if metrics.enabled:
+            metrics.count('output_bytes', output_bytes(path_output))
+    if path_previous is not None and path_previous != path_output:
+        remove_output(path_previous)
 
     time_elapsed = time() - time_start
     
     if verbose:
         print(f'Finished extraction and masking after {time_elapsed:0.2f} seconds.')
 
-    return fn_output
+    if region is not None:
+        return path_part.name
+    return fn_output if write_cube else fn_statistics
 
 def log(str, indent=0):
     out = datetime.now().strftime("%H:%M:%S.%f") + (" " * 3 * (indent + 1)) + str
-    with open("log.txt", "a") as file:
-        file.write(out + "\n")
+    # One locked write per line, the pool workers log to the same file
+    append_line(c.FN_LOG, out)
     print(out)
 
 def data_extraction(id_and_settings):
-    """Take tuple in the form (id, settings) and call extraction function."""
+    """Take tuple in the form (id, settings), call extraction function and return the filename (None if failed)."""
     id = id_and_settings[0]
     settings = id_and_settings[1]
 
     log("Processing id: {}".format(id))
+    fns_ext = None
+    metrics = Metrics(settings.get('run_id')) if settings.get('metrics', False) else NULL_METRICS
     
     try:
         fns_ext = extract_lake_subset(lakeid=int(id),
@@ -402,9 +789,23 @@ def data_extraction(id_and_settings):
                                       enddate=settings['enddate'],
                                       compress=settings['compress'], 
                                       complevel=settings['complevel'], 
-                                      verbose=settings['verbose'])
+                                      verbose=settings['verbose'],
+                                      opendap_workers=settings.get('opendap_workers', c.OPENDAP_WORKERS),
+                                      opendap_cache=settings.get('opendap_cache', True),
+                                      incremental=settings.get('incremental', False),
+                                      block_days=settings.get('block_days', c.BLOCK_DAYS),
+                                      layout=settings.get('layout', 'grid'),
+                                      statistics=settings.get('statistics'),
+                                      min_quality=settings.get('min_quality'),
+                                      write_cube=settings.get('write_cube', True),
+                                      skip_empty=settings.get('skip_empty', False),
+                                      backend=settings.get('backend', 'netcdf'),
+                                      use_consolidated=settings.get('use_consolidated', False),
+                                      metrics=metrics)
     
     except:
         log("Failed to process id: {}".format(id), indent=1)
+
+    metrics.emit('lake', lakeid=int(id), status='ok' if fns_ext is not None else 'failed', output=fns_ext)
         
-    return
\ No newline at end of file
+    return fns_ext
\ No newline at end of file
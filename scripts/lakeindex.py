@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+"""This module builds and loads the precomputed lake index of the static lake mask.
+
+The index stores for every lake its bbox, number of lakecells, the flat pixel indices
+and the distance to shoreline per pixel. It is built in one vectorized pass over the
+maskfile, saved as .npy files next to the maskfile and memory-mapped when loaded.
+The index is rebuilt automatically when the maskfile changes.
+"""
+
+import os
+import json
+import shutil
+from collections import namedtuple
+import numpy as np
+import netCDF4 as nc4
+from scripts import constants as c
+from scripts import ROOT
+
+LakeWindow = namedtuple('LakeWindow', ['bbox', 'mask', 'dist', 'lakecells', 'latlon'])
+
+INDEX_FILES = ['ids', 'offsets', 'counts', 'bbox', 'pixels', 'dist', 'lat', 'lon']
+
+_cache = {}
+
+class LakeIndex:
+    """Memory-mapped lake index of the static lake mask."""
+
+    def __init__(self, path_index):
+        with open(path_index.joinpath('meta.json')) as f:
+            self.meta = json.load(f)
+        self.shape = tuple(self.meta['shape'])
+        for name in INDEX_FILES:
+            setattr(self, name, np.load(path_index.joinpath(f'{name}.npy'), mmap_mode='r'))
+
+    def __contains__(self, lakeid):
+        pos = np.searchsorted(self.ids, lakeid)
+        return pos < len(self.ids) and self.ids[pos] == lakeid
+
+    def bbox_of(self, lakeid: int):
+        """Return the bbox (i0, i1, j0, j1) of a lake."""
+        if lakeid not in self:
+            raise ValueError(f'Lake ID{lakeid} not found in the maskfile!')
+        return tuple(int(k) for k in self.bbox[np.searchsorted(self.ids, lakeid)])
+
+    def pixels_of(self, lakeid: int):
+        """Return the sorted flat pixel indices and distance to shoreline of a lake."""
+        if lakeid not in self:
+            raise ValueError(f'Lake ID{lakeid} not found in the maskfile!')
+        pos = np.searchsorted(self.ids, lakeid)
+        start, stop = self.offsets[pos], self.offsets[pos] + self.counts[pos]
+        return np.asarray(self.pixels[start:stop]), np.asarray(self.dist[start:stop])
+
+    def window(self, lakeids: list):
+        """Compute bbox, cropped lakemask, distance to shoreline and lakecells for the union of lakeids.
+
+        Parameters
+        ----------
+        lakeids : list
+            CCI lake ids which are merged into one window
+        Returns
+        -------
+        LakeWindow
+            Named tuple with the bbox (i0, i1, j0, j1), the cropped boolean lakemask, the cropped
+            distance to shoreline, the number of lakecells and the bbox as (lat_min, lat_max, lon_min, lon_max)
+        """
+        pixels, dist = zip(*[self.pixels_of(lakeid) for lakeid in lakeids])
+        pixels, dist = np.concatenate(pixels), np.concatenate(dist)
+        rows, cols = np.divmod(pixels, self.shape[1])
+
+        i0, i1 = int(rows.min()), int(rows.max())
+        j0, j1 = int(cols.min()), int(cols.max())
+
+        # Crop mask and distance to shoreline (the bbox excludes the last row and column)
+        inside = (rows < i1) & (cols < j1)
+        bool_mask_crop = np.zeros((i1 - i0, j1 - j0), dtype=bool)
+        bool_mask_crop[rows[inside] - i0, cols[inside] - j0] = True
+        float_dist_crop = np.full((i1 - i0, j1 - j0), nc4.default_fillvals['f4'], dtype=dist.dtype)
+        float_dist_crop[rows[inside] - i0, cols[inside] - j0] = dist[inside]
+        lakecells = np.count_nonzero(bool_mask_crop)
+
+        return LakeWindow((i0, i1, j0, j1), bool_mask_crop, float_dist_crop, lakecells,
+                          (self.lat[i0], self.lat[i1], self.lon[j0], self.lon[j1]))
+
+def gather_pixels(var, pixels, nx: int, block_rows: int = c.INDEX_BLOCK_ROWS):
+    """Read the values of sorted flat pixel indices from a daily variable (time, lat, lon).
+
+    Only the blocks of rows containing pixels are read, each limited to the columns of its pixels.
+    """
+    values = []
+    for block in np.unique(pixels // nx // block_rows):
+        lo, hi = np.searchsorted(pixels, [block * block_rows * nx, (block + 1) * block_rows * nx])
+        rows, cols = np.divmod(pixels[lo:hi], nx)
+        r0, j0 = block * block_rows, cols.min()
+        field = var[0, r0:rows.max() + 1, j0:cols.max() + 1]
+        values.append(field[rows - r0, cols - j0])
+    if len(values) == 0:
+        return np.empty(0, dtype=var.dtype)
+    return np.ma.concatenate(values) if np.ma.isMaskedArray(values[0]) else np.concatenate(values)
+
+def mask_signature(path_maskfile):
+    """Return the signature of the maskfile used to invalidate the index."""
+    stat = os.stat(path_maskfile)
+    return {'maskfile': path_maskfile.name, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def is_current(meta: dict, signature: dict):
+    """Check if the index metadata matches the maskfile signature and return boolean."""
+    return all(meta.get(k) == v for k, v in signature.items())
+
+def build_lake_index(path_maskfile, path_index, block_rows: int = c.INDEX_BLOCK_ROWS):
+    """Build the lake index from the maskfile in one pass over blocks of rows.
+
+    Parameters
+    ----------
+    path_maskfile : Path
+        Path of the CCI Lakes maskfile
+    path_index : Path
+        Directory to write the index to
+    block_rows : int
+        Number of rows of the mask read at once
+    """
+    ids, pixels, dist = [], [], []
+    with nc4.Dataset(path_maskfile, 'r') as nc_mask:
+        var_lakeid = nc_mask['CCI_lakeid']
+        var_dist = nc_mask['distance_to_land']
+        ny, nx = var_lakeid.shape
+        for r0 in range(0, ny, block_rows):
+            block = np.ma.filled(var_lakeid[r0:r0 + block_rows, :], 0).ravel()
+            flat = np.flatnonzero(block > 0)
+            ids.append(block[flat])
+            pixels.append(flat + r0 * nx)
+            dist.append(np.ma.getdata(var_dist[r0:r0 + block_rows, :]).ravel()[flat])
+        lat = np.ma.getdata(nc_mask['lat'][:])
+        lon = np.ma.getdata(nc_mask['lon'][:])
+
+    # Group pixels by lakeid, the stable sort keeps the pixels of each lake in ascending order
+    ids = np.concatenate(ids)
+    order = np.argsort(ids, kind='stable')
+    ids = ids[order]
+    pixels = np.concatenate(pixels).astype(np.int64)[order]
+    dist = np.concatenate(dist)[order]
+    uids, offsets, counts = np.unique(ids, return_index=True, return_counts=True)
+
+    rows, cols = np.divmod(pixels, nx)
+    bbox = np.zeros((len(uids), 4), dtype=np.int64)
+    if len(uids) > 0:
+        bbox = np.stack([np.minimum.reduceat(rows, offsets), np.maximum.reduceat(rows, offsets),
+                         np.minimum.reduceat(cols, offsets), np.maximum.reduceat(cols, offsets)], axis=1)
+
+    # Write to a temporary directory and move it in place once complete
+    path_tmp = path_index.with_name(f'{path_index.name}.tmp-{os.getpid()}')
+    shutil.rmtree(path_tmp, ignore_errors=True)
+    path_tmp.mkdir(parents=True)
+    arrays = {'ids': uids, 'offsets': offsets, 'counts': counts, 'bbox': bbox,
+              'pixels': pixels, 'dist': dist, 'lat': lat, 'lon': lon}
+    for name in INDEX_FILES:
+        np.save(path_tmp.joinpath(f'{name}.npy'), arrays[name])
+    with open(path_tmp.joinpath('meta.json'), 'w') as f:
+        json.dump({**mask_signature(path_maskfile), 'shape': [ny, nx]}, f)
+
+    shutil.rmtree(path_index, ignore_errors=True)
+    try:
+        os.replace(path_tmp, path_index)
+    except OSError:
+        # Another process moved its index in place first
+        shutil.rmtree(path_tmp, ignore_errors=True)
+
+def load_lake_index(rebuild: bool = False):
+    """Return the lake index of the current maskfile, (re)build it if missing or outdated."""
+    path_maskfile = ROOT.joinpath(c.PATH_AUXILIARY).joinpath(c.FN_MASK)
+    path_index = ROOT.joinpath(c.PATH_AUXILIARY).joinpath(c.DIR_INDEX)
+
+    if not (path_maskfile.exists()):
+        raise ValueError('The maskfile does not exist!')
+
+    signature = mask_signature(path_maskfile)
+    index = _cache.get(path_index)
+    if index is not None and not rebuild and is_current(index.meta, signature):
+        return index
+
+    path_meta = path_index.joinpath('meta.json')
+    stale = True
+    if path_meta.exists() and not rebuild:
+        with open(path_meta) as f:
+            stale = not is_current(json.load(f), signature)
+    if stale:
+        build_lake_index(path_maskfile, path_index)
+
+    _cache[path_index] = LakeIndex(path_index)
+    return _cache[path_index]
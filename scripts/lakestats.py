@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+"""This module computes lake-wide daily statistics during the extraction.
+
+The statistics are reduced from the cropped daily fields while they are in memory, so the
+extracted cube does not have to be read again (or written at all). Per day the table holds
+the mean, median and std of the lake surface water temperature of the lakecells with at
+least the minimum quality level, the fraction of valid lakecells and the ice fraction.
+"""
+
+import numpy as np
+import pandas as pd
+import netCDF4 as nc4
+from scripts import constants as c
+from scripts.opendap import unpack
+from scripts.metrics import Metrics, NULL_METRICS
+
+STATISTICS_VARS = ['lake_surface_water_temperature', 'lswt_quality_level', 'lake_ice_cover_class']
+
+COLUMNS = ['lswt_mean', 'lswt_median', 'lswt_std', 'lswt_valid_fraction', 'ice_fraction']
+
+def flag_values(attrs: dict, word: str, default: dict):
+    """Return the flag values whose meaning contains word (from the attributes, else from default)."""
+    if 'flag_values' in attrs and 'flag_meanings' in attrs:
+        flags = dict(zip(np.atleast_1d(attrs['flag_values']).tolist(), attrs['flag_meanings'].split()))
+    else:
+        flags = default
+    return [value for value, meaning in flags.items() if word in meaning]
+
+class LakeStatistics:
+    """Reduce the cropped daily fields of a lake to daily lake-wide statistics.
+
+    Parameters
+    ----------
+    mask : np.ndarray
+        Cropped boolean lakemask
+    nc_in : netCDF4.Dataset
+        Daily file (or OPeNDAP subset) to take the attributes of the variables from
+    min_quality : int
+        Minimum lswt_quality_level of the lakecells used for the temperature statistics
+        (see LSWT_FLAGS), all valid lakecells are used if None
+    metrics : Metrics
+        Records the time of the reduction ('statistics')
+    """
+
+    def __init__(self, mask, nc_in, min_quality: int = None, metrics: Metrics = NULL_METRICS):
+        self.mask = mask
+        self.metrics = metrics
+        self.lakecells = np.count_nonzero(mask)
+        self.min_quality = min_quality
+        self.attrs = {v_name: {k: nc_in[v_name].getncattr(k) for k in nc_in[v_name].ncattrs()}
+                      for v_name in STATISTICS_VARS}
+        self.time_attrs = {k: nc_in['time'].getncattr(k) for k in nc_in['time'].ncattrs()}
+        self.ice = flag_values(self.attrs['lake_ice_cover_class'], 'ice', c.LIC_FLAGS)
+        self.water = flag_values(self.attrs['lake_ice_cover_class'], 'water', c.LIC_FLAGS)
+        self.times, self.rows = [], []
+
+    def append(self, fields: dict, time_value, time_coverage_end: str = None):
+        """Reduce the fields of the next day, packed fields (OPeNDAP) are unpacked first."""
+        with self.metrics.stage('statistics'):
+            self.reduce(fields, time_value)
+
+    def reduce(self, fields: dict, time_value):
+        fields = {v_name: fields[v_name] if np.ma.isMaskedArray(fields[v_name])
+                  else unpack(fields[v_name].reshape(self.mask.shape), self.attrs[v_name])
+                  for v_name in STATISTICS_VARS}
+
+        lswt = fields['lake_surface_water_temperature']
+        valid = self.mask & ~np.ma.getmaskarray(lswt)
+        if self.min_quality is not None:
+            quality = fields['lswt_quality_level']
+            valid &= np.ma.filled(quality >= self.min_quality, False)
+        values = np.ma.getdata(lswt)[valid].astype(np.float64)
+
+        lic = fields['lake_ice_cover_class']
+        classified = self.mask & ~np.ma.getmaskarray(lic)
+        n_ice = np.count_nonzero(classified & np.isin(np.ma.getdata(lic), self.ice))
+        n_water = np.count_nonzero(classified & np.isin(np.ma.getdata(lic), self.water))
+
+        self.times.append(time_value)
+        self.rows.append((values.mean() if values.size else np.nan,
+                          np.median(values) if values.size else np.nan,
+                          values.std() if values.size else np.nan,
+                          values.size / self.lakecells if self.lakecells else np.nan,
+                          n_ice / (n_ice + n_water) if n_ice + n_water else np.nan))
+
+    def append_empty(self, time_value, time_coverage_end: str = None):
+        """Add a day without valid lakecells without reducing any fields."""
+        self.times.append(time_value)
+        self.rows.append((np.nan, np.nan, np.nan, 0.0 if self.lakecells else np.nan, np.nan))
+
+    def flush(self):
+        """Nothing to write until the table is complete (same interface as BlockWriter)."""
+        return
+
+    def table(self):
+        """Return the statistics as DataFrame indexed by date."""
+        dates = nc4.num2date(np.asarray(self.times), self.time_attrs['units'],
+                             self.time_attrs.get('calendar', 'standard'),
+                             only_use_cftime_datetimes=False, only_use_python_datetimes=True)
+        df = pd.DataFrame(self.rows, columns=COLUMNS, index=pd.DatetimeIndex(dates, name='date'))
+        df.insert(0, 'time', np.asarray(self.times))
+        return df
+
+    def write(self, path_statistics, lakeid: int, lakename: str):
+        """Write the statistics table as .csv or .nc (by the suffix of path_statistics)."""
+        df = self.table()
+        if path_statistics.suffix == '.csv':
+            df.to_csv(path_statistics, float_format='%.4f')
+            return
+
+        with nc4.Dataset(path_statistics, 'w', format='NETCDF4') as nc_out:
+            nc_out.setncatts({'lakename': lakename, 'lakeid': lakeid, 'lakecells': self.lakecells,
+                              'min_quality': -1 if self.min_quality is None else self.min_quality})
+            nc_out.createDimension('time', None)
+            outVar = nc_out.createVariable('time', np.asarray(self.times).dtype, ('time',))
+            outVar.setncatts(self.time_attrs)
+            outVar[:] = df['time'].values
+            for column in COLUMNS:
+                outVar = nc_out.createVariable(column, 'f4', ('time',), fill_value=nc4.default_fillvals['f4'])
+                outVar[:] = np.ma.masked_invalid(df[column].values)
+            nc_out['lswt_mean'].units = nc_out['lswt_median'].units = nc_out['lswt_std'].units = \
+                self.attrs['lake_surface_water_temperature'].get('units', 'K')
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+"""This module looks up lake ids, lake names and variable abbreviations.
+
+The data-availability table and the abbreviations are loaded once per process and
+kept in memory (workers forked after the first lookup inherit them). Lists of ids
+or names are resolved in one pass; lakes which cannot be resolved unambiguously are
+reported all at once with a ValueError instead of asking for manual input.
+"""
+
+import re
+import json
+import pandas as pd
+from scripts import constants as c
+from scripts import ROOT
+
+UNNAMED = 'unnamed' # Name of lakes without name in the lake table
+
+_cache = {}
+
+def load_lake_table():
+    """Return the data-availability table (local, else web-table), raise ValueError if not available."""
+    path_table = ROOT.joinpath(c.PATH_AUXILIARY).joinpath(c.FN_TABLE)
+    key = ('table', path_table)
+    if key not in _cache:
+        if path_table.is_file():
+            df = pd.read_csv(path_table)
+        else:
+            try:
+                df = pd.read_csv(c.URL_TABLE)
+            except Exception as e:
+                raise ValueError(f'The lake table is neither available at {path_table} '
+                                 f'nor at {c.URL_TABLE}!') from e
+        _cache[key] = df
+    return _cache[key]
+
+def load_abbreviations():
+    """Return the dict of variable abbreviations."""
+    path_abbreviations = ROOT.joinpath(c.PATH_ABBREV)
+    key = ('abbreviations', path_abbreviations)
+    if key not in _cache:
+        with open(path_abbreviations) as f:
+            _cache[key] = json.load(f)
+    return _cache[key]
+
+def lake_maps():
+    """Return the dicts {id: [names]} and {lowercase name: [ids]} of the lake table."""
+    path_table = ROOT.joinpath(c.PATH_AUXILIARY).joinpath(c.FN_TABLE)
+    key = ('maps', path_table)
+    if key not in _cache:
+        df = load_lake_table()
+        names_by_id = df['name'].fillna(UNNAMED).groupby(df['id']).agg(list).to_dict()
+        ids_by_name = df.groupby(df['name'].str.lower())['id'].agg(list).to_dict()
+        _cache[key] = (names_by_id, ids_by_name)
+    return _cache[key]
+
+def clean_lakename(lakename: str):
+    """Return the lakename with all characters except letters and whitespace removed."""
+    return re.sub(r'[^a-zA-Z\s]', '', lakename)
+
+def check_unique(keys: list, matches: list, kind: str):
+    """Raise ValueError listing all keys without match or with several matches."""
+    unknown = [key for key, match in zip(keys, matches) if len(match) == 0]
+    ambiguous = {key: match for key, match in zip(keys, matches) if len(match) > 1}
+    errors = []
+    if unknown:
+        errors.append(f'{kind} not found in the lake table: {unknown}')
+    if ambiguous:
+        errors.append(f'{kind} with several matches in the lake table: {ambiguous}')
+    if errors:
+        raise ValueError('; '.join(errors) + '!')
+
+def find_lakenames(lakeids: list):
+    """Return the lakenames of the lakeids, raise ValueError listing all unknown or ambiguous ids."""
+    names_by_id, _ = lake_maps()
+    matches = [names_by_id.get(int(lakeid), []) for lakeid in lakeids]
+    check_unique([int(lakeid) for lakeid in lakeids], matches, 'Lake IDs')
+    return [clean_lakename(names[0]) for names in matches]
+
+def find_lakeids(lakenames: list):
+    """Return the lakeids of the lakenames (case-insensitive), raise ValueError listing all unknown or ambiguous names."""
+    _, ids_by_name = lake_maps()
+    matches = [ids_by_name.get(lakename.lower(), []) for lakename in lakenames]
+    check_unique(list(lakenames), matches, 'Lakenames')
+    return [int(ids[0]) for ids in matches]
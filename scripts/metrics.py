@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+"""This module records per-stage timings and counters of extractions as JSON lines.
+
+An extraction passes its Metrics to the stages, which time themselves and count bytes,
+files and days. Once a lake (or a day-major group of lakes) is done, one record with the
+seconds per stage, the counters, the elapsed time and the peak memory of the process
+during the extraction is appended to the metrics file. Records are appended under a file
+lock with a single write, so all pool workers can write to the same file. After the run
+main.py appends a summary of all records of the run. Without metrics the extraction uses
+NULL_METRICS, whose stages are a shared no-op context:
+
+    {"type": "lake", "run": "...", "lakeid": 2, "status": "ok", "elapsed": 3.1,
+     "stages": {"discovery": 0.0, "mask": 0.01, "open": 0.4, "read": 1.9, ...},
+     "counters": {"files": 365, "days": 365, "bytes_read": ..., "bytes_written": ...},
+     "peak_rss_mb": 212.0}
+"""
+
+import os
+import json
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from time import time, perf_counter
+from scripts import constants as c
+
+# POSIX only, on Windows files are locked with msvcrt and the peak memory is not recorded
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Stages of an extraction: file discovery, lake index window, opening the daily files,
+# reading (decompressing) the fields, buffering and masking, writing (compressing) the
+# outputs, waiting for OPeNDAP responses and reducing the statistics
+STAGES = ['discovery', 'mask', 'open', 'read', 'copy', 'write', 'network', 'statistics']
+
+@contextmanager
+def locked_fd(fd: int):
+    """Hold an exclusive lock on an open file between processes (on Windows on its first byte)."""
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+    try:
+        yield
+    finally:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        else:
+            os.lseek(fd, 0, os.SEEK_SET)
+            msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+def append_line(path, line: str):
+    """Append a line to a file with one write under an exclusive lock (safe between processes)."""
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        with locked_fd(fd):
+            os.write(fd, (line + '\n').encode('utf-8'))
+    finally:
+        os.close(fd)
+
+def reset_peak_rss():
+    """Reset the peak resident memory of the process (Linux only, ignored elsewhere)."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def peak_rss_mb():
+    """Return the peak resident memory of the process in MB (since the last reset on Linux, 0 if unknown)."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if resource is None:
+        return 0.0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def new_run_id():
+    """Return an id for the records of a run."""
+    return f'{datetime.now():%Y%m%dT%H%M%S}-{os.getpid()}'
+
+class Metrics:
+    """Timers per stage and counters of one extraction.
+
+    Parameters
+    ----------
+    run : str
+        Id of the run the records belong to
+    path : Path
+        File the records are appended to
+    """
+
+    enabled = True
+
+    def __init__(self, run: str = None, path=c.FN_METRICS):
+        self.run = run
+        self.path = path
+        self.stages = dict.fromkeys(STAGES, 0.0)
+        self.counters = {}
+        reset_peak_rss()
+        self.time_start = time()
+
+    @contextmanager
+    def stage(self, name: str):
+        """Add the time spent inside the context to the stage."""
+        time_start = perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] += perf_counter() - time_start
+
+    def count(self, name: str, value: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + int(value)
+
+    def count_bytes(self, name: str, fields: dict):
+        """Count the (uncompressed) bytes of a dict of arrays."""
+        self.count(name, sum(getattr(field, 'nbytes', 0) for field in fields.values()))
+
+    def iterate(self, name: str, iterable):
+        """Yield the items of iterable, adding the time spent to produce them to the stage."""
+        iterator = iter(iterable)
+        while True:
+            time_start = perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.stages[name] += perf_counter() - time_start
+            yield item
+
+    def emit(self, kind: str = 'lake', **fields):
+        """Append the record of the extraction to the metrics file and return it."""
+        record = {'type': kind, 'run': self.run, 'time': datetime.now().isoformat(timespec='seconds'),
+                  **fields, 'elapsed': round(time() - self.time_start, 6),
+                  'stages': {k: round(v, 6) for k, v in self.stages.items()},
+                  'counters': self.counters, 'peak_rss_mb': round(peak_rss_mb(), 1)}
+        append_line(self.path, json.dumps(record))
+        return record
+
+class NullMetrics:
+    """Metrics which record nothing (the stages are a shared no-op context)."""
+
+    enabled = False
+    _context = nullcontext()
+
+    def stage(self, name: str):
+        return self._context
+
+    def count(self, name: str, value: int = 1):
+        return
+
+    def count_bytes(self, name: str, fields: dict):
+        return
+
+    def iterate(self, name: str, iterable):
+        return iterable
+
+    def emit(self, kind: str = 'lake', **fields):
+        return None
+
+NULL_METRICS = NullMetrics()
+
+def output_bytes(path):
+    """Return the size of an output file or store on disk in bytes (0 if missing)."""
+    if path.is_dir():
+        return sum(p.stat().st_size for p in path.rglob('*') if p.is_file())
+    return path.stat().st_size if path.exists() else 0
+
+def summarize_run(run: str, time_start: float, path=c.FN_METRICS, **fields):
+    """Append the summary of all records of a run (totals per stage and counter) and return it."""
+    records = []
+    if os.path.exists(path):
+        with open(path) as f:
+            records = [record for record in map(json.loads, filter(str.strip, f))
+                       if record.get('run') == run and record.get('type') != 'summary']
+    stages, counters = dict.fromkeys(STAGES, 0.0), {}
+    for record in records:
+        for k, v in record['stages'].items():
+            stages[k] = stages.get(k, 0.0) + v
+        for k, v in record['counters'].items():
+            counters[k] = counters.get(k, 0) + v
+    summary = {'type': 'summary', 'run': run, 'time': datetime.now().isoformat(timespec='seconds'), **fields,
+               'records': len(records),
+               'lakes': sum(len(record['lakeids']) if 'lakeids' in record else record['type'] == 'lake'
+                            for record in records),
+               'failed': sum(record.get('status') != 'ok' for record in records),
+               'elapsed': round(time() - time_start, 6), 'stages': {k: round(v, 6) for k, v in stages.items()},
+               'counters': counters,
+               'peak_rss_mb': max([record['peak_rss_mb'] for record in records], default=0.0)}
+    append_line(path, json.dumps(summary))
+    return summary
@@ -0,0 +1,485 @@
+# -*- coding: utf-8 -*-
+
+"""This module implements the concurrent OPeNDAP fetcher for daily lake subsets.
+
+The daily subsets are requested as DAP2 binary responses (.dods) over persistent
+HTTP connections (one per worker thread), decoded to numpy arrays and yielded in
+time order. Redirects are followed and transient failures are retried with exponential
+backoff. Fetched subsets can be kept in a size-bounded on-disk cache, so repeated runs
+only request missing days or variables.
+"""
+
+import os
+import re
+import hashlib
+import threading
+import http.client
+from time import time, sleep
+from urllib.parse import urlsplit, urlunsplit, urljoin
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+import netCDF4 as nc4
+from scripts import constants as c
+from scripts import ROOT
+from scripts.metrics import locked_fd
+
+DAP_TYPES = {'Byte': np.dtype('u1'), 'Int16': np.dtype('>i4'), 'UInt16': np.dtype('>u4'),
+             'Int32': np.dtype('>i4'), 'UInt32': np.dtype('>u4'),
+             'Float32': np.dtype('>f4'), 'Float64': np.dtype('>f8')}
+
+DAP_CASTS = {'Int16': np.int16, 'UInt16': np.uint16}
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+REDIRECT_STATUS = {301, 302, 303, 307, 308}
+
+CACHE_SIZE_FILE = 'size' # File in the cache directory holding the size of the entries (bytes)
+
+class DapError(Exception):
+    """Error raised for failed OPeNDAP requests."""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+    @property
+    def transient(self):
+        return self.status is None or self.status in RETRY_STATUS
+
+def opendap_dates(startdate: str, enddate: str):
+    """Return the daily dates of the timerange, raise ValueError if empty."""
+    date_range = pd.date_range(start=startdate, end=enddate, freq="D")
+
+    if len(date_range) == 0:
+        raise ValueError('Empty timerange provided!')
+
+    return date_range
+
+def opendap_url(date, bbox: tuple, variables: list):
+    """Return the OPeNDAP url of a day requesting lat, lon, time and the bbox of the variables.
+
+    Parameters
+    ----------
+    date : pd.Timestamp
+        Day to request
+    bbox : tuple
+        Bbox (i0, i1, j0, j1) of the lake
+    variables : list
+        Variables to request
+    Returns
+    -------
+    str
+        OPeNDAP url
+    """
+    i0, i1, j0, j1 = bbox
+    lat_range_str = f'[{i0}:1:{i1 - 1}]'
+    lon_range_str = f'[{j0}:1:{j1 - 1}]'
+    var_str = ''.join(',' + var + '[0:1:0]' + lat_range_str + lon_range_str for var in variables)
+
+    return (f'{c.URL_OPENDAP}/v{c.VERSION}/{date.year}/{date.month:02d}'
+            f'/ESACCI-LAKES-L3S-LK_PRODUCTS-MERGED-{date.strftime("%Y%m%d")}-fv{c.VERSION}.nc?'
+            f'lat{lat_range_str},lon{lon_range_str},time[0:1:0]{var_str}')
+
+def parse_dds(dds: str):
+    """Parse a DAP2 DDS and return the flat list of (type, name, shape) in transmission order."""
+    tokens = re.findall(r'[{}\[\];=:]|[^\s{}\[\];=:]+', dds)
+    pos = 0
+
+    def take(expected=None):
+        nonlocal pos
+        token = tokens[pos]
+        if expected is not None and token != expected:
+            raise DapError(f'Invalid DDS, expected "{expected}" but got "{token}"!')
+        pos += 1
+        return token
+
+    def declarations():
+        decls = []
+        while tokens[pos] != '}':
+            if tokens[pos] in ('ARRAY', 'MAPS'):
+                take()
+                take(':')
+                continue
+            decls.extend(declaration())
+        take('}')
+        take()  # name of the constructor
+        take(';')
+        return decls
+
+    def declaration():
+        dtype = take()
+        if dtype in ('Grid', 'Structure'):
+            take('{')
+            return declarations()
+        name, shape = take(), []
+        while tokens[pos] == '[':
+            take('[')
+            if tokens[pos + 1] == '=':
+                take()
+                take('=')
+            shape.append(int(take()))
+            take(']')
+        take(';')
+        return [(dtype, name, tuple(shape))]
+
+    take('Dataset')
+    take('{')
+    return declarations()
+
+def decode_dods(content: bytes):
+    """Decode a DAP2 binary response and return a dict of numpy arrays by variable name."""
+    sep = content.find(b'\nData:\n')
+    if sep < 0:
+        raise DapError('Invalid DAP2 response without data section!')
+    decls = parse_dds(content[:sep].decode('utf-8'))
+
+    arrays, offset = {}, sep + len(b'\nData:\n')
+    for dtype, name, shape in decls:
+        if dtype not in DAP_TYPES:
+            raise DapError(f'Unsupported DAP2 type {dtype} of {name}!')
+        count = int(np.prod(shape))
+        if shape:
+            offset += 8  # array length is sent twice
+        itemsize = DAP_TYPES[dtype].itemsize
+        data = np.frombuffer(content, dtype=DAP_TYPES[dtype], count=count, offset=offset)
+        offset += count * itemsize
+        if itemsize == 1:
+            offset += -count % 4  # bytes are padded to a multiple of four
+        data = data.astype(DAP_CASTS.get(dtype, data.dtype.newbyteorder('=')))
+        arrays[name] = data.reshape(shape)
+    return arrays
+
+def packed_invalid(field, attrs: dict):
+    """Return boolean array of packed values which are masked when read (fill, missing or out of valid range)."""
+    if '_FillValue' in attrs:
+        invalid = field == attrs['_FillValue']
+    elif field.dtype.itemsize > 1:
+        invalid = field == nc4.default_fillvals[field.dtype.str[1:]]
+    else:
+        invalid = np.zeros(field.shape, dtype=bool)
+    if 'missing_value' in attrs:
+        invalid |= np.isin(field, attrs['missing_value'])
+    valid_min, valid_max = attrs.get('valid_range', (attrs.get('valid_min'), attrs.get('valid_max')))
+    if valid_min is not None:
+        invalid |= field < valid_min
+    if valid_max is not None:
+        invalid |= field > valid_max
+    return invalid
+
+def unpack(field, attrs: dict):
+    """Return the masked array of a packed field as netCDF4 reads it (masked and scaled)."""
+    field = np.ma.masked_array(field, mask=packed_invalid(field, attrs))
+    if 'scale_factor' in attrs or 'add_offset' in attrs:
+        field = field * attrs.get('scale_factor', 1.0) + attrs.get('add_offset', 0.0)
+    return field
+
+class DapClient:
+    """Minimal DAP2 client reusing one persistent HTTP connection per thread and host.
+
+    Redirects (e.g. of a front-end to the THREDDS server) are followed, also to other hosts.
+    """
+
+    def __init__(self, timeout: float = c.OPENDAP_TIMEOUT):
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def connection(self, scheme, netloc):
+        conns = self.local.__dict__.setdefault('conns', {})
+        if (scheme, netloc) not in conns:
+            cls = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+            conns[(scheme, netloc)] = cls(netloc, timeout=self.timeout)
+        return conns[(scheme, netloc)]
+
+    def drop(self, scheme, netloc):
+        conn = self.local.__dict__.get('conns', {}).pop((scheme, netloc), None)
+        if conn is not None:
+            conn.close()
+
+    def request(self, url: str):
+        """Send a GET request over the persistent connection and return (status, body, location)."""
+        parts = urlsplit(url)
+        path = parts.path + (f'?{parts.query}' if parts.query else '')
+        conn = self.connection(parts.scheme, parts.netloc)
+        try:
+            conn.request('GET', path, headers={'Connection': 'keep-alive'})
+            response = conn.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException) as e:
+            self.drop(parts.scheme, parts.netloc)
+            raise DapError(f'Request to {url} failed: {e}') from e
+        if response.will_close or response.status not in (200, *REDIRECT_STATUS):
+            self.drop(parts.scheme, parts.netloc)
+        return response.status, body, response.getheader('Location')
+
+    def get(self, url: str, suffix: str):
+        """Request the url with the DAP2 suffix (.dods, .das, .dds) and return the body, following redirects."""
+        parts = urlsplit(url)
+        target = urlunsplit((parts.scheme, parts.netloc, parts.path + suffix, parts.query, ''))
+        for _ in range(c.OPENDAP_REDIRECTS + 1):
+            status, body, location = self.request(target)
+            if status not in REDIRECT_STATUS or location is None:
+                break
+            target = urljoin(target, location)
+        else:
+            raise DapError(f'Request to {url} exceeded {c.OPENDAP_REDIRECTS} redirects!', status)
+        if status != 200:
+            raise DapError(f'Request to {url} failed with status {status}!', status)
+        return body
+
+    def fetch(self, url: str):
+        """Fetch a daily subset and return the arrays by variable name and the response size."""
+        body = self.get(url, '.dods')
+        return decode_dods(body), len(body)
+
+    def attribute(self, url: str, name: str):
+        """Fetch a global attribute of the dataset from its DAS."""
+        das = self.get(url.split('?')[0], '.das').decode('utf-8')
+        match = re.search(rf'\b{re.escape(name)}\s+"((?:[^"\\]|\\.)*)"', das)
+        if match is None:
+            raise DapError(f'Attribute {name} not found for {url}!')
+        return match.group(1)
+
+class FetchStats:
+    """Throughput counters of a fetch stage."""
+
+    def __init__(self):
+        self.days = 0
+        self.bytes = 0
+        self.retries = 0
+        self.time_start = time()
+        self.lock = threading.Lock()
+
+    def add(self, days=0, nbytes=0, retries=0):
+        with self.lock:
+            self.days += days
+            self.bytes += nbytes
+            self.retries += retries
+
+    @property
+    def elapsed(self):
+        return time() - self.time_start
+
+    def __str__(self):
+        elapsed = max(self.elapsed, 1e-9)
+        return (f'{self.days} days in {elapsed:0.2f} seconds ({self.days / elapsed:0.2f} days/s, '
+                f'{self.bytes / elapsed / 1e6:0.2f} MB/s, {self.retries} retries)')
+
+class DapCache:
+    """Content-addressed on-disk cache of daily OPeNDAP subsets with LRU eviction.
+
+    Entries are keyed by (version, date, variable, i0:i1, j0:j1) and stored as .npy files.
+    The modification time of an entry is its last access, the least recently used entries
+    are evicted once the cache exceeds max_bytes. The size of the entries is kept in a file
+    updated under a lock by all processes, the entries are only listed to create it and to
+    evict entries.
+
+    Parameters
+    ----------
+    path : Path
+        Directory of the cache
+    max_bytes : int
+        Size cap of the cache in bytes
+    """
+
+    def __init__(self, path=None, max_bytes: int = c.CACHE_MAX_BYTES):
+        self.path = path or ROOT.joinpath(c.PATH_CACHE)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.path.mkdir(parents=True, exist_ok=True)
+        with self.locked_size() as fd:
+            self.size = self.read_size(fd)
+            if self.size is None:
+                self.size = sum(e[1] for e in self.entries())
+                self.write_size(fd, self.size)
+
+    @contextmanager
+    def locked_size(self):
+        """Hold an exclusive lock on the size file (shared between processes) and yield its descriptor."""
+        fd = os.open(self.path.joinpath(CACHE_SIZE_FILE), os.O_RDWR | os.O_CREAT)
+        try:
+            with locked_fd(fd):
+                yield fd
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def read_size(fd: int):
+        """Return the size stored in the size file, None if it is empty (newly created)."""
+        os.lseek(fd, 0, os.SEEK_SET)
+        content = os.read(fd, 64).strip()
+        return int(content) if content else None
+
+    @staticmethod
+    def write_size(fd: int, size: int):
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.ftruncate(fd, 0)
+        os.write(fd, str(size).encode())
+
+    def entries(self):
+        """Return list of (last access, size, path) of all entries."""
+        entries = []
+        for entry in self.path.rglob('*.npy'):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry))
+        return entries
+
+    def entry(self, date, variable: str, bbox: tuple):
+        i0, i1, j0, j1 = bbox
+        key = f'{c.VERSION}|{date.strftime("%Y-%m-%d")}|{variable}|{i0}:{i1}|{j0}:{j1}'
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return self.path.joinpath(digest[:2]).joinpath(f'{digest}.npy')
+
+    def get(self, date, variable: str, bbox: tuple):
+        """Return the cached array or None, count hits and misses."""
+        entry = self.entry(date, variable, bbox)
+        try:
+            array = np.load(entry)
+            os.utime(entry)
+        except (OSError, ValueError):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return array
+
+    def put(self, date, variable: str, bbox: tuple, array):
+        """Store an array in the cache and evict old entries if the size cap is exceeded."""
+        entry = self.entry(date, variable, bbox)
+        entry.parent.mkdir(exist_ok=True)
+        path_tmp = entry.with_name(f'{entry.stem}.{os.getpid()}.{threading.get_ident()}.tmp')
+        with open(path_tmp, 'wb') as f:
+            np.save(f, array)
+        size = path_tmp.stat().st_size
+        with self.lock, self.locked_size() as fd:
+            # An entry written again (e.g. by another process) replaces the previous one
+            try:
+                size -= entry.stat().st_size
+            except OSError:
+                pass
+            os.replace(path_tmp, entry)
+            self.size = self.read_size(fd)
+            if self.size is None:
+                self.size = sum(e[1] for e in self.entries())
+            else:
+                self.size += size
+            if self.size > self.max_bytes:
+                self.evict()
+            self.write_size(fd, self.size)
+
+    def evict(self):
+        """Delete least recently used entries until the cache is below 90% of its size cap.
+
+        Called with the lock of the size file held, the size is recounted from the entries.
+        """
+        entries = sorted(self.entries(), key=lambda e: e[0])
+        self.size = sum(e[1] for e in entries)
+        for _, size, entry in entries:
+            if self.size <= 0.9 * self.max_bytes:
+                break
+            try:
+                entry.unlink()
+                self.size -= size
+            except OSError:
+                pass
+
+    def __str__(self):
+        return (f'{self.hits} hits, {self.misses} misses, '
+                f'{self.size / 1e6:0.1f}/{self.max_bytes / 1e6:0.1f} MB')
+
+class DapFetcher:
+    """Fetch daily subsets concurrently with bounded parallelism, retries and an optional cache.
+
+    Parameters
+    ----------
+    workers : int
+        Number of concurrent requests
+    retries : int
+        Number of retries of a failed request
+    backoff : float
+        Initial backoff in seconds, doubled for each retry
+    client : DapClient
+        Client used for the requests
+    cache : DapCache
+        Cache of daily subsets, only missing days or variables are requested
+    """
+
+    def __init__(self, workers: int = c.OPENDAP_WORKERS, retries: int = c.OPENDAP_RETRIES,
+                 backoff: float = c.OPENDAP_BACKOFF, client: DapClient = None, cache: DapCache = None):
+        self.workers = max(1, workers)
+        self.retries = retries
+        self.backoff = backoff
+        self.client = client or DapClient()
+        self.cache = cache
+        self.stats = FetchStats()
+
+    def retry(self, func, *args):
+        """Call func, retrying transient failures with backoff."""
+        for attempt in range(self.retries + 1):
+            try:
+                return func(*args)
+            except DapError as e:
+                if not e.transient or attempt == self.retries:
+                    raise
+                self.stats.add(retries=1)
+                sleep(self.backoff * 2 ** attempt)
+
+    def fetch_one(self, date, bbox: tuple, variables: list):
+        """Fetch one daily subset, answering cached variables from the cache."""
+        arrays = {}
+        if self.cache is not None:
+            for v_name in ['time', *variables]:
+                array = self.cache.get(date, v_name, bbox)
+                if array is not None:
+                    arrays[v_name] = array
+
+        missing = [v_name for v_name in variables if v_name not in arrays]
+        if missing or 'time' not in arrays:
+            fetched, nbytes = self.retry(self.client.fetch, opendap_url(date, bbox, missing))
+            self.stats.add(nbytes=nbytes)
+            for v_name in ['time', *missing]:
+                arrays[v_name] = fetched[v_name]
+                if self.cache is not None:
+                    self.cache.put(date, v_name, bbox, fetched[v_name])
+
+        self.stats.add(days=1)
+        return arrays
+
+    def fetch(self, dates, bbox: tuple, variables: list):
+        """Yield the daily subsets of the dates in order while fetching ahead concurrently."""
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = deque()
+            dates = iter(dates)
+            for date in dates:
+                pending.append(executor.submit(self.fetch_one, date, bbox, variables))
+                if len(pending) >= 2 * self.workers:
+                    break
+            try:
+                while pending:
+                    arrays = pending.popleft().result()
+                    for date in dates:
+                        pending.append(executor.submit(self.fetch_one, date, bbox, variables))
+                        break
+                    yield arrays
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def attribute(self, date, bbox: tuple, name: str):
+        """Fetch a global attribute of a day, answered from the cache if available."""
+        if self.cache is not None:
+            value = self.cache.get(date, name, bbox)
+            if value is not None:
+                return str(value)
+        value = self.retry(self.client.attribute, opendap_url(date, bbox, []), name)
+        if self.cache is not None:
+            self.cache.put(date, name, bbox, np.array(value))
+        return value
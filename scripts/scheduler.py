@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+"""This module schedules the extraction of many lakes on a process pool.
+
+The extraction cost of each lake is estimated from its bbox area (lake index, or the
+data-availability table as fallback, if it has the bboxes) and the number of days. Lakes are dispatched
+largest-first, results are streamed as they finish and progress is logged with an ETA.
+"""
+
+from multiprocessing import Pool
+from contextlib import nullcontext
+from time import time
+import pandas as pd
+from scripts import constants as c
+from scripts.lakeindex import load_lake_index
+from scripts.lookup import load_lake_table
+from scripts.functions import data_extraction, log
+
+BOX_COLUMNS = ['lat_min_box', 'lat_max_box', 'lon_min_box', 'lon_max_box']
+
+def lake_costs(lakeids: list, startdate: str, enddate: str):
+    """Estimate the relative extraction cost of each lake.
+
+    Parameters
+    ----------
+    lakeids : list
+        CCI lake ids
+    startdate : str
+        Startdate of the timeseries in the form (YYYY-MM-DD)
+    enddate : str
+        Enddate of the timeseries in the form (YYYY-MM-DD)
+    Returns
+    -------
+    dict
+        Cost by lakeid, in grid cells read (plus a fixed overhead per daily file)
+    """
+    days = len(pd.date_range(startdate, enddate))
+    try:
+        lake_index = load_lake_index()
+        areas = {}
+        for lakeid in lakeids:
+            i0, i1, j0, j1 = lake_index.bbox_of(int(lakeid)) if int(lakeid) in lake_index \
+                else (0, 0, 0, 0)
+            areas[lakeid] = (i1 - i0) * (j1 - j0)
+    except ValueError:
+        # Without maskfile fall back to the bboxes of the data-availability table, only the
+        # table of v2.0.2 has them (otherwise all lakes cost the overhead of the daily files)
+        df = load_lake_table().set_index('id')
+        if not set(BOX_COLUMNS).issubset(df.columns):
+            return {lakeid: days * c.COST_DAY_CELLS for lakeid in lakeids}
+        cells_per_degree = 1 / c.GRID_RESOLUTION
+        areas = {lakeid: ((df.loc[lakeid, 'lat_max_box'] - df.loc[lakeid, 'lat_min_box'])
+                          * (df.loc[lakeid, 'lon_max_box'] - df.loc[lakeid, 'lon_min_box'])
+                          * cells_per_degree ** 2) if lakeid in df.index else 0
+                 for lakeid in lakeids}
+    return {lakeid: days * (areas[lakeid] + c.COST_DAY_CELLS) for lakeid in lakeids}
+
+def balance_groups(lakeids: list, costs: dict, n_groups: int):
+    """Split lakes into n_groups of similar total cost (largest-first to the cheapest group)."""
+    groups = [[] for _ in range(n_groups)]
+    totals = [0] * n_groups
+    for lakeid in sorted(lakeids, key=costs.get, reverse=True):
+        k = totals.index(min(totals))
+        groups[k].append(lakeid)
+        totals[k] += costs[lakeid]
+    return [group for group in groups if group]
+
+def timed_extraction(id_and_settings):
+    """Call data_extraction and return tuple in the form (id, filename, elapsed seconds)."""
+    time_start = time()
+    fn_output = data_extraction(id_and_settings)
+    return id_and_settings[0], fn_output, time() - time_start
+
+def run_scheduled(lakeids: list, settings: dict, n_processes: int, pool=None):
+    """Extract the lakes on a process pool, largest first, and log progress with ETA.
+
+    Parameters
+    ----------
+    lakeids : list
+        CCI lake ids to extract
+    settings : dict
+        Extraction settings as used by data_extraction
+    n_processes : int
+        Number of processes
+    pool : Pool
+        Running process pool to use (a pool of n_processes is created if None)
+    Returns
+    -------
+    list
+        Tuples in the form (id, filename, elapsed seconds) in order of completion,
+        filename is None for failed lakes
+    """
+    costs = lake_costs(lakeids, settings['startdate'], settings['enddate'])
+    order = sorted(lakeids, key=costs.get, reverse=True)
+    cost_total, cost_done = sum(costs.values()), 0
+    results = []
+
+    time_start = time()
+    with Pool(processes=n_processes, initializer=c.set_version, initargs=(c.VERSION,)) \
+            if pool is None else nullcontext(pool) as p:
+        for lakeid, fn_output, elapsed in p.imap_unordered(timed_extraction,
+                                                           map(lambda id: (id, settings), order)):
+            results.append((lakeid, fn_output, elapsed))
+            cost_done += costs[lakeid]
+            time_total = time() - time_start
+            eta = time_total * (cost_total - cost_done) / max(cost_done, 1)
+            status = 'Finished' if fn_output is not None else 'Failed'
+            log(f'{status} id: {lakeid} after {elapsed:0.1f}s ({len(results)}/{len(order)} lakes, '
+                f'{100 * cost_done / max(cost_total, 1):0.1f}% of estimated cost, ETA {eta:0.0f}s)')
+
+    return results
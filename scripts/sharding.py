@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+
+"""This module implements the time-sharded extraction of single (large) lakes.
+
+The daterange of a lake is split into yearly or monthly shards which are extracted in
+parallel processes into the temporary folder and merged into the final output in time order,
+the statistics tables of the shards are concatenated. Zarr outputs of the local extraction
+without statistics are not merged: the output store is created first and all shards write
+their days into it at once.
+"""
+
+import os
+from multiprocessing import Pool
+from contextlib import nullcontext
+import numpy as np
+import pandas as pd
+import netCDF4 as nc4
+from scripts import constants as c
+from scripts import ROOT
+from scripts.lakeindex import load_lake_index
+from scripts.functions import (extract_lake_subset, find_lakename, find_ncfiles, output_filename,
+                               statistics_filename, create_output, log)
+from scripts.zarrstore import ZarrStore, open_output, remove_output, replace_output
+from scripts.metrics import Metrics, NULL_METRICS
+
+SHARD_FREQS = {'year': 'YS', 'month': 'MS'}
+
+def shard_dateranges(startdate: str, enddate: str, shard: str = 'year'):
+    """Split the daterange into yearly or monthly shards and return list of (startdate, enddate)."""
+    if shard not in SHARD_FREQS:
+        raise ValueError(f'Unknown shard {shard}, use one of {list(SHARD_FREQS)}!')
+    start, end = pd.Timestamp(startdate), pd.Timestamp(enddate)
+    bounds = [start, *pd.date_range(start, end, freq=SHARD_FREQS[shard]).drop(start, errors='ignore'),
+              end + pd.Timedelta(days=1)]
+    return [(s0.strftime('%Y-%m-%d'), (s1 - pd.Timedelta(days=1)).strftime('%Y-%m-%d'))
+            for s0, s1 in zip(bounds[:-1], bounds[1:])]
+
+def large_lakes(lakeids: list, min_cells: int = c.SHARD_MIN_CELLS):
+    """Return the lakeids whose bbox has at least min_cells grid cells."""
+    lake_index = load_lake_index()
+    large = []
+    for lakeid in lakeids:
+        if int(lakeid) in lake_index:
+            i0, i1, j0, j1 = lake_index.bbox_of(int(lakeid))
+            if (i1 - i0) * (j1 - j0) >= min_cells:
+                large.append(lakeid)
+    return large
+
+def shard_extraction(shard_and_settings):
+    """Take tuple in the form (id, startdate, enddate, settings, run) and extract the shard into the temporary folder.
+
+    The metrics of the shard are recorded with the run id (None to disable). With incremental
+    set in the settings a shard of an interrupted run is reused or continued.
+    """
+    lakeid, startdate, enddate, settings, run = shard_and_settings
+    metrics = Metrics(run) if run is not None else NULL_METRICS
+    fn_shard = extract_lake_subset(lakeid=lakeid, startdate=startdate, enddate=enddate, temp=True,
+                                   metrics=metrics, **settings)
+    metrics.emit('shard', lakeid=lakeid, startdate=startdate, enddate=enddate, status='ok', output=fn_shard)
+    return fn_shard
+
+def shard_region_extraction(shard_and_settings):
+    """Take tuple in the form (id, startdate, enddate, region, settings, run) and write the shard into the store."""
+    lakeid, startdate, enddate, region, settings, run = shard_and_settings
+    metrics = Metrics(run) if run is not None else NULL_METRICS
+    fn_store = extract_lake_subset(lakeid=lakeid, startdate=startdate, enddate=enddate, region=region,
+                                   metrics=metrics, **settings)
+    metrics.emit('shard', lakeid=lakeid, startdate=startdate, enddate=enddate, status='ok', output=fn_store)
+    return fn_store
+
+def create_store(path_store, lakeid: int, lakename: str, path_ncfile, **settings):
+    """Create the Zarr output of a lake from its first daily file without any days."""
+    window = load_lake_index().window([lakeid])
+    with nc4.Dataset(path_ncfile, 'r') as nc_in, ZarrStore(path_store, 'w') as nc_out:
+        create_output(nc_out, nc_in, window, lakename, lakeid, settings.get('variables', c.DEFAULT_VARS),
+                      compress=settings.get('compress', True), complevel=settings.get('complevel', 4),
+                      chunk_time=settings.get('block_days', c.BLOCK_DAYS),
+                      layout=settings.get('layout', 'grid'))
+
+def merge_outputs(paths_shards: list, path_output, block_days: int = c.BLOCK_DAYS):
+    """Merge the outputs of consecutive shards into one output in time order.
+
+    Values are copied unscaled in blocks of block_days days, so the memory used does not
+    depend on the length of the shards.
+
+    Parameters
+    ----------
+    paths_shards : list
+        Paths of the shard outputs sorted by time
+    path_output : Path
+        Path of the merged output
+    block_days : int
+        Number of days copied at once
+    """
+    path_part = path_output.with_name(path_output.name + '.part')
+    with open_output(paths_shards[0], 'r') as nc_first, open_output(path_part, 'w') as nc_out:
+
+        # Recreate dims, vars and attributes of the first shard
+        nc_out.setncatts({k: nc_first.getncattr(k) for k in nc_first.ncattrs()})
+        for dname, the_dim in iter(nc_first.dimensions.items()):
+            nc_out.createDimension(dname, len(the_dim) if not the_dim.isunlimited() else None)
+        for v_name, varin in iter(nc_first.variables.items()):
+            filters = varin.filters()
+            chunking = varin.chunking()
+            outVar = nc_out.createVariable(v_name, varin.datatype, varin.dimensions,
+                                           zlib=filters['zlib'], complevel=filters['complevel'],
+                                           chunksizes=None if chunking == 'contiguous' else chunking)
+            outVar.setncatts({k: varin.getncattr(k) for k in varin.ncattrs()})
+            outVar.set_auto_maskandscale(False)
+            if 'time' not in varin.dimensions:
+                varin.set_auto_maskandscale(False)
+                outVar[...] = varin[...]
+
+        # Append the time-dependent variables of all shards
+        idx = 0
+        for path_shard in paths_shards:
+            with open_output(path_shard, 'r') as nc_shard:
+                nc_shard.set_auto_maskandscale(False)
+                n_days = len(nc_shard.dimensions['time'])
+                for v_name, varin in iter(nc_shard.variables.items()):
+                    if 'time' not in varin.dimensions:
+                        continue
+                    for k in range(0, n_days, max(1, block_days)):
+                        block = slice(k, min(k + block_days, n_days))
+                        nc_out[v_name][idx + block.start:idx + block.stop, ...] = varin[block, ...]
+                if 'time_coverage_end' in nc_shard.ncattrs():
+                    nc_out.time_coverage_end = nc_shard.time_coverage_end
+                idx += n_days
+
+    replace_output(path_part, path_output)
+
+def merge_statistics(paths_shards: list, path_statistics):
+    """Concatenate the statistics tables (.csv or .nc) of consecutive shards in time order.
+
+    Parameters
+    ----------
+    paths_shards : list
+        Paths of the statistics tables of the shards sorted by time
+    path_statistics : Path
+        Path of the merged table
+    """
+    path_part = path_statistics.with_name(path_statistics.name + '.part')
+    if path_statistics.suffix != '.csv':
+        # The columns are written at once as by LakeStatistics.write, so they get the same chunking
+        with nc4.Dataset(paths_shards[0], 'r') as nc_first, nc4.Dataset(path_part, 'w', format='NETCDF4') as nc_out:
+            nc_out.setncatts({k: nc_first.getncattr(k) for k in nc_first.ncattrs()})
+            nc_out.createDimension('time', None)
+            for v_name, varin in nc_first.variables.items():
+                attrs = {k: varin.getncattr(k) for k in varin.ncattrs()}
+                outVar = nc_out.createVariable(v_name, varin.datatype, ('time',), fill_value=attrs.pop('_FillValue', None))
+                outVar.setncatts(attrs)
+                outVar.set_auto_maskandscale(False)
+                columns = []
+                for path_shard in paths_shards:
+                    with nc4.Dataset(path_shard, 'r') as nc_shard:
+                        nc_shard.set_auto_maskandscale(False)
+                        columns.append(nc_shard[v_name][:])
+                outVar[:] = np.concatenate(columns)
+        os.replace(path_part, path_statistics)
+        return
+
+    with open(path_part, 'w') as f_out:
+        for k, path_shard in enumerate(paths_shards):
+            with open(path_shard) as f_shard:
+                header = f_shard.readline()
+                if k == 0:
+                    f_out.write(header)
+                f_out.writelines(f_shard)
+    os.replace(path_part, path_statistics)
+
+def extract_lake_sharded(lakeid: int, shard: str = 'year', n_processes: int = 4,
+                         startdate: str = c.DEFAULT_START, enddate: str = c.DEFAULT_END,
+                         temp: bool = False, verbose: bool = False, metrics_run: str = None, pool=None,
+                         **settings):
+    """Extract a lake by extracting shards of its daterange in parallel and merging them.
+
+    Parameters
+    ----------
+    lakeid : int
+        CCI lake id of lake to extract
+    shard : str
+        Split the daterange into shards per 'year' or 'month'
+    n_processes : int
+        Number of processes extracting shards
+    startdate : str
+        Startdate of the timeseries to extract in the form (YYYY-MM-DD)
+    enddate : str
+        Enddate of the timeseries to extract in the form (YYYY-MM-DD)
+    temp : bool
+        Put the merged output inside temporary folder
+    verbose : bool
+        Print status updates to console
+    metrics_run : str
+        Record the metrics of every shard with this run id (see metrics), nothing is recorded if None
+    pool : Pool
+        Running process pool to use (a pool of n_processes is created if None)
+    **settings
+        Further arguments of extract_lake_subset (variables, use_opendap, compress, statistics, ...),
+        with incremental the shards of an interrupted run are reused and a complete output is kept
+    Returns
+    -------
+    str
+        Filename of the extracted subset (of the statistics table if write_cube is False)
+    """
+    lakename = find_lakename(lakeid, interactive=False)
+    dateranges = shard_dateranges(startdate, enddate, shard)
+    if not settings.get('use_opendap', False):
+        # Skip shards without local files
+        dateranges = [(s0, s1) for s0, s1 in dateranges if len(find_ncfiles(s0, s1)) > 0]
+        if len(dateranges) == 0:
+            raise ValueError('No .nc files found for specified timerange!')
+
+    fn_output = output_filename(lakeid, lakename, settings.get('variables', c.DEFAULT_VARS),
+                                startdate, enddate, settings.get('layout', 'grid'),
+                                settings.get('backend', 'netcdf'))
+    path_temp = ROOT.joinpath(c.PATH_EXTRACTED).joinpath('temp')
+    path_output = (path_temp if temp else ROOT.joinpath(c.PATH_EXTRACTED)).joinpath(fn_output)
+    path_output.parent.mkdir(parents=True, exist_ok=True)
+    write_cube, statistics = settings.get('write_cube', True), settings.get('statistics')
+    if statistics is not None:
+        fn_statistics = statistics_filename(lakeid, lakename, startdate, enddate,
+                                            settings.get('min_quality'), statistics)
+
+    # Statistics cannot be extracted incrementally, so only the output of the cube can be complete
+    if settings.get('incremental', False) and write_cube and path_output.exists():
+        if verbose:
+            print(f'Lake {lakename} (ID{lakeid}) is already extracted to {fn_output}.')
+        return fn_output
+
+    if verbose:
+        print(f'Extracting Lake {lakename} (ID{lakeid}) in {len(dateranges)} shards '
+              f'using {n_processes} processes..')
+
+    # All shards write into the same store, each starting at the time index of its first file
+    if settings.get('backend', 'netcdf') == 'zarr' and not settings.get('use_opendap', False) \
+            and statistics is None:
+        paths_ncfiles = find_ncfiles(startdate, enddate)
+        offsets = np.cumsum([0, *[len(find_ncfiles(s0, s1)) for s0, s1 in dateranges[:-1]]])
+        path_part = path_output.with_name(path_output.name + '.part')
+        create_store(path_part, lakeid, lakename, paths_ncfiles[0], **settings)
+
+        with Pool(processes=n_processes, initializer=c.set_version, initargs=(c.VERSION,)) \
+            if pool is None else nullcontext(pool) as p:
+            p.map(shard_region_extraction, [(lakeid, s0, s1, (path_part, int(offset)), settings, metrics_run)
+                                            for (s0, s1), offset in zip(dateranges, offsets)], chunksize=1)
+
+        with nc4.Dataset(paths_ncfiles[-1], 'r') as nc_last, ZarrStore(path_part, 'r+') as nc_out:
+            nc_out.time_coverage_end = nc_last.time_coverage_end
+        replace_output(path_part, path_output)
+
+        if verbose:
+            print(f'Wrote {len(dateranges)} shards into {fn_output}.')
+        return fn_output
+
+    with Pool(processes=n_processes, initializer=c.set_version, initargs=(c.VERSION,)) \
+        if pool is None else nullcontext(pool) as p:
+        fns_shards = p.map(shard_extraction, [(lakeid, s0, s1, settings, metrics_run)
+                                              for s0, s1 in dateranges], chunksize=1)
+
+    paths_merged = []
+    if write_cube:
+        paths_shards = [path_temp.joinpath(fn_shard) for fn_shard in fns_shards]
+        merge_outputs(paths_shards, path_output, settings.get('block_days', c.BLOCK_DAYS))
+        paths_merged += [(paths_shards, path_output)]
+    if statistics is not None:
+        paths_shards = [path_temp.joinpath(statistics_filename(lakeid, lakename, s0, s1, settings.get('min_quality'),
+                                                               statistics)) for s0, s1 in dateranges]
+        merge_statistics(paths_shards, path_output.with_name(fn_statistics))
+        paths_merged += [(paths_shards, path_output.with_name(fn_statistics))]
+
+    for paths_shards, path_merged in paths_merged:
+        for path_shard in paths_shards:
+            if path_shard != path_merged:
+                remove_output(path_shard)
+
+    if verbose:
+        print(f'Merged {len(dateranges)} shards into {fn_output if write_cube else fn_statistics}.')
+
+    return fn_output if write_cube else fn_statistics
+
+def run_sharded(lakeids: list, settings: dict, n_processes: int, pool=None):
+    """Extract the lakes one after the other, each in time shards on n_processes processes.
+
+    Parameters
+    ----------
+    lakeids : list
+        CCI lake ids to extract
+    settings : dict
+        Extraction settings as used by data_extraction
+    n_processes : int
+        Number of processes
+    pool : Pool
+        Running process pool shared by the lakes (a pool of n_processes is created per lake if None)
+    Returns
+    -------
+    list
+        Filenames of the extracted subsets, None for failed lakes
+    """
+    keys = ['variables', 'use_opendap', 'opendap_workers', 'opendap_cache', 'compress', 'complevel',
+            'block_days', 'layout', 'skip_empty', 'backend', 'use_consolidated', 'incremental',
+            'statistics', 'min_quality', 'write_cube']
+    run = settings.get('run_id') if settings.get('metrics', False) else None
+    fns_output = []
+    for lakeid in lakeids:
+        log("Processing id: {} in {} shards".format(lakeid, settings['shard']))
+        # The stages are recorded per shard, the record of the lake holds the total time
+        metrics = Metrics(run) if run is not None else NULL_METRICS
+        try:
+            fns_output.append(extract_lake_sharded(lakeid, shard=settings['shard'], n_processes=n_processes,
+                                                   startdate=settings['startdate'],
+                                                   enddate=settings['enddate'],
+                                                   verbose=settings['verbose'], metrics_run=run, pool=pool,
+                                                   **{k: settings[k] for k in keys if k in settings}))
+        except:
+            log("Failed to process id: {}".format(lakeid), indent=1)
+            fns_output.append(None)
+        metrics.emit('lake', lakeid=int(lakeid), status='ok' if fns_output[-1] is not None else 'failed',
+                     output=fns_output[-1], sharded=True)
+    return fns_output
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+"""This module extracts all lakes of the local dataset within a memory budget.
+
+The lakes are packed into batches whose estimated memory fits into the budget of a process
+and which open at most max_open outputs at once. Every batch is extracted day-major (see
+engine), neighbouring lakes are packed together so their bands are shared. The memory of a
+batch is the block buffers of its lakes, the band read at once (max_band_cells is reduced
+to fit) and the chunk cache of its open outputs, which is lowered from the netCDF default
+(64 MB per variable) in the workers. A worker reads the next day only once the full blocks
+are written, so reading never runs ahead of writing by more than block_days, and the pool
+dispatches one batch at a time per worker. Lakes whose buffers alone exceed the budget are
+extracted alone with fewer days per block (and time chunk).
+
+The outputs of a batch are written as .part files and moved in place once the whole batch is
+complete, so an interrupted run (e.g. a killed worker) leaves no truncated outputs. With
+incremental set, a run skips the lakes whose output is complete and continues the .part files
+of the others. The lakes of failed batches are retried one by one.
+"""
+
+from multiprocessing import Pool
+from contextlib import nullcontext
+from time import time
+import numpy as np
+import netCDF4 as nc4
+from scripts import constants as c
+from scripts.lakeindex import load_lake_index
+from scripts.lakestats import STATISTICS_VARS
+from scripts import ROOT
+from scripts.functions import find_ncfiles, find_lakenames, output_filename, log
+from scripts.scheduler import lake_costs
+from scripts.engine import data_extraction_daymajor
+
+# Bytes per cell and variable of the temporaries of reading a band (packed and unpacked values
+# and the mask) and of writing a block (netCDF4 packs the values in double precision)
+TEMP_READ = 1
+TEMP_WRITE = 9
+
+def cell_bytes(variables: list, paths_ncfiles):
+    """Return the bytes per grid cell and variable of the unpacked (in memory) and packed values."""
+    with nc4.Dataset(paths_ncfiles[0], 'r') as nc_in:
+        return {v_name: (nc_in[v_name][0, 0:1, 0:1].dtype.itemsize, nc_in[v_name].dtype.itemsize)
+                for v_name in variables}
+
+def lake_memory(window, nbytes: dict, variables: list, block_days: int, layout: str = 'grid'):
+    """Estimate the bytes of the block buffers (with masks) of a lake and of writing one of its blocks."""
+    i0, i1, j0, j1 = window.bbox
+    cells = window.lakecells if layout == 'pixels' else (i1 - i0) * (j1 - j0)
+    per_day = cells * sum(nbytes[v_name][0] + 1 for v_name in variables)
+    return block_days * per_day, block_days * cells * TEMP_WRITE
+
+def plan_batches(lakeids: list, settings: dict, memory_mb: int = c.STREAM_MEMORY_MB, n_processes: int = 4,
+                 max_open: int = c.STREAM_MAX_OPEN):
+    """Pack the lakes into batches which fit into the memory budget of a process.
+
+    Parameters
+    ----------
+    lakeids : list
+        CCI lake ids to extract
+    settings : dict
+        Extraction settings as used by data_extraction
+    memory_mb : int
+        Memory budget of all processes in MB
+    n_processes : int
+        Number of processes
+    max_open : int
+        Maximum number of outputs of a batch open at once
+    Returns
+    -------
+    list
+        Tuples in the form (lakeids, block_days, max_band_cells) in order of the lakes in the grid
+    """
+    paths_ncfiles = find_ncfiles(settings['startdate'], settings['enddate'])
+    if len(paths_ncfiles) == 0:
+        raise ValueError('No .nc files found for specified timerange!')
+    variables = settings['variables']
+    read_vars = list(dict.fromkeys([*variables, *STATISTICS_VARS])) if settings.get('statistics') else variables
+    nbytes = cell_bytes(read_vars, paths_ncfiles)
+    block_days = settings.get('block_days', c.BLOCK_DAYS)
+    layout = settings.get('layout', 'grid')
+    write_cube = settings.get('write_cube', True)
+
+    # A quarter of the budget of a process is left for reading bands, the rest for the lakes
+    budget = (memory_mb / n_processes - c.STREAM_BASE_MB) * 1024**2
+    if budget <= 0:
+        raise ValueError(f'The memory budget of {memory_mb} MB is too small for {n_processes} processes!')
+    band_cell = sum(nbytes[v_name][0] + nbytes[v_name][1] + TEMP_READ for v_name in read_vars)
+    max_band_cells = int(min(c.MAX_BAND_CELLS, budget / 4 / band_cell))
+    budget_lakes = budget - max_band_cells * band_cell
+    cache = c.STREAM_CHUNK_CACHE * len(variables) if write_cube else 0
+
+    lake_index = load_lake_index()
+    windows = {lakeid: lake_index.window([lakeid]) for lakeid in lakeids}
+    batches, batch, total, peak_write = [], [], 0, 0
+    for lakeid in sorted(lakeids, key=lambda k: windows[k].bbox):
+        buffers, write = lake_memory(windows[lakeid], nbytes, variables if write_cube else [], block_days, layout)
+        if buffers + write + cache > budget_lakes:
+            # Extract alone with as many days per block as fit (at least one)
+            per_day = (buffers + write) / block_days
+            days = int(max(1, min(block_days, (budget_lakes - cache) // max(per_day, 1))))
+            batches.append(([lakeid], days, max_band_cells))
+            continue
+        if batch and (len(batch) >= max_open or total + buffers + cache + max(peak_write, write) > budget_lakes):
+            batches.append((batch, block_days, max_band_cells))
+            batch, total, peak_write = [], 0, 0
+        batch.append(lakeid)
+        total += buffers + cache
+        peak_write = max(peak_write, write)
+    if batch:
+        batches.append((batch, block_days, max_band_cells))
+    return batches
+
+def completed_lakes(lakeids: list, settings: dict):
+    """Return the lakeids whose output of the settings exists (only complete outputs are moved in place)."""
+    if not settings.get('write_cube', True):
+        return []
+    path_extracted = ROOT.joinpath(c.PATH_EXTRACTED)
+    return [lakeid for lakeid, lakename in zip(lakeids, find_lakenames(lakeids))
+            if path_extracted.joinpath(output_filename(lakeid, lakename, settings['variables'], settings['startdate'],
+                                                       settings['enddate'], settings.get('layout', 'grid'),
+                                                       settings.get('backend', 'netcdf'))).exists()]
+
+def init_worker(chunk_cache: int, version: str = c.VERSION):
+    """Set the dataset version and lower the chunk cache of the outputs opened by the worker."""
+    c.set_version(version)
+    nc4.set_chunk_cache(chunk_cache)
+
+def stream_batch(batch_and_settings):
+    """Take tuple in the form ((lakeids, block_days, max_band_cells), settings), extract the batch day-major.
+
+    Returns tuple in the form (lakeids, filenames or None if failed, elapsed seconds).
+    """
+    (lakeids, block_days, max_band_cells), settings = batch_and_settings
+    time_start = time()
+    fns_output = data_extraction_daymajor((lakeids, {**settings, 'block_days': block_days,
+                                                     'max_band_cells': max_band_cells}))
+    return lakeids, fns_output, time() - time_start
+
+def run_streaming(lakeids: list, settings: dict, n_processes: int, memory_mb: int = c.STREAM_MEMORY_MB,
+                  max_open: int = c.STREAM_MAX_OPEN, pool=None):
+    """Extract the lakes in memory-bounded batches on a process pool and log progress with ETA.
+
+    Parameters
+    ----------
+    lakeids : list
+        CCI lake ids to extract, lakes which are not in the lakemask are reported as failed
+    settings : dict
+        Extraction settings as used by data_extraction (local dataset only)
+    n_processes : int
+        Number of processes
+    memory_mb : int
+        Memory budget of all processes in MB
+    max_open : int
+        Maximum number of outputs open at once per process
+    pool : Pool
+        Running process pool to use, its workers should be initialized with init_worker
+        (a pool of n_processes is created if None)
+    Returns
+    -------
+    list
+        Tuples in the form (lakeids, filenames, elapsed seconds) per batch in order of completion,
+        filenames is None for failed batches (the lakes of failed batches are retried alone)
+    """
+    if settings.get('use_opendap', False):
+        raise ValueError('The streaming extraction is only supported for the local dataset!')
+
+    lake_index = load_lake_index()
+    unknown = [lakeid for lakeid in lakeids if int(lakeid) not in lake_index]
+    if len(unknown) > 0:
+        log(f'Failed {len(unknown)} ids not found in the maskfile: {unknown}')
+    lakeids = [int(lakeid) for lakeid in lakeids if int(lakeid) in lake_index]
+
+    # Lakes whose output is complete are not extracted again when resuming
+    if settings.get('incremental', False):
+        completed = set(completed_lakes(lakeids, settings))
+        if len(completed) > 0:
+            log(f'Skipping {len(completed)} lakes with complete output')
+        lakeids = [lakeid for lakeid in lakeids if lakeid not in completed]
+
+    batches = plan_batches(lakeids, settings, memory_mb, n_processes, max_open)
+    reduced = [batch for batch in batches if batch[1] < settings.get('block_days', c.BLOCK_DAYS)]
+    log(f'Streaming {len(lakeids)} lakes in {len(batches)} batches within {memory_mb} MB '
+        f'({len(reduced)} large lakes with fewer days per block)')
+
+    # Dispatch the most expensive batches first
+    costs = lake_costs(lakeids, settings['startdate'], settings['enddate'])
+    batch_costs = [sum(costs[lakeid] for lakeid in batch[0]) for batch in batches]
+    order = np.argsort(batch_costs, kind='stable')[::-1]
+    cost_total, cost_done = sum(batch_costs), 0
+    results = []
+
+    time_start = time()
+    with Pool(processes=n_processes, initializer=init_worker, initargs=(c.STREAM_CHUNK_CACHE, c.VERSION),
+              maxtasksperchild=c.STREAM_TASKS_PER_CHILD) if pool is None else nullcontext(pool) as p:
+        tasks = ((batches[k], settings) for k in order)
+        for batch_lakeids, fns_output, elapsed in p.imap_unordered(stream_batch, tasks):
+            results.append((batch_lakeids, fns_output, elapsed))
+            cost_done += sum(costs[lakeid] for lakeid in batch_lakeids)
+            time_total = time() - time_start
+            eta = time_total * (cost_total - cost_done) / max(cost_done, 1)
+            status = 'Finished' if fns_output is not None else 'Failed'
+            log(f'{status} {len(batch_lakeids)} ids after {elapsed:0.1f}s ({len(results)}/{len(batches)} '
+                f'batches, {100 * cost_done / max(cost_total, 1):0.1f}% of estimated cost, ETA {eta:0.0f}s)')
+
+        # Retry the lakes of failed batches alone, so one lake cannot fail the others of its batch
+        batch_of = {lakeid: batch for batch in batches for lakeid in batch[0]}
+        retries = [([lakeid], *batch_of[lakeid][1:]) for batch_lakeids, fns_output, _ in results
+                   if fns_output is None and len(batch_lakeids) > 1 for lakeid in batch_lakeids]
+        if len(retries) > 0:
+            log(f'Retrying {len(retries)} ids of failed batches one by one')
+            results = [result for result in results if result[1] is not None or len(result[0]) == 1]
+            for batch_lakeids, fns_output, elapsed in p.imap_unordered(stream_batch,
+                                                                       ((batch, settings) for batch in retries)):
+                results.append((batch_lakeids, fns_output, elapsed))
+                status = 'Finished' if fns_output is not None else 'Failed'
+                log(f'{status} {len(batch_lakeids)} ids after {elapsed:0.1f}s (retry)')
+
+    failed = [lakeid for batch_lakeids, fns_output, _ in results if fns_output is None for lakeid in batch_lakeids]
+    if len(failed) > 0:
+        log(f'Failed {len(failed)} ids, their partial outputs are continued by a run with incremental set: {failed}')
+
+    return results
@@ -0,0 +1,450 @@
+# -*- coding: utf-8 -*-
+
+"""This module writes and reads extracted subsets as Zarr (v2) directory stores.
+
+Every chunk of a variable is a separate zlib-compressed file, so a pixel time series is read
+without decompressing whole day-planes and several processes can write disjoint time ranges of
+the same store at once. Chunks which are only partly written (e.g. at the border of a time shard)
+and the growth of the time axis are updated under a lock on the variable directory. ZarrStore
+implements the part of the netCDF4.Dataset interface used by the extraction (dimensions, variables,
+attributes, masked and scaled reads and writes), the stores can be opened with xarray or zarr.
+"""
+
+import os
+import json
+import zlib
+import shutil
+import itertools
+from contextlib import contextmanager
+import numpy as np
+import netCDF4 as nc4
+from scripts.opendap import unpack
+from scripts.metrics import locked_fd
+
+ZARR_FORMAT = 2
+CHUNK_UNLIMITED = 1024 # Chunk size along unlimited dimensions if no chunksizes are given
+KEY_UNLIMITED = '_unlimited_dimensions' # Group attribute listing the unlimited dimensions
+
+def to_json(value):
+    """Convert a (numpy) attribute value to a JSON serializable value."""
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def write_json(path, obj):
+    """Write obj as JSON to a temporary file and move it in place once complete."""
+    path_tmp = path.with_name(f'{path.name}.tmp-{os.getpid()}')
+    with open(path_tmp, 'w') as f:
+        json.dump(obj, f, indent=2)
+    os.replace(path_tmp, path)
+
+def read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+@contextmanager
+def locked(path_dir):
+    """Hold an exclusive lock on a directory of the store (shared between processes).
+
+    Directories cannot be opened on Windows, there the lock is held on a .lock file inside it.
+    """
+    if os.name == 'nt':
+        fd = os.open(path_dir.joinpath('.lock'), os.O_RDWR | os.O_CREAT)
+    else:
+        fd = os.open(path_dir, os.O_RDONLY)
+    try:
+        with locked_fd(fd):
+            yield
+    finally:
+        os.close(fd)
+
+def selection(key, shape: tuple, clip: bool = True):
+    """Convert an index key into (starts, stops, squeezed axes), only unit steps are supported."""
+    key = key if isinstance(key, tuple) else (key,)
+    n_ellipsis = sum(k is Ellipsis for k in key)
+    if n_ellipsis > 1:
+        raise IndexError('Only one Ellipsis is allowed!')
+    if n_ellipsis == 1:
+        pos = next(k for k, item in enumerate(key) if item is Ellipsis)
+        key = key[:pos] + (slice(None),) * (len(shape) - len(key) + 1) + key[pos + 1:]
+    key = key + (slice(None),) * (len(shape) - len(key))
+    if len(key) != len(shape):
+        raise IndexError(f'Too many indices for variable of shape {shape}!')
+
+    starts, stops, squeeze = [], [], []
+    for axis, (k, n) in enumerate(zip(key, shape)):
+        if isinstance(k, (int, np.integer)):
+            start = int(k) + n if k < 0 else int(k)
+            stop = start + 1
+            squeeze.append(axis)
+        elif isinstance(k, slice):
+            if k.step not in (None, 1):
+                raise IndexError('Only slices with step 1 are supported!')
+            start = 0 if k.start is None else (k.start + n if k.start < 0 else k.start)
+            stop = n if k.stop is None else (k.stop + n if k.stop < 0 else k.stop)
+        else:
+            raise IndexError(f'Unsupported index {k}!')
+        if clip:
+            start, stop = min(max(start, 0), n), min(max(stop, 0), n)
+        starts.append(start)
+        stops.append(max(start, stop))
+    return starts, stops, tuple(squeeze)
+
+class ZarrDimension:
+    """Dimension of a store (length of the variables along it)."""
+
+    def __init__(self, store, name: str):
+        self.store = store
+        self.name = name
+
+    def __len__(self):
+        sizes = [var.shape[var.dimensions.index(self.name)]
+                 for var in self.store.variables.values() if self.name in var.dimensions]
+        return max(sizes, default=self.store._sizes.get(self.name) or 0)
+
+    def isunlimited(self):
+        return self.name in self.store._unlimited
+
+class ZarrVariable:
+    """Variable of a store, indexed like a netCDF4.Variable."""
+
+    def __init__(self, store, name: str):
+        object.__setattr__(self, '_path', store.path.joinpath(name))
+        object.__setattr__(self, '_store', store)
+        object.__setattr__(self, 'name', name)
+        object.__setattr__(self, '_auto', True)
+        self._load()
+
+    def _load(self):
+        meta = read_json(self._path.joinpath('.zarray'))
+        attrs = read_json(self._path.joinpath('.zattrs'))
+        object.__setattr__(self, '_meta', meta)
+        object.__setattr__(self, 'dimensions', tuple(attrs.pop('_ARRAY_DIMENSIONS')))
+        object.__setattr__(self, '_attrs', attrs)
+
+    def __getattr__(self, name):
+        attrs = self.__dict__.get('_attrs', {})
+        if name in attrs:
+            return attrs[name]
+        if name == '_FillValue' and self._meta['fill_value'] is not None:
+            return self.getncattr(name)
+        raise AttributeError(f'Variable {self.__dict__.get("name")} has no attribute {name}!')
+
+    def __setattr__(self, name, value):
+        self.setncatts({name: value})
+
+    @property
+    def dtype(self):
+        return np.dtype(self._meta['dtype'])
+
+    @property
+    def datatype(self):
+        return self.dtype
+
+    @property
+    def shape(self):
+        return tuple(self._meta['shape'])
+
+    @property
+    def chunks(self):
+        return tuple(self._meta['chunks'])
+
+    @property
+    def fill_value(self):
+        """Value of unwritten cells (the netCDF default fill if the variable has no _FillValue)."""
+        fill_value = self._meta['fill_value']
+        if fill_value is None:
+            return np.array(nc4.default_fillvals[self.dtype.str[1:]]).astype(self.dtype)
+        return np.array(fill_value).astype(self.dtype)
+
+    def ncattrs(self):
+        return list(self._attrs) + (['_FillValue'] if self._meta['fill_value'] is not None else [])
+
+    def getncattr(self, name):
+        if name == '_FillValue' and self._meta['fill_value'] is not None:
+            return self.fill_value[()]
+        value = self._attrs[name]
+        return np.array(value) if isinstance(value, list) else value
+
+    def setncatts(self, attrs: dict):
+        """Set attributes, _FillValue is stored as fill value of the array."""
+        attrs = dict(attrs)
+        with locked(self._path):
+            if '_FillValue' in attrs:
+                self._meta['fill_value'] = to_json(np.array(attrs.pop('_FillValue')).astype(self.dtype)[()])
+                write_json(self._path.joinpath('.zarray'), self._meta)
+            disk = read_json(self._path.joinpath('.zattrs'))
+            disk.update({k: to_json(v) for k, v in attrs.items()})
+            write_json(self._path.joinpath('.zattrs'), disk)
+        self._load()
+
+    def set_auto_maskandscale(self, flag: bool):
+        object.__setattr__(self, '_auto', bool(flag))
+
+    def filters(self):
+        compressor = self._meta['compressor']
+        return {'zlib': compressor is not None, 'shuffle': False, 'fletcher32': False,
+                'complevel': compressor['level'] if compressor else 0}
+
+    def chunking(self):
+        return list(self.chunks)
+
+    def chunk_path(self, index: tuple):
+        return self._path.joinpath('.'.join(str(i) for i in index) if index else '0')
+
+    def read_chunk(self, index: tuple):
+        """Return the raw values of a chunk (fill value if not written)."""
+        path_chunk = self.chunk_path(index)
+        if not path_chunk.exists():
+            return np.full(self.chunks, self.fill_value, dtype=self.dtype)
+        with open(path_chunk, 'rb') as f:
+            data = f.read()
+        if self._meta['compressor'] is not None:
+            data = zlib.decompress(data)
+        return np.frombuffer(data, dtype=self.dtype).reshape(self.chunks).copy()
+
+    def write_chunk(self, index: tuple, chunk):
+        """Write the raw values of a chunk to a temporary file and move it in place."""
+        data = np.ascontiguousarray(chunk, dtype=self.dtype).tobytes()
+        if self._meta['compressor'] is not None:
+            data = zlib.compress(data, self._meta['compressor']['level'])
+        path_chunk = self.chunk_path(index)
+        path_tmp = path_chunk.with_name(f'{path_chunk.name}.tmp-{os.getpid()}')
+        with open(path_tmp, 'wb') as f:
+            f.write(data)
+        os.replace(path_tmp, path_chunk)
+
+    def chunk_indices(self, starts: list, stops: list):
+        """Return the indices of all chunks overlapping the selection."""
+        return itertools.product(*[range(start // chunk, -(-stop // chunk))
+                                   for start, stop, chunk in zip(starts, stops, self.chunks)])
+
+    def __getitem__(self, key):
+        starts, stops, squeeze = selection(key, self.shape)
+        out = np.empty([stop - start for start, stop in zip(starts, stops)], dtype=self.dtype)
+        if out.size > 0:
+            for index in self.chunk_indices(starts, stops):
+                lo = [max(start, i * chunk) for start, i, chunk in zip(starts, index, self.chunks)]
+                hi = [min(stop, (i + 1) * chunk) for stop, i, chunk in zip(stops, index, self.chunks)]
+                chunk = self.read_chunk(index)
+                out[tuple(slice(l - s, h - s) for l, h, s in zip(lo, hi, starts))] = \
+                    chunk[tuple(slice(l - i * c, h - i * c) for l, h, i, c in zip(lo, hi, index, self.chunks))]
+        out = out.reshape([n for axis, n in enumerate(out.shape) if axis not in squeeze])
+        if not self._auto:
+            return out
+        attrs = {k: self.getncattr(k) for k in self.ncattrs()}
+        return unpack(out, attrs)
+
+    def encode(self, value):
+        """Return the raw values of value (masked values are filled, scaled values are packed)."""
+        if not self._auto:
+            return np.asarray(value).astype(self.dtype, casting='unsafe')
+        value = np.ma.asarray(value)
+        mask = np.ma.getmaskarray(value)
+        data = np.ma.getdata(value)
+        if 'scale_factor' in self._attrs or 'add_offset' in self._attrs:
+            data = (data - self._attrs.get('add_offset', 0.0)) / self._attrs.get('scale_factor', 1.0)
+            if self.dtype.kind in 'iu':
+                data = np.around(data)
+        if mask.any():
+            data = np.where(mask, 0, data)
+        data = np.asarray(data).astype(self.dtype, casting='unsafe')
+        if mask.any():
+            data[mask] = self.fill_value
+        return data
+
+    def grow(self, stops: list):
+        """Extend the unlimited dimensions to stops (the store may be written by other processes)."""
+        with locked(self._path):
+            meta = read_json(self._path.joinpath('.zarray'))
+            shape = [max(n, stop) if dim in self._store._unlimited else n
+                     for n, stop, dim in zip(meta['shape'], stops, self.dimensions)]
+            if shape != meta['shape']:
+                meta['shape'] = shape
+                write_json(self._path.joinpath('.zarray'), meta)
+            self._meta['shape'] = shape
+
+    def __setitem__(self, key, value):
+        starts, stops, squeeze = selection(key, self.shape, clip=False)
+        if any(stop > n for stop, n in zip(stops, self.shape)):
+            self.grow(stops)
+            starts, stops, squeeze = selection(key, self.shape)
+        size = [stop - start for start, stop in zip(starts, stops)]
+        data = np.broadcast_to(self.encode(value),
+                               [n for axis, n in enumerate(size) if axis not in squeeze]).reshape(size)
+
+        for index in self.chunk_indices(starts, stops):
+            lo = [max(start, i * chunk) for start, i, chunk in zip(starts, index, self.chunks)]
+            hi = [min(stop, (i + 1) * chunk) for stop, i, chunk in zip(stops, index, self.chunks)]
+            part = data[tuple(slice(l - s, h - s) for l, h, s in zip(lo, hi, starts))]
+            inner = tuple(slice(l - i * c, h - i * c) for l, h, i, c in zip(lo, hi, index, self.chunks))
+            # Chunks along unlimited dimensions are only complete if fully covered, they may be
+            # continued by another writer
+            full = all(l == i * c and (h == (i + 1) * c or (h == n and dim not in self._store._unlimited))
+                       for l, h, i, c, n, dim in zip(lo, hi, index, self.chunks, self.shape, self.dimensions))
+            if full:
+                chunk = np.full(self.chunks, self.fill_value, dtype=self.dtype)
+                chunk[inner] = part
+                self.write_chunk(index, chunk)
+                continue
+            with locked(self._path):
+                chunk = self.read_chunk(index)
+                chunk[inner] = part
+                self.write_chunk(index, chunk)
+
+class ZarrStore:
+    """Zarr (v2) directory store with the interface of a netCDF4.Dataset used by the extraction.
+
+    Parameters
+    ----------
+    path : Path
+        Directory of the store
+    mode : str
+        'r' to read, 'r+' to modify an existing store, 'w' to create a new store (replacing an existing one)
+    """
+
+    def __init__(self, path, mode: str = 'r'):
+        object.__setattr__(self, 'path', path)
+        object.__setattr__(self, 'mode', mode)
+        object.__setattr__(self, '_sizes', {})
+        object.__setattr__(self, 'variables', {})
+        if mode == 'w':
+            shutil.rmtree(path, ignore_errors=True)
+            path.mkdir(parents=True)
+            write_json(path.joinpath('.zgroup'), {'zarr_format': ZARR_FORMAT})
+            write_json(path.joinpath('.zattrs'), {KEY_UNLIMITED: []})
+        elif not path.joinpath('.zgroup').exists():
+            raise OSError(f'{path} is not a Zarr store!')
+        object.__setattr__(self, '_attrs', read_json(path.joinpath('.zattrs')))
+        object.__setattr__(self, '_unlimited', self._attrs.pop(KEY_UNLIMITED, []))
+        for path_var in sorted(path.iterdir()):
+            if path_var.joinpath('.zarray').exists():
+                self.variables[path_var.name] = ZarrVariable(self, path_var.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getitem__(self, name):
+        return self.variables[name]
+
+    def __getattr__(self, name):
+        attrs = self.__dict__.get('_attrs', {})
+        if name in attrs:
+            return attrs[name]
+        raise AttributeError(f'Store has no attribute {name}!')
+
+    def __setattr__(self, name, value):
+        self.setncatts({name: value})
+
+    @property
+    def dimensions(self):
+        names = list(self._sizes)
+        for var in self.variables.values():
+            names += [dim for dim in var.dimensions if dim not in names]
+        return {name: ZarrDimension(self, name) for name in names}
+
+    def ncattrs(self):
+        return list(self._attrs)
+
+    def getncattr(self, name):
+        value = self._attrs[name]
+        return np.array(value) if isinstance(value, list) else value
+
+    def setncatts(self, attrs: dict):
+        """Set global attributes (merged with the attributes written by other processes)."""
+        with locked(self.path):
+            disk = read_json(self.path.joinpath('.zattrs'))
+            disk.update({k: to_json(v) for k, v in attrs.items()})
+            write_json(self.path.joinpath('.zattrs'), disk)
+        disk.pop(KEY_UNLIMITED, None)
+        object.__setattr__(self, '_attrs', disk)
+
+    def set_auto_maskandscale(self, flag: bool):
+        for var in self.variables.values():
+            var.set_auto_maskandscale(flag)
+
+    def createDimension(self, name: str, size: int = None):
+        self._sizes[name] = size
+        if size is None and name not in self._unlimited:
+            self._unlimited.append(name)
+            with locked(self.path):
+                disk = read_json(self.path.joinpath('.zattrs'))
+                disk[KEY_UNLIMITED] = self._unlimited
+                write_json(self.path.joinpath('.zattrs'), disk)
+        return ZarrDimension(self, name)
+
+    def createVariable(self, name: str, datatype, dimensions: tuple = (), zlib: bool = False,
+                       complevel: int = 4, chunksizes: tuple = None, fill_value=None):
+        """Create a variable, chunked by chunksizes (full dimensions and CHUNK_UNLIMITED along unlimited ones).
+
+        Like netCDF4 the variable only has a _FillValue if fill_value is given, unwritten cells of
+        variables without are the netCDF default fill.
+        """
+        dtype = np.dtype(datatype)
+        shape = [0 if dim in self._unlimited else int(self._sizes.get(dim) or len(self.dimensions[dim]))
+                 for dim in dimensions]
+        if chunksizes is None:
+            chunksizes = [CHUNK_UNLIMITED if dim in self._unlimited else max(1, n)
+                          for dim, n in zip(dimensions, shape)]
+        path_var = self.path.joinpath(name)
+        path_var.mkdir()
+        write_json(path_var.joinpath('.zarray'), {
+            'zarr_format': ZARR_FORMAT, 'shape': shape, 'chunks': [int(k) for k in chunksizes],
+            'dtype': dtype.newbyteorder('<').str if dtype.byteorder not in '|' else dtype.str,
+            'compressor': {'id': 'zlib', 'level': int(complevel)} if zlib else None,
+            'fill_value': None if fill_value is None else to_json(np.array(fill_value).astype(dtype)[()]),
+            'order': 'C', 'filters': None})
+        write_json(path_var.joinpath('.zattrs'), {'_ARRAY_DIMENSIONS': list(dimensions)})
+        self.variables[name] = ZarrVariable(self, name)
+        return self.variables[name]
+
+    def sync(self):
+        """Nothing to flush, every chunk is written to disk at once."""
+        return
+
+    def close(self):
+        """Write the consolidated metadata (read by xarray.open_zarr in one request)."""
+        if self.mode == 'r':
+            return
+        metadata = {key: read_json(self.path.joinpath(key)) for key in ['.zgroup', '.zattrs']}
+        for path_var in sorted(self.path.iterdir()):
+            for key in ['.zarray', '.zattrs']:
+                if path_var.joinpath(key).exists():
+                    metadata[f'{path_var.name}/{key}'] = read_json(path_var.joinpath(key))
+        write_json(self.path.joinpath('.zmetadata'), {'zarr_consolidated_format': 1, 'metadata': metadata})
+
+def is_zarr(path):
+    """Check if the path is a Zarr store (by its name, also for partial stores) and return boolean."""
+    return '.zarr' in path.suffixes
+
+def open_output(path, mode: str = 'r'):
+    """Open an output as ZarrStore or netCDF4.Dataset depending on its name."""
+    if is_zarr(path):
+        return ZarrStore(path, mode)
+    return nc4.Dataset(path, mode, format='NETCDF4')
+
+def remove_output(path):
+    """Remove an output file or store if it exists."""
+    if path.is_dir():
+        shutil.rmtree(path)
+    else:
+        path.unlink(missing_ok=True)
+
+def copy_output(path_src, path_dst):
+    """Copy an output file or store."""
+    remove_output(path_dst)
+    if path_src.is_dir():
+        shutil.copytree(path_src, path_dst)
+    else:
+        shutil.copy2(path_src, path_dst)
+
+def replace_output(path_src, path_dst):
+    """Move an output file or store in place of path_dst."""
+    if path_src.is_dir():
+        remove_output(path_dst)
+    os.replace(path_src, path_dst)
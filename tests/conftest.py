@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+"""Fixtures of the tests: a small synthetic dataset and a stand-in OPeNDAP server serving it."""
+
+import re
+import threading
+from time import sleep
+from pathlib import Path
+from urllib.parse import unquote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import netCDF4 as nc4
+import pytest
+from scripts import constants as c
+from benchmarks.synthetic import make_dataset
+from benchmarks.benchmark import use_dataset
+
+# DAP2 type and transmitted dtype of the netCDF dtypes (16 bit integers are sent as 32 bit)
+DAP_TYPES = {'i1': ('Byte', 'u1'), 'u1': ('Byte', 'u1'), 'i2': ('Int16', '>i4'), 'u2': ('UInt16', '>u4'),
+             'i4': ('Int32', '>i4'), 'u4': ('UInt32', '>u4'), 'f4': ('Float32', '>f4'), 'f8': ('Float64', '>f8')}
+
+PATH_THREDDS = '/thredds/dodsC/esacci/lakes/data/lake_products/L3S'
+
+def encode_dods(arrays: dict, name: str = 'test'):
+    """Encode arrays by variable name as DAP2 binary response (DDS, separator and XDR data)."""
+    dds = ['Dataset {']
+    for v_name, (dims, array) in arrays.items():
+        shape = ''.join(f'[{dim} = {n}]' for dim, n in zip(dims, array.shape))
+        dds.append(f'    {DAP_TYPES[array.dtype.str[1:]][0]} {v_name}{shape};')
+    dds.append(f'}} {name};')
+    body = ['\n'.join(dds).encode(), b'\nData:\n']
+    for dims, array in arrays.values():
+        dap_type, dtype = DAP_TYPES[array.dtype.str[1:]]
+        data = array.view('u1') if dap_type == 'Byte' else array.astype(dtype)
+        if array.ndim > 0:
+            body.append(np.array([data.size, data.size], '>u4').tobytes())
+        body.append(data.tobytes())
+        if dap_type == 'Byte':
+            body.append(b'\0' * (-data.size % 4))
+    return b''.join(body)
+
+def parse_constraint(constraint: str, nc_in):
+    """Return the requested variables with their index keys, all variables without constraint."""
+    if not constraint:
+        return {v_name: () for v_name in nc_in.variables}
+    projection = {}
+    for item in constraint.split(','):
+        v_name, ranges = re.match(r'([\w.]+)((?:\[[^\]]*\])*)$', item).groups()
+        key = []
+        for r in re.findall(r'\[([^\]]*)\]', ranges):
+            # [index], [start:stop] or [start:step:stop] with inclusive stop
+            start, *step, stop = [int(k) for k in r.split(':') * (2 if ':' not in r else 1)]
+            key.append(slice(start, stop + 1, step[0] if step else 1))
+        projection[v_name.split('.')[-1]] = tuple(key)
+    return projection
+
+def encode_das(nc_in):
+    """Encode the attributes of a file as DAS (bytes are sent unsigned, marked with _Unsigned)."""
+    def attribute(name, value, signed_byte=False):
+        if isinstance(value, str):
+            return f'        String {name} "{value}";'
+        value = np.atleast_1d(value)
+        if signed_byte:
+            value = value.astype('i1').view('u1')
+        values = ', '.join(repr(v.item()) for v in value)
+        return f'        {DAP_TYPES[value.dtype.str[1:]][0]} {name} {values};'
+
+    lines = ['Attributes {', '    NC_GLOBAL {']
+    lines += [attribute(k, nc_in.getncattr(k)) for k in nc_in.ncattrs()]
+    lines.append('    }')
+    for v_name, var in nc_in.variables.items():
+        signed_byte = var.dtype == np.int8
+        lines.append(f'    {v_name} {{')
+        lines += [attribute(k, var.getncattr(k), signed_byte) for k in var.ncattrs()]
+        if signed_byte:
+            lines.append('        String _Unsigned "false";')
+        lines.append('    }')
+    dims = [d_name for d_name, dim in nc_in.dimensions.items() if dim.isunlimited()]
+    lines += ['    DODS_EXTRA {', f'        String Unlimited_Dimension "{dims[0]}";', '    }'] if dims else []
+    lines.append('}')
+    return '\n'.join(lines).encode()
+
+class DapHandler(BaseHTTPRequestHandler):
+    """Answer .dods, .dds and .das requests of the daily files of the dataset like THREDDS."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        return
+
+    def do_GET(self):
+        server = self.server
+        path, _, constraint = self.path.partition('?')
+        if server.redirect is not None and path.startswith(server.redirect[0]):
+            with server.lock:
+                server.requests.append(self.path)
+            self.send_response(server.redirect[1])
+            self.send_header('Location', self.path[len(server.redirect[0]):])
+            self.send_header('Content-Length', '0')
+            return self.end_headers()
+        match = re.match(rf'{PATH_THREDDS}/(.*)\.(dods|dds|das)$', path)
+        with server.lock:
+            server.requests.append(self.path)
+            fail = match is not None and server.fail.get(Path(match.group(1)).name, 0) > 0
+            if fail:
+                server.fail[Path(match.group(1)).name] -= 1
+        if match is None or not server.root.joinpath(match.group(1)).exists():
+            return self.send(404, b'Not found')
+        if fail:
+            return self.send(503, b'Service unavailable')
+        sleep(server.delay(Path(match.group(1)).name))
+        # The netCDF library is not thread-safe, the responses are only delayed concurrently
+        with server.lock, nc4.Dataset(server.root.joinpath(match.group(1))) as nc_in:
+            nc_in.set_auto_maskandscale(False)
+            if match.group(2) == 'das':
+                body = encode_das(nc_in)
+            else:
+                projection = parse_constraint(unquote(constraint), nc_in)
+                arrays = {v_name: (nc_in[v_name].dimensions, np.asarray(nc_in[v_name][key]))
+                          for v_name, key in projection.items()}
+        if match.group(2) != 'das':
+            body = encode_dods(arrays, Path(match.group(1)).name)
+        if match.group(2) == 'dds':
+            body = body[:body.find(b'\nData:\n') + 1]
+        self.send(200, body)
+
+    def send(self, status: int, body: bytes):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+@pytest.fixture(scope='session')
+def dataset(tmp_path_factory):
+    """Small synthetic dataset from 2009-12-28 to 2010-01-14, return its path and lake ids."""
+    path = tmp_path_factory.mktemp('dataset')
+    lakeids = make_dataset(path, n_days=18, n_lakes=6, ny=90, nx=180, startdate='2009-12-28', seed=1)
+    return path, lakeids
+
+@pytest.fixture
+def use_synthetic(dataset, tmp_path, monkeypatch):
+    """Redirect the extraction to the synthetic dataset, outputs and cache to the test directory."""
+    for name in ['PATH_RAW', 'PATH_AUXILIARY', 'PATH_ABBREV', 'PATH_EXTRACTED', 'PATH_CATALOG',
+                 'PATH_CONSOLIDATED', 'PATH_CACHE', 'URL_OPENDAP']:
+        monkeypatch.setattr(c, name, getattr(c, name))
+    use_dataset(dataset[0])
+    c.PATH_EXTRACTED = str(tmp_path.joinpath('extracted'))
+    c.PATH_CACHE = str(tmp_path.joinpath('cache'))
+    return dataset
+
+@pytest.fixture
+def dap_server(use_synthetic):
+    """Stand-in OPeNDAP server of the synthetic dataset, the extraction requests it.
+
+    Requests are recorded in server.requests, server.fail maps filenames to the number of
+    requests answered with 503 and server.delay returns the response delay of a filename.
+    server.redirect (prefix, status) redirects the paths starting with the prefix to the rest.
+    server.dataset is the path and the lake ids of the dataset.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), DapHandler)
+    server.daemon_threads = True
+    server.root = Path(c.PATH_RAW)
+    server.lock = threading.Lock()
+    server.dataset = use_synthetic
+    server.requests, server.fail, server.redirect = [], {}, None
+    server.delay = lambda filename: 0
+    thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+    thread.start()
+    c.URL_OPENDAP = f'http://127.0.0.1:{server.server_port}{PATH_THREDDS}'
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of the OPeNDAP fetcher (against the stand-in server of conftest) and its cache."""
+
+import os
+from time import time
+from pathlib import Path
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+import netCDF4 as nc4
+import pytest
+from scripts import ROOT
+from scripts import constants as c
+from scripts.opendap import (CACHE_SIZE_FILE, DapCache, DapClient, DapError, DapFetcher, decode_dods,
+                             opendap_dates, opendap_url, packed_invalid, unpack)
+from scripts.lakeindex import load_lake_index
+from scripts.functions import extract_lake_subset
+from tests.conftest import encode_dods
+
+VARIABLES = ['lake_surface_water_temperature', 'lswt_quality_level', 'lake_ice_cover_class', 'chla_mean']
+
+def test_decode_dods():
+    # 5 bytes are padded to 8, the Int16 after them starts at the next multiple of four
+    arrays = {'flags': (('lat',), np.array([-1, 0, 1, 2, -128], 'i1')),
+              'lswt': (('time', 'lat', 'lon'), np.array([[[-32768, -1], [0, 32767]]], 'i2')),
+              'time': (('time',), np.array([1262304000], 'i4')),
+              'chla': (('lat', 'lon'), np.array([[0.5, np.nan], [1e30, -2]], 'f4'))}
+    decoded = decode_dods(encode_dods(arrays))
+
+    assert list(decoded) == list(arrays)
+    # Bytes are sent unsigned, cast to the dtype of the output when written
+    assert decoded['flags'].dtype == np.uint8
+    np.testing.assert_array_equal(decoded['flags'].astype('i1'), arrays['flags'][1])
+    # Int16 are sent as Int32 and cast back
+    assert decoded['lswt'].dtype == np.int16
+    for v_name in ['lswt', 'time', 'chla']:
+        assert decoded[v_name].dtype.isnative
+        np.testing.assert_array_equal(decoded[v_name], arrays[v_name][1])
+
+def test_decode_grid():
+    content = (b'Dataset {\n    Grid {\n     ARRAY:\n        Int16 lswt[time = 1][lat = 2];\n'
+               b'     MAPS:\n        Int32 time[time = 1];\n        Float32 lat[lat = 2];\n    } lswt;\n} day.nc;\n'
+               b'\nData:\n' + np.array([2, 2, -5, 7, 1, 1, 100, 2, 2], '>i4').tobytes()
+               + np.array([10.5, 11.5], '>f4').tobytes())
+    decoded = decode_dods(content)
+    np.testing.assert_array_equal(decoded['lswt'], [[-5, 7]])
+    np.testing.assert_array_equal(decoded['time'], [100])
+    np.testing.assert_array_equal(decoded['lat'], [10.5, 11.5])
+
+def test_decode_invalid():
+    with pytest.raises(DapError):
+        decode_dods(b'Dataset {\n    Int16 lswt[lat = 2];\n} day.nc;\n')
+    with pytest.raises(DapError):
+        decode_dods(b'Dataset {\n    String name;\n} day.nc;\n\nData:\n')
+
+def test_packed_invalid():
+    field = np.array([-32768, -32767, -1001, -1000, 0, 5000, 5001, 9999], 'i2')
+    # Fill value, missing values and out of the valid range
+    attrs = {'_FillValue': np.int16(-32768), 'missing_value': np.int16(9999),
+             'valid_min': np.int16(-1000), 'valid_max': np.int16(5000)}
+    np.testing.assert_array_equal(packed_invalid(field, attrs), [1, 1, 1, 0, 0, 0, 1, 1])
+    np.testing.assert_array_equal(packed_invalid(field, {'_FillValue': np.int16(-32768), 'missing_value': 9999}),
+                                  [1, 0, 0, 0, 0, 0, 0, 1])
+    np.testing.assert_array_equal(packed_invalid(field, {'valid_range': np.array([-1000, 5000], 'i2')}),
+                                  [1, 1, 1, 0, 0, 0, 1, 1])
+    # Without _FillValue the netCDF default fill is masked, not for bytes
+    np.testing.assert_array_equal(packed_invalid(field, {}), [0, 1, 0, 0, 0, 0, 0, 0])
+    np.testing.assert_array_equal(packed_invalid(np.array([-127, -1, 0], 'i1'), {}), [0, 0, 0])
+
+    unpacked = unpack(field, {**attrs, 'scale_factor': 0.01, 'add_offset': 273.15})
+    np.testing.assert_array_equal(unpacked.mask, packed_invalid(field, attrs))
+    np.testing.assert_allclose(unpacked.compressed(), [263.15, 273.15, 323.15])
+
+def test_packed_invalid_as_netcdf(use_synthetic):
+    """The fetched values are masked like netCDF4 masks the daily files."""
+    path_ncfile = next(ROOT.joinpath(c.PATH_RAW).rglob('*.nc'))
+    with nc4.Dataset(path_ncfile) as nc_in:
+        for v_name in VARIABLES:
+            expected = nc_in[v_name][0]
+            nc_in[v_name].set_auto_maskandscale(False)
+            var = nc_in[v_name]
+            field = unpack(var[0], {k: var.getncattr(k) for k in var.ncattrs()})
+            np.testing.assert_array_equal(np.ma.getmaskarray(field), np.ma.getmaskarray(expected))
+            np.testing.assert_allclose(field.filled(0), expected.filled(0))
+
+def test_fetch_day(dap_server):
+    bbox = load_lake_index().bbox_of(dap_server.dataset[1][0])
+    date = pd.Timestamp('2010-01-03')
+    arrays, nbytes = DapClient().fetch(opendap_url(date, bbox, VARIABLES))
+
+    assert nbytes > 0 and dap_server.requests[-1].split('?')[0].endswith('.nc.dods')
+    i0, i1, j0, j1 = bbox
+    path_ncfile = next(ROOT.joinpath(c.PATH_RAW).rglob(f'*{date:%Y%m%d}*.nc'))
+    with nc4.Dataset(path_ncfile) as nc_in:
+        nc_in.set_auto_maskandscale(False)
+        np.testing.assert_array_equal(arrays['time'], nc_in['time'][:])
+        np.testing.assert_array_equal(arrays['lat'], nc_in['lat'][i0:i1])
+        np.testing.assert_array_equal(arrays['lon'], nc_in['lon'][j0:j1])
+        for v_name in VARIABLES:
+            expected = nc_in[v_name][0:1, i0:i1, j0:j1]
+            assert arrays[v_name].shape == expected.shape
+            np.testing.assert_array_equal(arrays[v_name].astype(expected.dtype), expected)
+
+def test_retries(dap_server):
+    bbox = load_lake_index().bbox_of(dap_server.dataset[1][0])
+    date = pd.Timestamp('2010-01-02')
+    filename = f'ESACCI-LAKES-L3S-LK_PRODUCTS-MERGED-{date:%Y%m%d}-fv{c.VERSION}.nc'
+
+    # Transient failures are retried with backoff
+    dap_server.fail[filename] = 2
+    fetcher = DapFetcher(workers=1, retries=2, backoff=0.001)
+    arrays = fetcher.fetch_one(date, bbox, VARIABLES)
+    assert fetcher.stats.retries == 2 and fetcher.stats.days == 1
+    assert set(arrays) == {'time', *VARIABLES}
+    assert len(dap_server.requests) == 3
+
+    # Until the retries are exhausted
+    dap_server.fail[filename] = 3
+    fetcher = DapFetcher(workers=1, retries=2, backoff=0.001)
+    with pytest.raises(DapError) as error:
+        fetcher.fetch_one(date, bbox, VARIABLES)
+    assert error.value.status == 503 and error.value.transient
+    assert fetcher.stats.retries == 2
+
+    # Missing files are not retried
+    fetcher = DapFetcher(workers=1, retries=2, backoff=0.001)
+    with pytest.raises(DapError) as error:
+        fetcher.fetch_one(pd.Timestamp('2011-01-01'), bbox, VARIABLES)
+    assert error.value.status == 404 and not error.value.transient
+    assert fetcher.stats.retries == 0
+
+@pytest.mark.parametrize('status', [301, 302, 307])
+def test_redirects(dap_server, status):
+    bbox = load_lake_index().bbox_of(dap_server.dataset[1][0])
+    date = pd.Timestamp('2010-01-03')
+    expected = DapFetcher(workers=1).fetch_one(date, bbox, VARIABLES)
+    n_requests = len(dap_server.requests)
+
+    # Requests of the moved server are redirected to the data
+    dap_server.redirect = ('/old', status)
+    c.URL_OPENDAP = c.URL_OPENDAP.replace('/thredds', '/old/thredds', 1)
+    fetcher = DapFetcher(workers=1, retries=2, backoff=0.001)
+    arrays = fetcher.fetch_one(date, bbox, VARIABLES)
+    assert fetcher.stats.retries == 0
+    assert [path.split('/')[1] for path in dap_server.requests[n_requests:]] == ['old', 'thredds']
+    for v_name, values in expected.items():
+        np.testing.assert_array_equal(arrays[v_name], values)
+    path_ncfile = next(ROOT.joinpath(c.PATH_RAW).rglob(f'*{date:%Y%m%d}*.nc'))
+    with nc4.Dataset(path_ncfile) as nc_in:
+        assert fetcher.attribute(date, bbox, 'time_coverage_end') == nc_in.time_coverage_end
+
+    # Redirect loops fail without retries
+    dap_server.redirect = ('/old', status)
+    c.URL_OPENDAP = c.URL_OPENDAP.replace('/old/thredds', '/old/old/old/old/old/old/old/thredds', 1)
+    with pytest.raises(DapError) as error:
+        fetcher.fetch_one(date, bbox, VARIABLES)
+    assert error.value.status == status and not error.value.transient
+    assert fetcher.stats.retries == 0
+
+def test_fetch_in_time_order(dap_server):
+    bbox = load_lake_index().bbox_of(dap_server.dataset[1][0])
+    dates = opendap_dates('2010-01-01', '2010-01-10')
+    # Earlier days are answered later, so the responses arrive out of order
+    delays = {f'ESACCI-LAKES-L3S-LK_PRODUCTS-MERGED-{date:%Y%m%d}-fv{c.VERSION}.nc': 0.02 * (len(dates) - k)
+              for k, date in enumerate(dates)}
+    dap_server.delay = lambda filename: delays.get(filename, 0)
+    dap_server.fail = {filename: 1 for filename in list(delays)[::3]}
+
+    fetcher = DapFetcher(workers=4, retries=2, backoff=0.001)
+    times = [arrays['time'][0] for arrays in fetcher.fetch(dates, bbox, VARIABLES)]
+    expected = (dates - pd.Timestamp('1970-01-01')).total_seconds().astype(int)
+    np.testing.assert_array_equal(times, expected)
+    assert fetcher.stats.retries == 4
+
+def test_fetch_from_cache(dap_server):
+    bbox = load_lake_index().bbox_of(dap_server.dataset[1][0])
+    dates = opendap_dates('2010-01-01', '2010-01-04')
+    fetched = list(DapFetcher(workers=2, cache=DapCache()).fetch(dates, bbox, VARIABLES[:2]))
+
+    # Only the missing variable is requested again
+    n_requests = len(dap_server.requests)
+    cache = DapCache()
+    cached = list(DapFetcher(workers=2, cache=cache).fetch(dates, bbox, VARIABLES[:3]))
+    assert len(dap_server.requests) == n_requests + len(dates)
+    assert all(VARIABLES[2] in r and VARIABLES[0] not in r for r in dap_server.requests[n_requests:])
+    for arrays, arrays_cached in zip(fetched, cached):
+        for v_name in ['time', *VARIABLES[:2]]:
+            np.testing.assert_array_equal(arrays[v_name], arrays_cached[v_name])
+    assert cache.hits == 3 * len(dates)
+
+def entries_size(path):
+    return sum(entry.stat().st_size for entry in path.rglob('*.npy'))
+
+def put_days(path, variable, n_days):
+    cache = DapCache(path)
+    for date in pd.date_range('2010-01-01', periods=n_days):
+        cache.put(date, variable, (0, 4, 0, 4), np.full((1, 4, 4), date.day, 'i2'))
+
+def test_cache_size(tmp_path, monkeypatch):
+    path = tmp_path / 'cache'
+    put_days(path, 'lswt', 5)
+    size = entries_size(path)
+    assert int(path.joinpath(CACHE_SIZE_FILE).read_text()) == size
+
+    # The entries are not listed again to get the size of the cache
+    def rglob(self, pattern):
+        raise AssertionError('The cache entries are listed!')
+    with monkeypatch.context() as patch:
+        patch.setattr(Path, 'rglob', rglob)
+        cache = DapCache(path)
+        assert cache.size == size
+        # Entries written again replace the previous ones
+        cache.put(pd.Timestamp('2010-01-01'), 'lswt', (0, 4, 0, 4), np.zeros((1, 4, 4), 'i2'))
+        assert cache.size == size
+
+    # The size is counted once if the size file is missing
+    path.joinpath(CACHE_SIZE_FILE).unlink()
+    assert DapCache(path).size == size
+
+    # Writers of several processes update the size
+    with Pool(3) as pool:
+        pool.starmap(put_days, [(path, variable, 8) for variable in ['lswt', 'ice', 'chla']])
+    assert DapCache(path).size == entries_size(path)
+    assert int(path.joinpath(CACHE_SIZE_FILE).read_text()) == entries_size(path)
+
+def test_cache_eviction(tmp_path):
+    path = tmp_path / 'cache'
+    put_days(path, 'lswt', 4)
+    entry_size = entries_size(path) // 4
+    cache = DapCache(path, max_bytes=6 * entry_size)
+    dates = pd.date_range('2010-01-01', periods=4)
+    # Entries were last used in order of their dates, reading the first day makes it the most recent
+    for k, date in enumerate(dates):
+        os.utime(cache.entry(date, 'lswt', (0, 4, 0, 4)), (time() - 100 + k,) * 2)
+    assert cache.get(dates[0], 'lswt', (0, 4, 0, 4)) is not None
+
+    for date in pd.date_range('2010-02-01', periods=3):
+        cache.put(date, 'lswt', (0, 4, 0, 4), np.zeros((1, 4, 4), 'i2'))
+    # 7 entries exceed the cap, the least recently used are evicted down to 90% of it
+    assert cache.size == entries_size(path) <= 0.9 * cache.max_bytes
+    assert [cache.get(date, 'lswt', (0, 4, 0, 4)) is not None for date in dates] == [True, False, False, True]
+    assert int(path.joinpath(CACHE_SIZE_FILE).read_text()) == cache.size
+
+@pytest.mark.parametrize('skip_empty', [False, True])
+def test_extraction_as_local(dap_server, skip_empty):
+    """Days fetched out of order and after retries are written in time order as from the local files."""
+    lakeid = int(dap_server.dataset[1][0])
+    dates = opendap_dates('2010-01-01', '2010-01-10')
+    delays = {f'ESACCI-LAKES-L3S-LK_PRODUCTS-MERGED-{date:%Y%m%d}-fv{c.VERSION}.nc': 0.01 * (len(dates) - k)
+              for k, date in enumerate(dates)}
+    dap_server.delay = lambda filename: delays.get(filename, 0)
+    dap_server.fail = {filename: 1 for filename in list(delays)[1::4]}
+    settings = dict(lakeid=lakeid, variables=VARIABLES, startdate='2010-01-01', enddate='2010-01-10',
+                    block_days=3, skip_empty=skip_empty)
+
+    path_extracted = ROOT.joinpath(c.PATH_EXTRACTED)
+    fn_local = extract_lake_subset(**settings)
+    path_local = path_extracted.joinpath(fn_local).rename(path_extracted.joinpath('local.nc'))
+    fn_dap = extract_lake_subset(**settings, use_opendap=True, opendap_workers=4, opendap_cache=False)
+    assert fn_dap == fn_local
+
+    with nc4.Dataset(path_local) as nc_local, nc4.Dataset(path_extracted.joinpath(fn_dap)) as nc_dap:
+        # netCDF4 adds the DAP2 extra attributes of the server to the global attributes
+        assert [k for k in nc_dap.ncattrs() if not k.startswith('DODS')] == nc_local.ncattrs()
+        assert nc_dap.time_coverage_end == nc_local.time_coverage_end
+        assert set(nc_dap.variables) == set(nc_local.variables)
+        assert np.all(np.diff(nc_dap['time'][:]) > 0)
+        for v_name, var in nc_local.variables.items():
+            values, expected = nc_dap[v_name][:], var[:]
+            assert values.dtype == expected.dtype and values.shape == expected.shape, v_name
+            np.testing.assert_array_equal(np.ma.getmaskarray(values), np.ma.getmaskarray(expected))
+            np.testing.assert_array_equal(values.filled(0), expected.filled(0))
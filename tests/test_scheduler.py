@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of the cost estimate of the scheduler."""
+
+from scripts import constants as c
+from scripts.lakeindex import load_lake_index
+from scripts.scheduler import lake_costs
+
+def test_lake_costs(use_synthetic, monkeypatch):
+    lakeids = [int(lakeid) for lakeid in use_synthetic[1]]
+    costs = lake_costs(lakeids, '2010-01-01', '2010-01-10')
+    lake_index = load_lake_index()
+    for lakeid in lakeids:
+        i0, i1, j0, j1 = lake_index.bbox_of(lakeid)
+        assert costs[lakeid] == 10 * ((i1 - i0) * (j1 - j0) + c.COST_DAY_CELLS)
+
+    # Without maskfile the table of v2.0.1 has no bboxes, all lakes cost the same
+    monkeypatch.setattr(c, 'FN_MASK', 'missing.nc')
+    monkeypatch.setattr(c, 'DIR_INDEX', 'missing')
+    costs = lake_costs(lakeids, '2010-01-01', '2010-01-10')
+    assert costs == {lakeid: 10 * c.COST_DAY_CELLS for lakeid in lakeids}
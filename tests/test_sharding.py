@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of the time-sharded extraction: outputs and statistics as from the extraction of the whole daterange."""
+
+import numpy as np
+import netCDF4 as nc4
+import pytest
+from scripts import ROOT
+from scripts import constants as c
+from scripts.functions import extract_lake_subset
+from scripts.sharding import extract_lake_sharded
+from scripts.zarrstore import open_output
+
+VARIABLES = ['lake_surface_water_temperature', 'lake_ice_cover_class']
+
+def assert_same_output(path_a, path_b):
+    if path_a.suffix == '.csv':
+        assert path_a.read_text() == path_b.read_text()
+        return
+    with open_output(path_a) as nc_a, open_output(path_b) as nc_b:
+        assert {k: str(nc_a.getncattr(k)) for k in nc_a.ncattrs()} == {k: str(nc_b.getncattr(k)) for k in nc_b.ncattrs()}
+        assert list(nc_a.variables) == list(nc_b.variables)
+        for v_name, var in nc_a.variables.items():
+            values, expected = nc_b[v_name][:], var[:]
+            assert values.dtype == expected.dtype and values.shape == expected.shape, v_name
+            np.testing.assert_array_equal(np.ma.getmaskarray(values), np.ma.getmaskarray(expected))
+            np.testing.assert_array_equal(np.ma.filled(values, 0), np.ma.filled(expected, 0))
+            assert nc_b[v_name].chunking() == var.chunking(), v_name
+
+@pytest.mark.parametrize('statistics, write_cube, backend', [(None, True, 'netcdf'), ('csv', True, 'netcdf'),
+                                                             ('nc', False, 'netcdf'), ('csv', True, 'zarr')])
+def test_sharded_as_whole(use_synthetic, statistics, write_cube, backend):
+    lakeid = int(use_synthetic[1][0])
+    # The daterange is split into the shards of December and January
+    settings = dict(variables=VARIABLES, startdate='2009-12-29', enddate='2010-01-10', block_days=4,
+                    statistics=statistics, min_quality=2 if statistics else None, write_cube=write_cube,
+                    backend=backend)
+    path_extracted = ROOT.joinpath(c.PATH_EXTRACTED)
+    fns_whole = [extract_lake_subset(lakeid=lakeid, **settings)]
+    if statistics is not None and write_cube:
+        fns_whole += [path.name for path in path_extracted.glob('*-stats*')]
+    path_whole = path_extracted.joinpath('whole')
+    path_whole.mkdir()
+    for fn in fns_whole:
+        path_extracted.joinpath(fn).rename(path_whole.joinpath(fn))
+
+    fn_sharded = extract_lake_sharded(lakeid, shard='month', n_processes=2, **settings)
+    assert fn_sharded == fns_whole[0]
+    for fn in fns_whole:
+        assert_same_output(path_whole.joinpath(fn), path_extracted.joinpath(fn))
+    # The shards are removed once merged
+    assert not any(path_extracted.joinpath('temp').iterdir())
+
+def test_sharded_incremental(use_synthetic):
+    lakeid = int(use_synthetic[1][0])
+    settings = dict(variables=VARIABLES, startdate='2009-12-29', enddate='2010-01-10', incremental=True)
+    fn_output = extract_lake_sharded(lakeid, shard='month', n_processes=2, **settings)
+    path_output = ROOT.joinpath(c.PATH_EXTRACTED).joinpath(fn_output)
+    mtime = path_output.stat().st_mtime_ns
+
+    # A complete output is kept, without incremental it is extracted again
+    assert extract_lake_sharded(lakeid, shard='month', n_processes=2, **settings) == fn_output
+    assert path_output.stat().st_mtime_ns == mtime
+    extract_lake_sharded(lakeid, shard='month', n_processes=2, **{**settings, 'incremental': False})
+    assert path_output.stat().st_mtime_ns != mtime
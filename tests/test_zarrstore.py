@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of the Zarr store: read back with a Zarr reader and written by concurrent processes."""
+
+from multiprocessing import Pool
+import numpy as np
+import netCDF4 as nc4
+import pytest
+from scripts.zarrstore import ZarrStore, open_output
+
+N_DAYS = 23
+CHUNKS = (4, 3, 3)
+# Time ranges of the writers of 3 days, the borders of neighbouring writers are inside the chunks of 4 days
+RANGES = [(start, min(start + 3, N_DAYS)) for start in range(0, N_DAYS, 3)]
+
+def create_output(nc_out):
+    """Create dims and variables like an extracted subset (time unlimited, coords without fill)."""
+    nc_out.createDimension('time', None)
+    nc_out.createDimension('lat', 5)
+    nc_out.createDimension('lon', 7)
+    var = nc_out.createVariable('time', 'i4', ('time',))
+    var.setncatts({'units': 'seconds since 1970-01-01 00:00:00', 'standard_name': 'time'})
+    for name, n in [('lat', 5), ('lon', 7)]:
+        var = nc_out.createVariable(name, 'f4', (name,))
+        var.setncatts({'units': f'degrees_{"north" if name == "lat" else "east"}'})
+        var[:] = np.linspace(10, 11, n, dtype='f4')
+    var = nc_out.createVariable('lake_surface_water_temperature', 'i2', ('time', 'lat', 'lon'), zlib=True,
+                                complevel=4, chunksizes=CHUNKS, fill_value=-32768)
+    var.setncatts({'scale_factor': np.float32(0.01), 'add_offset': np.float32(273.15), 'units': 'K',
+                   'valid_range': np.array([-2000, 5000], 'i2')})
+    var = nc_out.createVariable('lake_ice_cover_class', 'i1', ('time', 'lat', 'lon'), zlib=True,
+                                complevel=4, chunksizes=CHUNKS, fill_value=-1)
+    var.setncatts({'flag_values': np.array([0, 1, 2], 'i1')})
+    nc_out.setncatts({'title': 'test', 'lake_id': 2})
+
+def day_values(idx):
+    """Return the masked values of a day (cells outside the lake are masked)."""
+    rng = np.random.default_rng(idx)
+    mask = np.zeros((5, 7), bool)
+    mask[0, :2] = mask[-1, -3:] = True
+    lswt = np.ma.masked_array(np.round(rng.uniform(275, 300, (5, 7)), 2), mask)
+    ice = np.ma.masked_array(rng.integers(0, 3, (5, 7)).astype('i1'), mask)
+    return lswt, ice
+
+def write_days(path, start, stop):
+    """Write the days [start, stop) day by day into an existing output."""
+    with open_output(path, 'r+') as nc_out:
+        for idx in range(start, stop):
+            lswt, ice = day_values(idx)
+            nc_out['time'][idx] = 86400 * idx
+            nc_out['lake_surface_water_temperature'][idx] = lswt
+            nc_out['lake_ice_cover_class'][idx] = ice
+
+def write_output(path, ranges=((0, N_DAYS),), processes=1):
+    with open_output(path, 'w') as nc_out:
+        create_output(nc_out)
+    if processes == 1:
+        for start, stop in ranges:
+            write_days(path, start, stop)
+    else:
+        with Pool(processes) as pool:
+            pool.starmap(write_days, [(path, start, stop) for start, stop in ranges])
+    # Reopen to write the consolidated metadata of the complete store
+    with open_output(path, 'r+'):
+        pass
+
+def test_read_with_zarr(tmp_path):
+    zarr = pytest.importorskip('zarr', reason='zarr is needed to read the stores (see setup/environment.yaml)')
+    path_nc, path_zarr = tmp_path / 'lake.nc', tmp_path / 'lake.extracted.zarr'
+    write_output(path_nc)
+    write_output(path_zarr)
+
+    group = zarr.open_consolidated(str(path_zarr), mode='r')
+    with nc4.Dataset(path_nc) as nc_in:
+        nc_in.set_auto_maskandscale(False)
+        assert set(group.array_keys()) == set(nc_in.variables)
+        for name, var in nc_in.variables.items():
+            array = group[name]
+            np.testing.assert_array_equal(array[...], var[...])
+            assert array.dtype == var.dtype
+            assert array.attrs['_ARRAY_DIMENSIONS'] == list(var.dimensions)
+            # Variables without _FillValue in netCDF (the coordinates) have no fill value
+            if '_FillValue' in var.ncattrs():
+                assert array.fill_value == var.getncattr('_FillValue')
+            else:
+                assert array.fill_value is None
+            attrs = {k: v for k, v in array.attrs.items() if k != '_ARRAY_DIMENSIONS'}
+            assert set(attrs) == set(var.ncattrs()) - {'_FillValue'}
+            for k, v in attrs.items():
+                np.testing.assert_array_equal(v, var.getncattr(k))
+        assert group.attrs['title'] == 'test' and group.attrs['lake_id'] == 2
+        assert group['lake_surface_water_temperature'].chunks == CHUNKS
+
+def test_read_masked_and_scaled(tmp_path):
+    path_nc, path_zarr = tmp_path / 'lake.nc', tmp_path / 'lake.extracted.zarr'
+    write_output(path_nc)
+    write_output(path_zarr)
+    with nc4.Dataset(path_nc) as nc_in, ZarrStore(path_zarr) as store:
+        assert len(store.dimensions['time']) == N_DAYS and store.dimensions['time'].isunlimited()
+        assert '_FillValue' not in store['lat'].ncattrs()
+        for name, var in nc_in.variables.items():
+            key = (slice(2, 9), slice(1, None), 3)[:len(var.dimensions)]
+            expected, values = nc_in[name][key], store[name][key]
+            np.testing.assert_array_equal(np.ma.getmaskarray(values), np.ma.getmaskarray(expected))
+            np.testing.assert_allclose(values.filled(0), expected.filled(0))
+
+def test_concurrent_writers(tmp_path):
+    path_single, path_concurrent = tmp_path / 'single.extracted.zarr', tmp_path / 'concurrent.extracted.zarr'
+    write_output(path_single)
+    # Neighbouring writers share the partly written chunks at the borders of their ranges
+    write_output(path_concurrent, RANGES, processes=len(RANGES))
+
+    files = sorted(p.relative_to(path_single) for p in path_single.rglob('*') if p.is_file())
+    assert files == sorted(p.relative_to(path_concurrent) for p in path_concurrent.rglob('*') if p.is_file())
+    for path in files:
+        assert path_single.joinpath(path).read_bytes() == path_concurrent.joinpath(path).read_bytes(), path